@@ -1,5 +1,6 @@
 # location_share/settings.py
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,6 +38,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tracker.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,6 +76,9 @@ DATABASES = {
         'PASSWORD': '3333', # パスワード
         'HOST': 'localhost',            # 通常はローカル開発なら 'localhost'
         'PORT': '5432',                 # PostgreSQLのデフォルトポート
+        # スレッドプール経由のDBアクセスで呼び出しごとに接続し直さない
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -107,6 +112,93 @@ CHANNEL_LAYERS = {
     },
 }
 WEBSOCKET_TIMEOUT = 60  # 60秒
+
+# セッションメタデータキャッシュ（プロセス内）
+SESSION_META_CACHE_SIZE = 10000  # 最大保持セッション数（LRU）
+SESSION_META_CACHE_TTL = 300  # 秒
+
+# 位置情報のライトビハインドバッファ
+LOCATION_FLUSH_INTERVAL = 2.0  # DBへまとめて書き込む間隔（秒）
+LOCATION_FLUSH_BATCH_SIZE = 500  # 1回のupsertの最大行数
+LOCATION_BUFFER_MAX_ROOMS = 1000  # メモリに保持するルーム数（LRU）
+LOCATION_HISTORY_MAX_PENDING = 100000  # 書き込み待ちの履歴の上限（超えたら古いものから破棄）
+
+# ルームごとのブロードキャスト集約間隔: (参加者数の上限, 秒)。Noneはそれ以上すべて
+LOCATION_BROADCAST_TICKS = [
+    (10, 0.2),
+    (50, 0.35),
+    (None, 0.5),
+]
+
+# 受信した位置のサーバー側フィルタ
+LOCATION_FILTER_MIN_DISTANCE = 5.0  # これ未満の移動は捨てる（メートル）
+LOCATION_FILTER_ACCURACY_FACTOR = 1.0  # 精度（誤差半径）の何倍までの移動を揺れとみなすか
+LOCATION_FILTER_MAX_SPEED = 80.0  # これを超える速度は外れ値（m/s）
+LOCATION_FILTER_KEEPALIVE = 30.0  # 前回の採用からこの秒数が経ったら動いていなくても採用
+LOCATION_FILTER_MAX_OUTLIERS = 3  # 外れ値がこの回数続いたら採用（実際に移動したとみなす）
+
+# クライアントへの送信間隔の指示（rate_hint）
+LOCATION_RATE_ROOM_BUDGET = 20.0  # 1ルームあたりの位置受信の上限（件/秒）
+LOCATION_RATE_WORKER_BUDGET = 300.0  # 1ワーカーあたりの位置受信の上限（件/秒）
+LOCATION_RATE_LAG_THRESHOLD = 0.1  # イベントループの遅延がこれを超えたら間隔を延ばす（秒）
+
+# 大規模セッション（表示範囲のセルだけを配信）
+LARGE_SESSION_MIN_PARTICIPANTS = 200  # max_participantsがこれ以上のセッションで有効
+LARGE_SESSION_CELL_SIZE = 0.05  # グリッドのセルの大きさ（度、約5km）
+# 表示範囲がこれより多くのセルにまたがる場合はルーム全体を配信
+# （0.05度×400セルで約1度四方まで。スマートフォンでズーム10、PCの全画面でズーム12程度から）
+LARGE_SESSION_MAX_CELLS = 400
+
+# 期限切れセッションの削除（python manage.py reap_sessions でも実行可能）
+SESSION_REAPER_INTERVAL = None  # ワーカー内で定期実行する間隔（秒）。Noneなら実行しない
+SESSION_REAPER_BATCH_SIZE = 500  # 1バッチのセッション数
+SESSION_REAPER_GRACE_MINUTES = 60  # 期限切れからこの分数を過ぎたセッションを削除
+SESSION_REAPER_ARCHIVE_DIR = None  # 指定すると削除前にJSON Lines（gzip）で書き出す
+
+# 在席状況（ping・位置の受信）の管理
+PRESENCE_TIMEOUT = 150.0  # この秒数何も届かない参加者をオフラインにする（pingの指示間隔の3倍の方が長ければそちら）
+PRESENCE_SWEEP_INTERVAL = 10.0  # タイムアウトを確認する間隔（秒）
+PRESENCE_PERSIST_INTERVAL = 30.0  # 最終受信時刻をLocationDataへ書き込む間隔（秒）
+CONNECTION_STALE_AFTER = 300.0  # 最終受信からこの秒数を過ぎた接続は（異常終了したワーカーのものとみなし）数えない
+WEBSOCKET_MAX_MESSAGE_LENGTH = 8192  # 受信する1フレームの上限（文字数）。超えたものは解析せずに捨てる
+
+# WebSocket接続の受け入れ制御（ワーカーごと）
+ADMISSION_MAX_CONNECTIONS = 5000  # ワーカー全体の接続数の上限（Noneで無制限）
+ADMISSION_IP_RATE = 1.0  # IPアドレスごとの接続頻度（件/秒）
+ADMISSION_IP_BURST = 20  # IPアドレスごとに連続して受け入れる接続数
+ADMISSION_SESSION_RATE = 10.0  # セッションごとの接続頻度（件/秒）
+ADMISSION_SESSION_BURST = 100  # セッションごとに連続して受け入れる接続数
+ADMISSION_SOCKETS_PER_PARTICIPANT = 3  # max_participants × この数 までセッションの接続を受け入れる
+ADMISSION_TRUSTED_PROXIES = ['127.0.0.1', '::1']  # X-Forwarded-Forを信頼するプロキシ（アドレスまたはCIDR）
+
+# コンシューマーのDBアクセスを非同期接続のプールで行う（tracker/async_db.py）
+ASYNC_DB_POOL_SIZE = 10  # ワーカーごとの接続数（0でスレッドプール経由のORMを使う）
+ASYNC_DB_POOL_TIMEOUT = 5.0  # 空き接続を待つ上限（秒）
+
+# Prometheus形式のメトリクス（/metrics）。スタッフ以外はこのIPアドレスからのみ取得できる
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# WebSocketメッセージのトレース（tracker/tracing.py）
+TRACE_SAMPLE_RATE = 0.0  # 内訳（スパンごとの時間・SQL件数）を記録するメッセージの割合（0で無効）
+SLOW_MESSAGE_THRESHOLD = 0.5  # 処理にこの秒数以上かかったメッセージを slow_messages.log に書き出す
+
+# WebSocketメッセージごとのログ（位置更新・状態同期など、tracker/log.py の message_log）
+WEBSOCKET_MESSAGE_LOG = False  # 調査時のみTrueにする（Falseならほぼコストなし）
+WEBSOCKET_MESSAGE_LOG_RATE = 5.0  # メッセージ種別ごとの上限（件/秒）。超えた分は捨てる
+WEBSOCKET_MESSAGE_LOG_BURST = 20  # メッセージ種別ごとに連続して書き出す件数
+
+# セッション利用ログ（SessionLog）のまとめ書き（tracker/session_events.py）
+SESSION_LOG_BATCH_SIZE = 500  # この件数たまったら書き込む
+SESSION_LOG_FLUSH_INTERVAL = 2.0  # 少なくともこの間隔（秒）で書き込む
+SESSION_LOG_MAX_QUEUE = 10000  # 書き込み待ちの上限。超えたイベントは捨てる
+SESSION_LOG_SAMPLE_RATES = {'location_updated': 0.1}  # 件数の多い種類は割合を指定して記録する
+
+# お問い合わせメールの送信キュー（tracker/mail_queue.py）
+MAIL_QUEUE_MAX_ATTEMPTS = 5  # この回数失敗したら諦める
+MAIL_QUEUE_RETRY_DELAY = 5.0  # 再送までの待ち時間（秒）。失敗するたびに倍にする
+MAIL_QUEUE_MAX_RETRY_DELAY = 300.0  # 再送までの待ち時間の上限（秒）
+MAIL_QUEUE_MAX_SIZE = 1000  # 送信待ちの上限。超えた問い合わせはエラーにする
+
 # 本番環境でRedisを使用する場合は以下をコメントアウト解除
 # CHANNEL_LAYERS = {
 #     'default': {
@@ -116,6 +208,19 @@ WEBSOCKET_TIMEOUT = 60  # 60秒
 #         },
 #     },
 # }
+
+# Redisなしで複数ワーカーを動かす場合（先に python manage.py run_channel_broker を起動）
+# 位置情報の差分のバージョンとスナップショットもブローカーが持つ（ワーカーをまたいでも食い違わない）
+CHANNEL_BROKER_SOCKET = '/tmp/location_share_channels.sock'
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'tracker.channel_layer.UnixSocketChannelLayer',
+#         'CONFIG': {
+#             'path': CHANNEL_BROKER_SOCKET,
+#             'expiry': 300,
+#         },
+#     },
+# }
 # Internationalization
 LANGUAGE_CODE = 'ja'
 TIME_ZONE = 'Asia/Tokyo'
@@ -185,15 +290,26 @@ LOGGING = {
         },
         'console': {
             'level': 'INFO',
-            'class': 'logging.StreamHandler',
+            '()': 'tracker.log.BackgroundHandler',
+            'target': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
         'contact_file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            '()': 'tracker.log.BackgroundHandler',
+            'target': 'logging.FileHandler',
             'filename': BASE_DIR / 'contact.log',
             'formatter': 'simple',
         },
+        'slow_message_file': {
+            'level': 'WARNING',
+            '()': 'tracker.log.BackgroundHandler',
+            'target': 'logging.FileHandler',
+            'filename': BASE_DIR / 'slow_messages.log',
+            # 遅いメッセージが出るまでファイルを作らない（テスト・管理コマンドで空のファイルを残さない）
+            'delay': True,
+            'formatter': 'simple',
+        },
     },
     'root': {
         'handlers': ['console'],  # ファイルハンドラーを削除して一旦コンソールのみに
@@ -210,5 +326,21 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'tracker.mail_queue': {
+            'handlers': ['contact_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'tracker.slow': {
+            'handlers': ['slow_message_file'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
+
+# テスト実行中はリポジトリ内のログファイル（contact.log など）に書き込まない
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+if TESTING:
+    for name in ('contact_file', 'slow_message_file'):
+        LOGGING['handlers'][name] = {'class': 'logging.NullHandler'}
@@ -0,0 +1,172 @@
+# tracker/admission.py
+"""WebSocket接続の受け入れ制御
+
+connect() でグループに参加する前に、次の順で判定する（DBを見ない判定を先に行う）。
+
+- ワーカー全体の接続数の上限
+- IPアドレスごとの接続頻度
+- セッションごとの接続頻度
+- セッションの参加者数（max_participants）と、このワーカーでのセッションの接続数
+
+カウンターはワーカーのメモリに持つ（ワーカーごとの制限）。拒否した接続は
+ハンドシェイク後に下の終了コードで閉じ、クライアントは再接続の仕方を変える。
+"""
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# WebSocketの終了コード（4000-4999はアプリケーション定義）。location-sharing.js の CLOSE_CODES と合わせる
+CLOSE_SESSION_FULL = 4001
+CLOSE_RATE_LIMITED = 4029
+CLOSE_SERVER_BUSY = 4503
+
+
+class RateLimiter:
+    """キーごとのトークンバケット（rate件/秒、最大burst件まで溜まる）"""
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # key -> [トークン数, 最終更新時刻]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+
+class AdmissionControl:
+    def __init__(self, max_connections=5000, ip_rate=1.0, ip_burst=20,
+                 session_rate=10.0, session_burst=100, sockets_per_participant=3):
+        self.max_connections = max_connections
+        self.ip_limiter = RateLimiter(ip_rate, ip_burst)
+        self.session_limiter = RateLimiter(session_rate, session_burst)
+        # 複数タブ・再接続中の重複を見込んだ、参加者1人あたりの接続数
+        self.sockets_per_participant = sockets_per_participant
+        # session_pk -> このワーカーで受け入れた接続数
+        self._sockets = {}
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = {CLOSE_SESSION_FULL: 0, CLOSE_RATE_LIMITED: 0, CLOSE_SERVER_BUSY: 0}
+
+    def check_worker(self, connections, ip):
+        """セッションを見る前の判定。拒否する場合は終了コードを返す"""
+        if self.max_connections and connections >= self.max_connections:
+            return self._reject(CLOSE_SERVER_BUSY)
+        if ip and not self.ip_limiter.allow(ip):
+            return self._reject(CLOSE_RATE_LIMITED)
+        return None
+
+    def check_session(self, meta, room_size, participant_id=None, is_member=False):
+        """セッションごとの判定。受け入れる場合はNoneを返し、接続数を数え始める（disconnectでrelease）
+
+        participant_idが分かっていて既にルームにいる参加者（is_member）は満員でも受け入れる。
+        """
+        if not self.session_limiter.allow(meta.pk):
+            return self._reject(CLOSE_RATE_LIMITED)
+        with self._lock:
+            sockets = self._sockets.get(meta.pk, 0)
+            full = sockets >= meta.max_participants * self.sockets_per_participant or (
+                participant_id and not is_member and room_size >= meta.max_participants
+            )
+            if not full:
+                self._sockets[meta.pk] = sockets + 1
+                self.admitted += 1
+                return None
+        return self._reject(CLOSE_SESSION_FULL)
+
+    def release(self, session_pk):
+        with self._lock:
+            sockets = self._sockets.get(session_pk, 0) - 1
+            if sockets > 0:
+                self._sockets[session_pk] = sockets
+            else:
+                self._sockets.pop(session_pk, None)
+
+    def is_full(self, meta, room_size, is_member):
+        """参加（join）時の判定。接続時に参加者IDを送らない古いクライアント用"""
+        if is_member or room_size < meta.max_participants:
+            return False
+        self._reject(CLOSE_SESSION_FULL)
+        return True
+
+    def stats(self):
+        return {
+            'admitted': self.admitted,
+            'rejected_session_full': self.rejected[CLOSE_SESSION_FULL],
+            'rejected_rate_limited': self.rejected[CLOSE_RATE_LIMITED],
+            'rejected_server_busy': self.rejected[CLOSE_SERVER_BUSY],
+            'sessions': len(self._sockets),
+        }
+
+    def _reject(self, code):
+        with self._lock:
+            self.rejected[code] += 1
+        return code
+
+
+def _networks(addresses):
+    return [ipaddress.ip_network(address, strict=False) for address in addresses]
+
+
+# X-Forwarded-For を付け替えてよいプロキシ（この中からの接続の場合だけヘッダーを見る）
+TRUSTED_PROXIES = _networks(getattr(settings, 'ADMISSION_TRUSTED_PROXIES', ['127.0.0.1', '::1']))
+
+
+def is_trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(scope):
+    """接続元のIPアドレス
+
+    X-Forwarded-For は信頼するプロキシ（ADMISSION_TRUSTED_PROXIES）からの接続の場合だけ使い、
+    右から順に信頼するプロキシを除いた最初のアドレスを接続元とする。それ以外はソケットの接続元。
+    ヘッダーを付け替えて接続数の制限やIPごとの接続頻度の制限を逃れられないようにするため。
+    Unixソケット経由（scopeにclientがない）の接続は同じホストのプロキシからとみなす。
+    """
+    client = scope.get('client')
+    remote = client[0] if client else None
+    if remote is not None and not is_trusted_proxy(remote):
+        return remote
+    forwarded = [
+        value.decode('latin-1')
+        for name, value in scope.get('headers', ()) if name == b'x-forwarded-for'
+    ]
+    hops = [hop.strip() for hop in ','.join(forwarded).split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else remote
+
+
+admission = AdmissionControl(
+    max_connections=getattr(settings, 'ADMISSION_MAX_CONNECTIONS', 5000),
+    ip_rate=getattr(settings, 'ADMISSION_IP_RATE', 1.0),
+    ip_burst=getattr(settings, 'ADMISSION_IP_BURST', 20),
+    session_rate=getattr(settings, 'ADMISSION_SESSION_RATE', 10.0),
+    session_burst=getattr(settings, 'ADMISSION_SESSION_BURST', 100),
+    sockets_per_participant=getattr(settings, 'ADMISSION_SOCKETS_PER_PARTICIPANT', 3),
+)
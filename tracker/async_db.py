@@ -0,0 +1,183 @@
+# tracker/async_db.py
+"""コンシューマーのよく通るDBアクセスをイベントループから直接行う
+
+database_sync_to_async はスレッドプール（既定では1スレッド）を経由するため、参加者の多い
+ルームでは呼び出しがキューで待たされる。ここではpsycopgの非同期接続をプールしておき、
+参加者の状態の読み出しとバックグラウンド状態の更新を await だけで行う。
+
+ワーカーごとの接続数は ASYNC_DB_POOL_SIZE（settings.py では10）。0にした場合（設定がない場合も）は
+従来どおりスレッドプール経由でORMを使う。
+プールはイベントループごとに作り直す（psycopgの非同期接続はループをまたいで使えない）。
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from . import tracing
+from .metrics import database_sync, db_helper
+from .models import LocationData
+
+PARTICIPANT_TABLE = LocationData._meta.db_table
+
+
+class AsyncConnectionPool:
+    """psycopg.AsyncConnection の単純なプール（最大size本、空きがなければtimeout秒待つ）"""
+
+    def __init__(self, size=0, timeout=5.0, alias='default'):
+        self.size = size
+        self.timeout = timeout
+        self.alias = alias
+        self._loop = None
+        self._slots = None
+        self._idle = None
+        self._opened = 0
+        self.acquired = 0
+        self.waited = 0
+
+    @property
+    def enabled(self):
+        return bool(self.size) and connections[self.alias].vendor == 'postgresql'
+
+    def _connect_kwargs(self):
+        params = connections[self.alias].get_connection_params()
+        # Django用のカーソル・型変換の設定は使わない
+        params.pop('cursor_factory', None)
+        params.pop('context', None)
+        params.pop('prepare_threshold', None)
+        params.pop('server_side_binding', None)
+        return params
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 別のループ（テスト・管理コマンド）で作った接続は捨てる
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.size)
+            self._idle = []
+            self._opened = 0
+
+    async def _acquire(self):
+        import psycopg
+
+        self._bind_loop()
+        self.acquired += 1
+        # 待っている順に接続を渡す（空き接続を後から来た呼び出しに横取りさせない）
+        if self._slots.locked():
+            self.waited += 1
+        await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+                self._opened -= 1
+            conn = await psycopg.AsyncConnection.connect(autocommit=True, **self._connect_kwargs())
+            self._opened += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, broken=False):
+        if broken or conn.closed:
+            self._opened -= 1
+            if not conn.closed:
+                asyncio.ensure_future(conn.close())
+        else:
+            self._idle.append(conn)
+        self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            # 失敗した接続は状態が分からないので戻さない
+            self._release(conn, broken=True)
+            raise
+        else:
+            self._release(conn)
+
+    async def fetchone(self, sql, params):
+        tracing.count_query()
+        async with self.connection() as conn:
+            cursor = await conn.execute(sql, params)
+            return await cursor.fetchone()
+
+    async def execute(self, sql, params):
+        tracing.count_query()
+        async with self.connection() as conn:
+            cursor = await conn.execute(sql, params)
+            return cursor.rowcount
+
+    async def close(self):
+        if self._idle is None:
+            return
+        while self._idle:
+            await self._idle.pop().close()
+        self._opened = 0
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'enabled': self.enabled,
+            'opened': self._opened,
+            'idle': len(self._idle) if self._idle is not None else 0,
+            'acquired': self.acquired,
+            'waited': self.waited,
+        }
+
+
+pool = AsyncConnectionPool(
+    size=getattr(settings, 'ASYNC_DB_POOL_SIZE', 0),
+    timeout=getattr(settings, 'ASYNC_DB_POOL_TIMEOUT', 5.0),
+)
+
+
+# --- 参加者の状態 ---
+# 同期版（スレッドプール経由）と非同期版は同じ値を返す
+
+def get_participant_sync(session_pk, participant_id, active_only=True):
+    """(participant_name, status, is_online) または None"""
+    queryset = LocationData.objects.filter(session_id=session_pk, participant_id=participant_id)
+    if active_only:
+        queryset = queryset.filter(is_active=True)
+    return queryset.order_by().values_list('participant_name', 'status', 'is_online').first()
+
+
+@db_helper
+async def get_participant(session_pk, participant_id, active_only=True, pooled=None):
+    if not (pool.enabled if pooled is None else pooled):
+        return await database_sync(get_participant_sync)(session_pk, participant_id, active_only)
+    sql = (
+        f'SELECT participant_name, status, is_online FROM {PARTICIPANT_TABLE} '
+        'WHERE session_id = %s AND participant_id = %s'
+    )
+    if active_only:
+        sql += ' AND is_active'
+    return await pool.fetchone(sql + ' LIMIT 1', (session_pk, participant_id))
+
+
+def set_background_sync(session_pk, participant_id, is_background):
+    return LocationData.objects.filter(
+        session_id=session_pk,
+        participant_id=participant_id
+    ).update(
+        is_background=is_background,
+        last_updated=timezone.now()
+    )
+
+
+@db_helper
+async def set_background(session_pk, participant_id, is_background, pooled=None):
+    if not (pool.enabled if pooled is None else pooled):
+        return await database_sync(set_background_sync)(session_pk, participant_id, is_background)
+    return await pool.execute(
+        f'UPDATE {PARTICIPANT_TABLE} SET is_background = %s, last_updated = %s '
+        'WHERE session_id = %s AND participant_id = %s',
+        (is_background, timezone.now(), session_pk, participant_id)
+    )
@@ -0,0 +1,155 @@
+# tracker/broadcaster.py
+import asyncio
+import json
+import logging
+import weakref
+
+from django.conf import settings
+
+from . import codec, metrics
+from .location_buffer import location_buffer
+from .spatial import cell_group_name
+
+logger = logging.getLogger(__name__)
+
+# (ルームの参加者数の上限, 集約間隔[秒])。上限Noneは残り全て
+DEFAULT_BROADCAST_TICKS = [
+    (10, 0.2),
+    (50, 0.35),
+    (None, 0.5),
+]
+
+
+def broadcast_tick(room_size):
+    """ルームの人数に応じたブロードキャスト集約間隔"""
+    for max_size, tick in getattr(settings, 'LOCATION_BROADCAST_TICKS', DEFAULT_BROADCAST_TICKS):
+        if max_size is None or room_size <= max_size:
+            return tick
+    return 0
+
+
+class RoomBroadcaster:
+    """ルーム単位で変更のあった参加者を集め、1 tickにつき1回だけ差分を送信する"""
+
+    def __init__(self, channel_layer, group_name, session_pk, cell_size=None):
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.session_pk = session_pk
+        # 大規模セッションではセルごとのグループにも送る（Noneなら通常のルーム）
+        self.cell_size = cell_size
+        self.dirty = set()
+        self._task = None
+        # 差分のバージョン順に送信するためのロック
+        self._lock = asyncio.Lock()
+        self.emitted = 0
+        self.coalesced = 0
+
+    def mark_dirty(self, participant_id):
+        """次のtickで送信する参加者として登録"""
+        if participant_id in self.dirty:
+            self.coalesced += 1
+        self.dirty.add(participant_id)
+        if self._task is None:
+            tick = broadcast_tick(location_buffer.room_size(self.session_pk))
+            self._task = asyncio.get_running_loop().create_task(self._flush_later(tick))
+
+    async def flush_now(self, participant_id=None):
+        """集約を待たずに送信（参加・退出時）"""
+        if participant_id is not None:
+            self.dirty.add(participant_id)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._emit()
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        # ここから先はキャンセルさせない（flush_nowは_taskがNoneなら何もしない）
+        self._task = None
+        try:
+            await self._emit()
+        except Exception:
+            logger.exception("Room broadcast failed")
+
+    async def _emit(self):
+        async with self._lock:
+            if not self.dirty:
+                return
+            participant_ids, self.dirty = sorted(self.dirty), set()
+            if is_shared(self.channel_layer):
+                await self._emit_shared(participant_ids)
+                return
+            delta = location_buffer.delta(self.session_pk, participant_ids)
+            if delta is None:
+                return
+            self.emitted += 1
+            compact = delta.pop('compact')
+            # 受信側ごとにエンコードしないよう、送信フレームをここで一度だけ作る
+            await metrics.group_send(
+                self.channel_layer,
+                all_locations_group(self.group_name) if self.cell_size else self.group_name,
+                {
+                    'type': 'location_broadcast',
+                    'frame': json.dumps({'type': 'location_delta', **delta}),
+                    'compact_frame': codec.dumps(compact)
+                }
+            )
+            if self.cell_size:
+                await self._emit_cells(participant_ids)
+
+    async def _emit_shared(self, participant_ids):
+        """複数ワーカー構成: 変更をブローカーのルームへ送る（バージョンとフレームはブローカーが付ける）
+
+        差分はルームのグループ全体に届き、表示範囲を購読している接続はフレームを送らずに状態だけ反映する。
+        """
+        changes = location_buffer.take_changes(self.session_pk, participant_ids)
+        if not changes:
+            return
+        if not self.channel_layer.has_room(self.group_name):
+            # ブローカーへ再接続した（ルームが捨てられている）ので、このワーカーの状態から作り直す
+            await self.channel_layer.room_seed(self.group_name, location_buffer.snapshot(self.session_pk) or [])
+        self.emitted += 1
+        metrics.group_sends.inc('location_broadcast')
+        await self.channel_layer.room_delta(self.group_name, changes)
+        if self.cell_size:
+            await self._emit_cells(participant_ids)
+
+    async def _emit_cells(self, participant_ids):
+        """表示範囲を購読している接続に、セルごとの差分を送る"""
+        cells = location_buffer.cell_deltas(self.session_pk, participant_ids, self.cell_size) or {}
+        # 移動元と移動先の両方のセルを購読している接続で参加者が消えないよう、removedを全て先に送る
+        for key in ('removed', 'updated'):
+            for cell, changes in cells.items():
+                if not changes[key]:
+                    continue
+                await metrics.group_send(
+                    self.channel_layer,
+                    cell_group_name(self.group_name, cell),
+                    {
+                        'type': 'viewport_broadcast',
+                        'frame': json.dumps({'type': 'viewport_delta', key: changes[key]}),
+                    }
+                )
+
+
+def is_shared(channel_layer):
+    """ルームの状態をワーカー間で共有するチャネルレイヤー（'rooms' 拡張）か"""
+    return 'rooms' in getattr(channel_layer, 'extensions', ())
+
+
+def all_locations_group(group_name):
+    """大規模セッションでルーム全体の差分を受け取る接続のグループ"""
+    return f'{group_name}_all'
+
+
+# (チャネルレイヤー, グループ名) -> RoomBroadcaster（ルームのコンシューマーが参照している間だけ保持）
+_broadcasters = weakref.WeakValueDictionary()
+
+
+def get_room_broadcaster(channel_layer, group_name, session_pk, cell_size=None):
+    key = (channel_layer, group_name)
+    broadcaster = _broadcasters.get(key)
+    if broadcaster is None:
+        broadcaster = RoomBroadcaster(channel_layer, group_name, session_pk, cell_size)
+        _broadcasters[key] = broadcaster
+    return broadcaster
@@ -0,0 +1,439 @@
+# tracker/channel_layer.py
+"""Redisなしで複数のASGIワーカー間のグループを共有するチャネルレイヤー
+
+同一ホスト上のブローカープロセス（manage.py run_channel_broker）とUnixドメインソケットで接続する。
+
+- 各ワーカーは起動ごとに固有のworker_idを持ち、チャネル名に埋め込む（specific.uds-<worker_id>!xxxx）
+- グループのメンバー管理はブローカーが持つ。group_sendはブローカーでワーカーごとに1フレームにまとめて配送し、
+  ワーカー側でローカルのキューに振り分ける
+- メッセージ本体はワーカーで一度だけJSONエンコードし、ブローカーはヘッダーだけを読んでそのまま転送する
+- 自プロセス内のチャネルへのsendはブローカーを経由しない
+
+対応するのはプロセス固有チャネル（コンシューマーが使うもの）のみ。runworker用の通常チャネルには対応しない。
+メッセージはJSONに変換できる値のみ。
+
+ルーム（'rooms' 拡張）: 位置情報の差分のepoch・バージョンとスナップショットはワーカーごとに持つと
+ワーカー間で食い違うため、ブローカーがルーム（グループ）ごとに1つの RoomState を持つ。
+
+- ワーカーはルームに最初の接続が来たときにDBから読んだ参加者を room_seed で送る（既にあれば無視される）
+- 変更は room_delta で参加者ごとの変更したフィールドだけを送り、ブローカーが反映してバージョンを振り、
+  差分フレーム（JSON・コンパクト形式）を一度だけ作ってグループに配送する
+- スナップショット・表示範囲の参加者一覧は room_snapshot でブローカーに問い合わせる
+- グループのメンバーがいなくなったらルームを捨てる（次に作るときはepochが変わる）
+- ブローカーへ再接続した後はルームが残っているとは限らないので、ワーカーは次の差分の前に送り直す（has_room）
+
+フレーム形式: [ヘッダー長(4byte)][本体長(4byte)][ヘッダーJSON][本体JSON]
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import secrets
+import struct
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+
+from . import codec
+from .location_buffer import RoomState, decode_change
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = '/tmp/location_share_channels.sock'
+
+FRAME_HEADER = struct.Struct('!II')
+
+# ブローカーが1ワーカーへの未送信データをこれ以上溜めたら配送を諦める（遅いワーカーに引きずられないため）
+MAX_WORKER_BUFFER = 8 * 1024 * 1024
+
+_worker_re = re.compile(r'\.uds-([0-9a-f]+)!')
+
+
+def socket_path():
+    return getattr(settings, 'CHANNEL_BROKER_SOCKET', DEFAULT_SOCKET_PATH)
+
+
+def worker_of(channel):
+    """チャネル名からworker_idを取り出す（該当しなければNone）"""
+    match = _worker_re.search(channel)
+    return match.group(1) if match else None
+
+
+def encode_frame(header, payload=b''):
+    head = json.dumps(header, separators=(',', ':')).encode()
+    return FRAME_HEADER.pack(len(head), len(payload)) + head + payload
+
+
+async def read_frame(reader):
+    """(header, payload) を返す。接続が閉じたらIncompleteReadError"""
+    head_len, body_len = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    header = json.loads(await reader.readexactly(head_len))
+    payload = await reader.readexactly(body_len) if body_len else b''
+    return header, payload
+
+
+class ChannelBroker:
+    """ワーカー間の中継。グループのメンバーとワーカーの接続だけを持つ"""
+
+    def __init__(self, group_expiry=86400):
+        self.group_expiry = group_expiry
+        self.workers = {}  # worker_id -> StreamWriter
+        self.groups = {}  # group -> {channel: 追加時刻}
+        self.rooms = {}  # group -> RoomState
+        self.frames_in = 0
+        self.frames_out = 0
+        self.dropped = 0
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        # bindした時点で0o660にする（chmodまでの間に他のユーザーから接続されないように）
+        umask = os.umask(0o117)
+        try:
+            server = await asyncio.start_unix_server(self.handle_worker, path=path)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o660)
+        logger.info("Channel broker listening on %s", path)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            header, _ = await read_frame(reader)
+            if header.get('op') != 'hello':
+                return
+            worker_id = header['worker']
+            previous = self.workers.get(worker_id)
+            if previous is not None and previous is not writer:
+                previous.close()
+            self.workers[worker_id] = writer
+            while True:
+                header, payload = await read_frame(reader)
+                self.frames_in += 1
+                self.dispatch(header, payload, worker_id)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Channel broker: worker %s failed", worker_id)
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self.drop_worker_channels(worker_id)
+            writer.close()
+
+    def dispatch(self, header, payload, worker_id=None):
+        op = header['op']
+        if op == 'send':
+            self.deliver(worker_of(header['channel']), [header['channel']], payload)
+        elif op == 'group_send':
+            self.group_send(header['group'], payload)
+        elif op == 'group_add':
+            self.groups.setdefault(header['group'], {})[header['channel']] = time.time()
+        elif op == 'group_discard':
+            members = self.groups.get(header['group'])
+            if members is not None:
+                members.pop(header['channel'], None)
+                if not members:
+                    self.drop_group(header['group'])
+        elif op == 'room_seed':
+            self.room_seed(header['group'], json.loads(payload))
+        elif op == 'room_delta':
+            self.room_delta(header['group'], json.loads(payload))
+        elif op == 'room_snapshot':
+            self.reply(worker_id, header['id'], self.room_snapshot(header['group'], header))
+        elif op == 'flush':
+            self.groups = {}
+            self.rooms = {}
+
+    def drop_group(self, group):
+        del self.groups[group]
+        self.rooms.pop(group, None)
+
+    def group_send(self, group, payload):
+        members = self.groups.get(group)
+        if not members:
+            return
+        deadline = time.time() - self.group_expiry
+        by_worker = {}
+        for channel, added_at in list(members.items()):
+            if added_at < deadline:
+                del members[channel]
+                continue
+            by_worker.setdefault(worker_of(channel), []).append(channel)
+        if not members:
+            self.drop_group(group)
+        for worker_id, channels in by_worker.items():
+            self.deliver(worker_id, channels, payload)
+
+    def deliver(self, worker_id, channels, payload):
+        writer = self.workers.get(worker_id)
+        if writer is None or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > MAX_WORKER_BUFFER:
+            self.dropped += 1
+            return
+        writer.write(encode_frame({'op': 'deliver', 'channels': channels}, payload))
+        self.frames_out += 1
+
+    def drop_worker_channels(self, worker_id):
+        """切断したワーカーのチャネルを全グループから外す"""
+        for group, members in list(self.groups.items()):
+            for channel in [c for c in members if worker_of(c) == worker_id]:
+                del members[channel]
+            if not members:
+                self.drop_group(group)
+
+    def reply(self, worker_id, request_id, result):
+        writer = self.workers.get(worker_id)
+        if writer is None or writer.is_closing():
+            return
+        writer.write(encode_frame({'op': 'reply', 'id': request_id}, json.dumps(result).encode()))
+        self.frames_out += 1
+
+    # ルーム
+
+    def room_seed(self, group, records):
+        """ワーカーがDBから読んだ参加者でルームを作る（既にあれば何もしない）"""
+        if group in self.rooms or group not in self.groups:
+            return
+        self.rooms[group] = RoomState({
+            record['participant_id']: decode_change(record) for record in records
+        })
+
+    def room_delta(self, group, message):
+        """変更を反映してバージョンを進め、差分フレームをグループに配送する"""
+        room = self.rooms.get(group)
+        if room is None:
+            # ルームのメンバーがいない（受け取る接続がない）
+            return
+        participant_ids = []
+        for participant_id, fields in message['changes']:
+            room.apply(participant_id, decode_change(fields))
+            participant_ids.append(participant_id)
+        delta = room.delta(participant_ids)
+        compact = delta.pop('compact')
+        self.group_send(group, json.dumps({
+            'type': 'location_broadcast',
+            'frame': json.dumps({'type': 'location_delta', **delta}),
+            'compact_frame': codec.dumps(compact),
+            # 受け取ったワーカーが自分のメモリ上の状態に反映する（送ったワーカーは反映済み）
+            'origin': message['origin'],
+            'version': delta['version'],
+            'changes': message['changes'],
+        }).encode())
+
+    def room_snapshot(self, group, request):
+        room = self.rooms.get(group)
+        if room is None:
+            return None
+        if request.get('cells') is not None:
+            cells = {tuple(cell) for cell in request['cells']}
+            return room.viewport(cells, request['cell_size'])
+        return room.snapshot_frame(request.get('compact', False))
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """ChannelBrokerを介して同一ホストの複数ワーカーでグループを共有するチャネルレイヤー"""
+
+    extensions = ['groups', 'flush', 'rooms']
+
+    def __init__(self, path=None, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path or socket_path()
+        self.group_expiry = group_expiry
+        self.worker_id = secrets.token_hex(6)
+        self.channels = {}  # channel -> asyncio.Queue[(期限, message)]
+        # 再接続時にブローカーへ再登録するためのローカルな控え
+        self.memberships = {}  # group -> set(channel)
+        # 今の接続でroom_seedを送ったグループ（再接続すると空に戻る）
+        self.seeded = set()
+        self._reader_task = None
+        self._writer = None
+        self._loop = None
+        self._connect_lock = None
+        # room_snapshotの応答待ち（リクエストID -> Future）
+        self._requests = {}
+        self._request_ids = 0
+
+    # 接続管理
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        if self._writer is not None and self._loop is loop and not self._writer.is_closing():
+            return self._writer
+        if self._connect_lock is None or self._loop is not loop:
+            self._connect_lock = asyncio.Lock()
+            self._loop = loop
+            self._writer = None
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                writer.write(encode_frame({'op': 'hello', 'worker': self.worker_id}))
+                self.seeded = set()
+                for group, channels in self.memberships.items():
+                    for channel in channels:
+                        writer.write(encode_frame({'op': 'group_add', 'group': group, 'channel': channel}))
+                self._writer = writer
+                self._reader_task = loop.create_task(self._read_loop(reader, writer))
+        return self._writer
+
+    async def _write(self, header, payload=b''):
+        writer = await self._connection()
+        writer.write(encode_frame(header, payload))
+        await writer.drain()
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                if header['op'] == 'deliver':
+                    message = json.loads(payload)
+                    for channel in header['channels']:
+                        try:
+                            self._put(channel, dict(message))
+                        except ChannelFull:
+                            pass
+                elif header['op'] == 'reply':
+                    future = self._requests.pop(header['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(json.loads(payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("Channel broker connection lost (%s)", self.path)
+        except Exception:
+            logger.exception("Channel layer reader failed")
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            for future in self._requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Channel broker connection lost"))
+            self._requests = {}
+
+    def _queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _put(self, channel, message):
+        try:
+            self._queue(channel).put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        if worker_of(channel) == self.worker_id:
+            self._put(channel, json.loads(json.dumps(message)))
+            return
+        if worker_of(channel) is None:
+            raise NotImplementedError("UnixSocketChannelLayer supports process-specific channels only")
+        await self._write({'op': 'send', 'channel': channel}, json.dumps(message).encode())
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self._connection()
+        queue = self._queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.uds-%s!%s' % (prefix, self.worker_id, secrets.token_hex(6))
+
+    async def flush(self):
+        self.channels = {}
+        self.memberships = {}
+        await self._write({'op': 'flush'})
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.memberships.setdefault(group, set()).add(channel)
+        await self._write({'op': 'group_add', 'group': group, 'channel': channel})
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        channels = self.memberships.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.memberships[group]
+                self.seeded.discard(group)
+        await self._write({'op': 'group_discard', 'group': group, 'channel': channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._write({'op': 'group_send', 'group': group}, json.dumps(message).encode())
+
+    def has_room(self, group):
+        """今の接続でルームの初期状態を送ったか"""
+        return group in self.seeded
+
+    def has_local_members(self, group):
+        """このワーカーにグループのメンバーがいるか"""
+        return bool(self.memberships.get(group))
+
+    # Rooms extension
+
+    async def room_seed(self, group, records):
+        """ルームの初期状態（シリアライズ済みの参加者一覧）を送る。ブローカーにルームがあれば無視される"""
+        self.require_valid_group_name(group)
+        await self._write({'op': 'room_seed', 'group': group}, json.dumps(records).encode())
+        self.seeded.add(group)
+
+    async def room_delta(self, group, changes):
+        """参加者の変更（[[participant_id, フィールド], ...]）を送る。差分はグループ全体に配送される"""
+        self.require_valid_group_name(group)
+        await self._write(
+            {'op': 'room_delta', 'group': group},
+            json.dumps({'origin': self.worker_id, 'changes': changes}).encode()
+        )
+
+    async def room_snapshot(self, group, compact=False, cells=None, cell_size=None, timeout=5.0):
+        """ルームのスナップショットのフレーム（cellsを指定した場合はその範囲の参加者一覧）
+
+        ブローカーにルームがなければNone。
+        """
+        self.require_valid_group_name(group)
+        header = {'op': 'room_snapshot', 'group': group, 'compact': compact}
+        if cells is not None:
+            header.update(cells=sorted(cells), cell_size=cell_size)
+        writer = await self._connection()
+        self._request_ids += 1
+        header['id'] = self._request_ids
+        future = self._requests[header['id']] = asyncio.get_running_loop().create_future()
+        try:
+            writer.write(encode_frame(header))
+            await writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._requests.pop(header['id'], None)
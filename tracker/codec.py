@@ -0,0 +1,57 @@
+# tracker/codec.py
+"""位置情報フレームのコンパクト形式（WebSocketサブプロトコルで選択）
+
+キー名を省いた配列で表現する。参加者IDと名前はルーム単位のインデックス表で一度だけ送る。
+
+    スナップショット: [1, epoch, version, defs, rows]
+    差分:             [2, epoch, version, defs, rows, removed]
+    defs:    [[index, participant_id, participant_name], ...]
+    rows:    [[index, lat*1e6, lon*1e6, accuracy*10, last_updated(epoch ms), flags,
+               altitude*10, heading*10, speed*10], ...]  末尾のnullは省略
+    removed: [index, ...]
+    flags:   bit0 is_background, bit1 is_online, bit2-3 status
+
+対応する復号処理は static/js/location-sharing.js の decodeCompactFrame。
+"""
+import json
+
+COMPACT_SUBPROTOCOL = 'location.compact.v1'
+
+FRAME_SNAPSHOT = 1
+FRAME_DELTA = 2
+
+STATUS_CODES = {'waiting': 0, 'sharing': 1, 'stopped': 2}
+
+COORD_SCALE = 1e6  # 約0.1m
+METRIC_SCALE = 10
+
+
+def _quantize(value, scale):
+    return round(value * scale) if value is not None else None
+
+
+def encode_row(index, record):
+    """参加者レコード（last_updatedはdatetime）を配列に変換"""
+    flags = (
+        (1 if record['is_background'] else 0)
+        | (2 if record['is_online'] else 0)
+        | (STATUS_CODES.get(record['status'], 0) << 2)
+    )
+    row = [
+        index,
+        _quantize(record['latitude'], COORD_SCALE),
+        _quantize(record['longitude'], COORD_SCALE),
+        _quantize(record['accuracy'], METRIC_SCALE),
+        int(record['last_updated'].timestamp() * 1000),
+        flags,
+        _quantize(record['altitude'], METRIC_SCALE),
+        _quantize(record['heading'], METRIC_SCALE),
+        _quantize(record['speed'], METRIC_SCALE),
+    ]
+    while row[-1] is None:
+        row.pop()
+    return row
+
+
+def dumps(frame):
+    return json.dumps(frame, separators=(',', ':'), ensure_ascii=False)
@@ -0,0 +1,113 @@
+# tracker/connections.py
+"""参加者ごとのWebSocket接続（タブ）の数
+
+同じ参加者が複数のタブ・複数のワーカーから接続している間は、1つのタブを閉じても
+オフライン化・位置のクリア・ブロードキャストを行わず、最後の接続が閉じたときだけ行う。
+
+- このワーカーの接続はメモリに持つ（他のタブが残っていればDBを見ずに判定できる）
+- 全ワーカーの接続はWebSocketConnectionの行で数え、LocationData.connection_countにも反映する
+- 異常終了したワーカーの行はlast_pingが古くなるので数えない（last_pingはpresenceが更新する）
+"""
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import LocationData, WebSocketConnection
+
+
+class ConnectionRegistry:
+    def __init__(self, stale_after=300.0):
+        self.stale_after = stale_after
+        # (session_pk, participant_id) -> このワーカーのチャネル名の集合
+        self._local = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+        self.last_closed = 0
+
+    def register(self, session_pk, participant_id, channel_name):
+        """接続を登録し、この参加者の接続数を返す"""
+        with self._lock:
+            self._local.setdefault((session_pk, participant_id), set()).add(channel_name)
+            self.opened += 1
+        with transaction.atomic():
+            self._lock_participant(session_pk, participant_id)
+            WebSocketConnection.objects.update_or_create(
+                session_id=session_pk,
+                participant_id=participant_id,
+                channel_name=channel_name,
+                defaults={'is_active': True}
+            )
+            return self._store_count(session_pk, participant_id)
+
+    def unregister(self, session_pk, participant_id, channel_name):
+        """接続を外し、残っている接続数を返す（0なら最後の接続だった）"""
+        key = (session_pk, participant_id)
+        with self._lock:
+            channels = self._local.get(key, set())
+            channels.discard(channel_name)
+            if not channels:
+                self._local.pop(key, None)
+            local_remaining = len(channels)
+            self.closed += 1
+        # 同じ参加者の接続が別のワーカーで同時に閉じても、どちらかが必ず0を数えるよう行をロックする
+        with transaction.atomic():
+            self._lock_participant(session_pk, participant_id)
+            WebSocketConnection.objects.filter(
+                session_id=session_pk,
+                participant_id=participant_id,
+                channel_name=channel_name
+            ).delete()
+            remaining = max(local_remaining, self._store_count(session_pk, participant_id))
+        if not remaining:
+            self.last_closed += 1
+        return remaining
+
+    def has_local_others(self, session_pk, participant_id, channel_name):
+        """このワーカーに同じ参加者の別の接続があるか（DBを見ない）"""
+        with self._lock:
+            return bool(self._local.get((session_pk, participant_id), set()) - {channel_name})
+
+    def count_others(self, session_pk, participant_id, channel_name):
+        """全ワーカーで同じ参加者の別の接続がいくつあるか"""
+        return self._active(session_pk, participant_id).exclude(channel_name=channel_name).count()
+
+    def stats(self):
+        return {
+            'participants': len(self._local),
+            'sockets': sum(len(channels) for channels in self._local.values()),
+            'opened': self.opened,
+            'closed': self.closed,
+            # オフライン化とブロードキャストを行った切断（残りは他のタブが残っていたので省いた）
+            'last_closed': self.last_closed,
+        }
+
+    def _active(self, session_pk, participant_id):
+        return WebSocketConnection.objects.filter(
+            session_id=session_pk,
+            participant_id=participant_id,
+            is_active=True,
+            last_ping__gte=timezone.now() - timedelta(seconds=self.stale_after)
+        )
+
+    def _lock_participant(self, session_pk, participant_id):
+        list(LocationData.objects.select_for_update().filter(
+            session_id=session_pk,
+            participant_id=participant_id
+        ).values_list('pk', flat=True))
+
+    def _store_count(self, session_pk, participant_id):
+        count = self._active(session_pk, participant_id).count()
+        LocationData.objects.filter(
+            session_id=session_pk,
+            participant_id=participant_id
+        ).update(connection_count=count)
+        return count
+
+
+connection_registry = ConnectionRegistry(
+    stale_after=getattr(settings, 'CONNECTION_STALE_AFTER', 300.0),
+)
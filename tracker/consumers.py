@@ -1,44 +1,153 @@
 import json
 import logging
+import time
+from urllib.parse import parse_qs
 from datetime import datetime, timedelta
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.utils import timezone
 from .models import LocationSession, LocationData
+from .session_cache import session_cache
+from .location_buffer import location_buffer, CLEARED_LOCATION_FIELDS
+from .broadcaster import get_room_broadcaster, all_locations_group, is_shared
+from .spatial import cells_for_bbox, cell_group_name
+from .fix_filter import fix_filter, haversine, ACCEPT
+from .rate_control import load_monitor, compute_rate_hint, hint_changed
+from .reaper import ensure_reaper
+from .presence import presence
+from .connections import connection_registry
+from .admission import admission, client_ip, CLOSE_SESSION_FULL
+from . import async_db, codec, metrics, protocol, tracing
+from .log import message_log
+from .session_events import session_events
+from .metrics import db_helper
 
 logger = logging.getLogger(__name__)
 
+# 大規模セッション（表示範囲ごとの配信）の設定
+LARGE_SESSION_MIN_PARTICIPANTS = getattr(settings, 'LARGE_SESSION_MIN_PARTICIPANTS', 200)
+LARGE_SESSION_CELL_SIZE = getattr(settings, 'LARGE_SESSION_CELL_SIZE', 0.05)
+LARGE_SESSION_MAX_CELLS = getattr(settings, 'LARGE_SESSION_MAX_CELLS', 400)
+
 class LocationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.session_id = self.scope['url_route']['kwargs']['session_id']
         self.room_group_name = f'location_{self.session_id}'
         self.participant_id = None
+        self.supports_delta = False
+        self.broadcaster = None
+        # 最後に送ったrate_hintと、速度計算用の直前の位置 (lat, lon, 時刻)
+        self.rate_hint = None
+        self.last_fix = None
+        self.speed = None
+        self.counted = False
+        # connection_registryに登録した参加者ID
+        self.registered = None
+        # admissionで接続数を数えているセッションの主キー
+        self.admitted_pk = None
+        # 大規模セッションで購読しているセル（Noneはルーム全体）
+        self.large = False
+        self.viewport_cells = None
+        # コンパクト形式のサブプロトコルが要求されていれば採用（それ以外はJSON）
+        self.compact = codec.COMPACT_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        # 複数ワーカー構成（ルームの差分とスナップショットをチャネルブローカーが持つ）
+        self.shared = is_shared(self.channel_layer)
+        
+        # ワーカーの接続数・接続元の接続頻度（DBを見ない判定を先に行う）
+        code = admission.check_worker(load_monitor.connections, client_ip(self.scope))
+        if code is not None:
+            await self.reject(code)
+            return
         
         # セッションの有効性をチェック
         session_exists = await self.check_session_exists(self.session_id)
         if not session_exists:
             await self.close()
             return
+        
+        # セッションの接続頻度・参加者数（グループに参加する前に判定する）
+        code = await self.admit()
+        if code is not None:
+            await self.reject(code)
+            return
             
         # グループに参加
+        first_local = self.shared and not self.channel_layer.has_local_members(self.room_group_name)
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        if first_local:
+            await self.seed_shared_room()
         
-        await self.accept()
-        logger.info(f"WebSocket connection established for session {self.session_id}")
+        # 大規模セッションでは表示範囲を受け取るまでルーム全体の差分を購読する
+        meta = await self.get_session_meta()
+        self.large = meta is not None and meta.max_participants >= LARGE_SESSION_MIN_PARTICIPANTS
+        if self.large:
+            await self.channel_layer.group_add(all_locations_group(self.room_group_name), self.channel_name)
+        
+        await self.accept(subprotocol=codec.COMPACT_SUBPROTOCOL if self.compact else None)
+        location_buffer.ensure_flusher()
+        ensure_reaper()
+        presence.ensure_started()
+        load_monitor.ensure_started()
+        load_monitor.connections += 1
+        self.counted = True
+        logger.info("WebSocket connection established for session %s", self.session_id)
+        self.log_event(
+            'websocket_connected',
+            ip_address=client_ip(self.scope),
+            user_agent=dict(self.scope.get('headers', ())).get(b'user-agent', b'').decode('latin-1'),
+        )
+
+    async def admit(self):
+        """セッション単位の受け入れ判定。拒否する場合は終了コードを返す"""
+        meta = await self.get_session_meta()
+        session_pk = await self.get_room_pk()
+        if meta is None or session_pk is None:
+            return None
+        # 新しいクライアントは接続URLに参加者IDを付ける（既存の参加者は満員でも再接続できる）
+        participant_id = parse_qs(self.scope.get('query_string', b'').decode('latin-1')).get('participant_id', [None])[0]
+        code = admission.check_session(
+            meta, location_buffer.room_size(session_pk), participant_id,
+            is_member=participant_id is not None and location_buffer.get_record(session_pk, participant_id) is not None
+        )
+        if code is None:
+            self.admitted_pk = session_pk
+        return code
+
+    async def reject(self, code):
+        """終了コードをクライアントに伝えるため、ハンドシェイクを完了してから閉じる"""
+        logger.info("WebSocket connection rejected for session %s (code %s)", self.session_id, code)
+        await self.accept(subprotocol=codec.COMPACT_SUBPROTOCOL if self.compact else None)
+        await self.close(code=code)
 
     async def disconnect(self, close_code):
-        if self.participant_id:
+        if self.counted:
+            load_monitor.connections -= 1
+            self.counted = False
+            self.log_event('websocket_disconnected', additional_data={'code': close_code})
+        if self.admitted_pk is not None:
+            admission.release(self.admitted_pk)
+            self.admitted_pk = None
+        remaining = 0
+        if self.registered:
+            # 同じ参加者の別のタブ（接続）が残っていればオフライン化もブロードキャストもしない
+            remaining = await self.unregister_connection()
+            if remaining:
+                logger.info("Participant %s still has %s open connection(s)", self.participant_id, remaining)
+        if self.participant_id and not remaining:
             # 切断前の参加者情報を取得
             participant_info = await self.get_participant_info(self.participant_id)
             
+            # 書き込み待ちの位置情報をDBへ反映
+            await self.flush_location_buffer()
+            
             # 参加者をオフライン状態に更新（位置情報もクリア）
             await self.update_participant_offline_with_location_clear(self.participant_id)
             
             # 更新された情報を全参加者に即座に送信
-            await self.broadcast_updated_locations()
+            await self.broadcast_updated_locations(self.participant_id, immediate=True)
             
             # 退出通知を送信（自動通知として）
             if participant_info:
@@ -50,12 +159,17 @@ class LocationConsumer(AsyncWebsocketConsumer):
                 )
             
             # 参加者のオフライン状態をグループに通知
-            await self.channel_layer.group_send(
+            await metrics.group_send(
+                self.channel_layer,
                 self.room_group_name,
                 {
                     'type': 'participant_offline',
                     'participant_id': self.participant_id,
-                    'participant_name': await self.get_participant_name(self.participant_id)
+                    'frame': json.dumps({
+                        'type': 'participant_offline',
+                        'participant_id': self.participant_id,
+                        'participant_name': await self.get_participant_name(self.participant_id)
+                    })
                 }
             )
         
@@ -64,51 +178,66 @@ class LocationConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if self.large:
+            for cell in self.viewport_cells or ():
+                await self.channel_layer.group_discard(cell_group_name(self.room_group_name, cell), self.channel_name)
+            await self.channel_layer.group_discard(all_locations_group(self.room_group_name), self.channel_name)
         
-        logger.info(f"WebSocket disconnected for session {self.session_id}, participant {self.participant_id}")
+        logger.info("WebSocket disconnected for session %s, participant %s", self.session_id, self.participant_id)
 
-    async def receive(self, text_data):
-        try:
-            data = json.loads(text_data)
-            message_type = data.get('type')
-            
-            if message_type == 'join':
-                await self.handle_join(data)
-            elif message_type == 'location_update':
-                await self.handle_location_update(data)
-            elif message_type == 'name_update':
-                await self.handle_name_update(data)
-            elif message_type == 'background_status_update':
-                await self.handle_background_status_update(data)
-            elif message_type == 'stop_sharing':
-                await self.handle_stop_sharing(data)
-            elif message_type == 'confirm_stop_sharing':
-                await self.handle_confirm_stop_sharing(data)
-            elif message_type == 'sync_status':
-                await self.handle_sync_status(data)
-            elif message_type == 'offline':
-                await self.handle_offline(data)
-            elif message_type == 'leave':
-                await self.handle_leave(data)
-            elif message_type == 'ping':
-                await self.handle_ping(data)
-            elif message_type == 'notification':
-                await self.handle_notification(data)
-            else:
-                logger.warning(f"Unknown message type: {message_type}")
-                
-        except json.JSONDecodeError:
-            logger.error("Invalid JSON received")
+    # メッセージ種別 -> ハンドラー（入力の検証は protocol.SCHEMAS）
+    HANDLERS = {
+        'join': 'handle_join',
+        'location_update': 'handle_location_update',
+        'name_update': 'handle_name_update',
+        'background_status_update': 'handle_background_status_update',
+        'stop_sharing': 'handle_stop_sharing',
+        'confirm_stop_sharing': 'handle_confirm_stop_sharing',
+        'sync_status': 'handle_sync_status',
+        'offline': 'handle_offline',
+        'leave': 'handle_leave',
+        'ping': 'handle_ping',
+        'notification': 'handle_notification',
+        'resync': 'handle_resync',
+        'viewport': 'handle_viewport',
+    }
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # 不正なフレームはDB・スレッドプールに触れる前に捨てる
+        data, error = protocol.parse(text_data)
+        if error:
+            logger.debug("Rejected message from %s: %s", self.participant_id, error)
             await self.send(text_data=json.dumps({
                 'type': 'error',
-                'message': 'Invalid JSON format'
+                'message': error
             }))
+            return
+        started = time.perf_counter()
+        trace = tracing.begin()
+        try:
+            await getattr(self, self.HANDLERS[data['type']])(data)
         except Exception as e:
-            logger.error(f"Error processing message: {e}")
+            logger.exception("Error processing %s message", data['type'])
+            self.log_event('error', error_message=f"{data['type']}: {e}")
             await self.send(text_data=json.dumps({
                 'type': 'error',
                 'message': 'Internal server error'
             }))
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.ws_handler_seconds.observe(elapsed, data['type'])
+            tracing.finish(trace, self.session_id, data['type'], elapsed)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None or bytes_data is not None:
+            # コンパクト形式（ensure_ascii=False）は日本語の名前がマルチバイトになるのでUTF-8で数える
+            metrics.ws_frames_sent.inc()
+            if text_data is not None:
+                size = len(text_data) if text_data.isascii() else len(text_data.encode())
+            else:
+                size = len(bytes_data)
+            metrics.ws_bytes_sent.inc(amount=size)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
 
     async def handle_join(self, data):
         self.participant_id = data.get('participant_id')
@@ -116,8 +245,26 @@ class LocationConsumer(AsyncWebsocketConsumer):
         is_sharing = data.get('is_sharing', False)
         has_cached_position = data.get('has_cached_position', False)
         initial_status = data.get('initial_status', 'waiting')
+        # location_delta（差分配信）に対応したクライアントか
+        self.supports_delta = bool(data.get('supports_delta', False))
         
-        logger.info(f"Participant {self.participant_id} joining - sharing: {is_sharing}, cached: {has_cached_position}, status: {initial_status}")
+        logger.info("Participant %s joining - sharing: %s, cached: %s, status: %s", self.participant_id, is_sharing, has_cached_position, initial_status)
+        
+        # 接続時に参加者IDを送らないクライアントはここで参加者数の上限を判定する
+        meta = await self.get_session_meta()
+        session_pk = await self.get_room_pk()
+        if meta is not None and session_pk is not None and admission.is_full(
+            meta, location_buffer.room_size(session_pk),
+            location_buffer.get_record(session_pk, self.participant_id) is not None
+        ):
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Session is full'
+            }))
+            self.participant_id = None
+            await self.close(code=CLOSE_SESSION_FULL)
+            return
+        self.log_event('joined')
         
         # 既存参加者かどうかをチェック
         existing_participant = await self.get_participant_info(self.participant_id)
@@ -130,21 +277,29 @@ class LocationConsumer(AsyncWebsocketConsumer):
         else:
             # 初回参加または共有停止中の場合は待機状態
             await self.update_participant_info(self.participant_id, participant_name, is_online=True, status='waiting')
+        await self.mark_seen(self.participant_id)
+        await self.register_connection()
         
         # 新規参加者の場合は通知を送信（他の参加者のローカル通知用）
         if is_new_participant:
             # 即座に現在の状況を送信してクライアント側で新規参加を検出できるようにする
-            await self.broadcast_updated_locations()
+            await self.broadcast_updated_locations(self.participant_id, immediate=True)
         else:
             # 既存参加者の復帰
-            await self.broadcast_updated_locations()
+            await self.broadcast_updated_locations(self.participant_id, immediate=True)
         
-        # 自分にも現在の状況を送信
-        locations = await self.get_all_locations()
-        await self.send(text_data=json.dumps({
-            'type': 'location_update',
-            'locations': locations
-        }))
+        # 自分にも現在の状況を送信（全体のスナップショット）
+        if self.large:
+            await self.send(text_data=json.dumps({
+                'type': 'session_mode',
+                'mode': 'large',
+                'cell_size': LARGE_SESSION_CELL_SIZE,
+            }))
+        # 表示範囲に対応したクライアントも、有効な viewport を受け付けるまではルーム全体を受け取る
+        # （範囲外のbboxで拒否された場合に地図が空のままにならないように）
+        if self.viewport_cells is None:
+            await self.send_location_snapshot()
+        await self.send_rate_hint()
 
     
     async def handle_location_update(self, data):
@@ -160,12 +315,23 @@ class LocationConsumer(AsyncWebsocketConsumer):
             }))
             return
         
-        logger.info(f"Location update from {participant_id} - background: {data.get('is_background', False)}")
+        message_log.log('location_update', "Location update from %s - background: %s", participant_id, data.get('is_background', False))
         
-        # 以前の状態を取得（共有開始検出のため）
-        previous_state = await self.get_participant_sharing_status(participant_id)
+        # 動いていない・あり得ない位置は書き込みもブロードキャストもしない（生存確認のみ更新）
+        session_pk = await self.get_room_pk()
+        await self.mark_seen(participant_id, is_background=bool(data.get('is_background', False)))
+        if session_pk is not None:
+            verdict = fix_filter.check(
+                session_pk, participant_id,
+                data.get('latitude'), data.get('longitude'), data.get('accuracy'),
+                state=(participant_name, bool(data.get('is_background', False)))
+            )
+            if verdict != ACCEPT:
+                location_buffer.touch(session_pk, participant_id)
+                return
         
-        # 位置情報をデータベースに保存（ステータスを'sharing'に更新）
+        # 位置情報を書き込み待ちに登録（ステータスを'sharing'に更新）。DBへはフラッシュ時にまとめてupsertする
+        self.log_event('location_updated', participant_id)
         await self.save_location_data({
             'participant_id': participant_id,
             'participant_name': participant_name,
@@ -181,7 +347,11 @@ class LocationConsumer(AsyncWebsocketConsumer):
         # サーバー側からの自動通知は削除
         
         # 全参加者に即座に位置情報更新を送信
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id)
+        
+        # 移動速度に合わせて送信間隔を指示
+        self.update_speed(data)
+        await self.send_rate_hint()
 
     async def handle_stop_sharing(self, data):
         """位置共有停止を処理（待機状態に戻す）"""
@@ -189,7 +359,7 @@ class LocationConsumer(AsyncWebsocketConsumer):
         participant_name = data.get('participant_name', '')
         is_background = data.get('is_background', False)
         
-        logger.info(f"Stop sharing from {participant_id} - background: {is_background}")
+        logger.info("Stop sharing from %s - background: %s", participant_id, is_background)
         
         # 以前の状態を取得（共有停止検出のため）
         previous_state = await self.get_participant_sharing_status(participant_id)
@@ -201,20 +371,20 @@ class LocationConsumer(AsyncWebsocketConsumer):
         # サーバー側からの自動通知は削除
         
         # 全参加者に即座に更新を送信
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id)
 
     async def handle_confirm_stop_sharing(self, data):
         """バックグラウンドでの共有停止確認"""
         participant_id = data.get('participant_id')
         participant_name = data.get('participant_name', '')
         
-        logger.info(f"Confirm stop sharing from {participant_id} (background)")
+        logger.info("Confirm stop sharing from %s (background)", participant_id)
         
         # 確実に待機状態に更新
         await self.update_participant_to_waiting(participant_id)
         
         # 全参加者に即座に更新を送信
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id)
 
     async def handle_sync_status(self, data):
         """フォアグラウンド復帰時の状態同期"""
@@ -224,7 +394,7 @@ class LocationConsumer(AsyncWebsocketConsumer):
         status = data.get('status', 'waiting')
         is_background = data.get('is_background', False)
         
-        logger.info(f"Status sync from {participant_id} - sharing: {is_sharing}, status: {status}, background: {is_background}")
+        message_log.log('sync_status', "Status sync from %s - sharing: %s, status: %s, background: %s", participant_id, is_sharing, status, is_background)
         
         # 状態を同期
         if is_sharing:
@@ -236,32 +406,32 @@ class LocationConsumer(AsyncWebsocketConsumer):
         await self.update_background_status(participant_id, is_background)
         
         # 全参加者に即座に更新を送信
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id)
 
     async def handle_name_update(self, data):
         participant_id = data.get('participant_id')
         participant_name = data.get('participant_name', '')
         
-        logger.info(f"Name update from {participant_id}: {participant_name}")
+        message_log.log('name_update', "Name update from %s: %s", participant_id, participant_name)
         
         await self.update_participant_info(participant_id, participant_name, is_online=True)
         
         # 全参加者に即座に更新を送信
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id)
 
     async def handle_background_status_update(self, data):
         participant_id = data.get('participant_id')
         is_background = data.get('is_background', False)
-        participant_name = data.get('participant_name', '')
         is_sharing = data.get('is_sharing', False)
         
-        logger.info(f"Background status update from {participant_id} - background: {is_background}, sharing: {is_sharing}")
+        message_log.log('background_status_update', "Background status update from %s - background: %s, sharing: %s", participant_id, is_background, is_sharing)
+        await self.mark_seen(participant_id, is_background=is_background)
         
         # データベースのバックグラウンド状態を更新
         await self.update_background_status(participant_id, is_background)
         
-        # 即座に全参加者に背景状態変更を送信
-        await self.broadcast_background_status_change(participant_id, participant_name, is_background)
+        # 即座に全参加者に背景状態変更を送信（バージョン順を保つためルームのブロードキャスターを通す）
+        await self.broadcast_updated_locations(participant_id, immediate=True)
 
     async def handle_ping(self, data):
         """Pingメッセージの処理"""
@@ -270,8 +440,8 @@ class LocationConsumer(AsyncWebsocketConsumer):
         has_position = data.get('has_position', False)
         
         if participant_id:
-            # 最終更新時刻を更新
-            await self.update_participant_last_seen(participant_id)
+            # 最終受信時刻はメモリ上で更新する（DBへはpresenceがまとめて書き込む）
+            await self.mark_seen(participant_id)
         
         # Pongレスポンスを送信
         await self.send(text_data=json.dumps({
@@ -279,6 +449,8 @@ class LocationConsumer(AsyncWebsocketConsumer):
             'timestamp': data.get('timestamp'),
             'participant_id': participant_id
         }))
+        # ルームの人数や負荷の変化を反映
+        await self.send_rate_hint()
 
     async def handle_notification(self, data):
         """クライアントからの通知メッセージを他の参加者に転送"""
@@ -290,104 +462,222 @@ class LocationConsumer(AsyncWebsocketConsumer):
         exclude_self = data.get('exclude_self', False)
         timestamp = data.get('timestamp', timezone.now().isoformat())
         
-        logger.info(f"Notification from {participant_id}: {message}")
+        message_log.log('notification', "Notification from %s: %s", participant_id, message)
         
-        # 通知を他の参加者に転送
-        await self.channel_layer.group_send(
+        # 通知を他の参加者に転送（送信フレームはここで一度だけエンコード）
+        await metrics.group_send(
+            self.channel_layer,
             self.room_group_name,
             {
                 'type': 'notification_broadcast',
-                'participant_id': participant_id,
-                'participant_name': participant_name,
-                'message': message,
-                'notification_type': notification_type,
-                'icon': icon,
                 'exclude_self': exclude_self,
-                'timestamp': timestamp,
-                'sender_participant_id': participant_id
+                'sender_participant_id': participant_id,
+                'frame': json.dumps({
+                    'type': 'notification',
+                    'participant_id': participant_id,
+                    'participant_name': participant_name,
+                    'message': message,
+                    'notification_type': notification_type,
+                    'icon': icon,
+                    'exclude_self': exclude_self,
+                    'timestamp': timestamp
+                })
             }
         )
 
+    async def handle_resync(self, data):
+        """差分の欠落を検出したクライアントに全体のスナップショットを再送"""
+        await self.send_location_snapshot()
+
+    async def handle_viewport(self, data):
+        """表示範囲（bbox: [south, west, north, east]）の変更。大規模セッションのみ"""
+        if not self.large:
+            return
+        try:
+            cells = cells_for_bbox(data['bbox'], LARGE_SESSION_CELL_SIZE, limit=LARGE_SESSION_MAX_CELLS)
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Invalid viewport from %s: %s", self.participant_id, data.get('bbox'))
+            cells = None
+        await self.set_viewport(cells)
+
+    async def set_viewport(self, cells):
+        """購読するセルを切り替える（cells=Noneでルーム全体）"""
+        old = self.viewport_cells
+        if cells is None:
+            for cell in old or ():
+                await self.channel_layer.group_discard(cell_group_name(self.room_group_name, cell), self.channel_name)
+            if old is not None:
+                await self.channel_layer.group_add(all_locations_group(self.room_group_name), self.channel_name)
+            self.viewport_cells = None
+            await self.send_location_snapshot()
+            return
+        if old is None:
+            await self.channel_layer.group_discard(all_locations_group(self.room_group_name), self.channel_name)
+            old = set()
+        for cell in old - cells:
+            await self.channel_layer.group_discard(cell_group_name(self.room_group_name, cell), self.channel_name)
+        for cell in cells - old:
+            await self.channel_layer.group_add(cell_group_name(self.room_group_name, cell), self.channel_name)
+        self.viewport_cells = cells
+        await self.send(text_data=json.dumps({
+            'type': 'viewport_snapshot',
+            'locations': await self.get_all_locations(cells=cells),
+        }))
+
     async def handle_offline(self, data):
         """完全なオフライン状態を処理"""
         participant_id = data.get('participant_id')
         participant_name = data.get('participant_name', '')
         
-        logger.info(f"Offline notification from {participant_id}")
+        logger.info("Offline notification from %s", participant_id)
+        
+        # タブを閉じる前の通知。他のタブが開いていれば位置をクリアしない
+        if await self.has_other_connections(participant_id):
+            return
         
         # オフライン状態に更新（位置情報をクリア、ステータスを'stopped'に）
         await self.update_participant_offline_with_location_clear(participant_id)
         
         # 全参加者に即座に更新を送信（オフライン状態変化をクライアント側で検出）
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id, immediate=True)
 
     async def handle_leave(self, data):
         participant_id = data.get('participant_id')
         
-        logger.info(f"Leave request from {participant_id}")
+        logger.info("Leave request from %s", participant_id)
+        self.log_event('left', participant_id)
         
         # 完全に退出する場合は非アクティブ状態に設定
         await self.update_participant_inactive(participant_id)
         
         # 全参加者に即座に更新を送信
-        await self.broadcast_updated_locations()
+        await self.broadcast_updated_locations(participant_id, immediate=True)
         
         await self.close()
 
     async def send_auto_notification(self, message, notification_type='info', icon='', exclude_participant=None):
         """システム自動通知を送信"""
-        await self.channel_layer.group_send(
+        await metrics.group_send(
+            self.channel_layer,
             self.room_group_name,
             {
                 'type': 'auto_notification_broadcast',
-                'message': message,
-                'notification_type': notification_type,
-                'icon': icon,
                 'exclude_participant': exclude_participant,
-                'timestamp': timezone.now().isoformat()
+                'frame': json.dumps({
+                    'type': 'notification',
+                    'message': message,
+                    'notification_type': notification_type,
+                    'icon': icon,
+                    'timestamp': timezone.now().isoformat(),
+                    'is_system_notification': True
+                })
             }
         )
 
-    async def broadcast_updated_locations(self):
-        """全参加者に更新された位置情報を即座に送信"""
-        locations = await self.get_all_locations()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'location_broadcast',
-                'locations': locations
-            }
+    @tracing.traced
+    async def broadcast_updated_locations(self, participant_id, immediate=False):
+        """変更のあった参加者の状態を差分として全参加者に送信
+
+        通常はルームごとに一定間隔(tick)でまとめて送信し、参加・退出時はimmediate=Trueで即座に送る。
+        """
+        session_pk = await self.get_room_pk()
+        if session_pk is None:
+            return
+        self.broadcaster = get_room_broadcaster(
+            self.channel_layer, self.room_group_name, session_pk,
+            LARGE_SESSION_CELL_SIZE if self.large else None
         )
+        if immediate:
+            await self.broadcaster.flush_now(participant_id)
+        else:
+            self.broadcaster.mark_dirty(participant_id)
 
-    async def broadcast_background_status_change(self, participant_id, participant_name, is_background):
-        """バックグラウンド状態変更を全参加者に送信"""
-        locations = await self.get_all_locations()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'background_status_change_broadcast',
-                'participant_id': participant_id,
-                'participant_name': participant_name,
-                'is_background': is_background,
-                'locations': locations
-            }
+    def update_speed(self, data):
+        """クライアントの速度（なければ直前の位置との差）から移動速度を更新"""
+        try:
+            latitude, longitude = float(data.get('latitude')), float(data.get('longitude'))
+        except (TypeError, ValueError):
+            return
+        now = time.monotonic()
+        if data.get('speed') is not None:
+            self.speed = float(data['speed'])
+        elif self.last_fix is not None and now > self.last_fix[2]:
+            self.speed = haversine(self.last_fix[0], self.last_fix[1], latitude, longitude) / (now - self.last_fix[2])
+        self.last_fix = (latitude, longitude, now)
+
+    @tracing.traced
+    async def send_rate_hint(self):
+        """送信間隔の指示を計算し、前回から変わっていれば送る"""
+        meta = await self.get_session_meta()
+        if meta is None:
+            return
+        hint = compute_rate_hint(location_buffer.room_size(meta.pk), speed=self.speed, previous=self.rate_hint)
+        if hint_changed(self.rate_hint, hint):
+            self.rate_hint = hint
+            await self.send(text_data=json.dumps(hint))
+
+    @tracing.traced
+    async def mark_seen(self, participant_id, is_background=None):
+        """在席状況を更新し、オフライン扱いだった参加者ならオンラインに戻して通知する"""
+        meta = await self.get_session_meta()
+        if meta is None or not participant_id:
+            return
+        ping_interval = self.rate_hint['ping_interval'] / 1000 if self.rate_hint else None
+        returned = presence.seen(
+            meta.pk, participant_id, self.room_group_name,
+            LARGE_SESSION_CELL_SIZE if self.large else None,
+            is_background=is_background, ping_interval=ping_interval
         )
+        record = location_buffer.get_record(meta.pk, participant_id)
+        if returned or (record is not None and not record['is_online']):
+            location_buffer.apply(meta.pk, participant_id, {'is_online': True})
+            await self.broadcast_updated_locations(participant_id)
+
+    @tracing.traced
+    async def send_location_snapshot(self):
+        """自分だけに全参加者のスナップショットを送信（参加時・再同期時）"""
+        session_pk = await self.get_room_pk()
+        if self.shared and session_pk is not None:
+            frame = await self.get_shared_snapshot(compact=self.compact)
+        else:
+            frame = location_buffer.snapshot_frame(session_pk, compact=self.compact) if session_pk is not None else None
+        if frame is None:
+            frame = json.dumps({'type': 'location_update', 'epoch': None, 'version': 0, 'locations': []})
+        await self.send(text_data=frame)
 
     # グループメッセージハンドラー
+    # 送信側でエンコード済みのフレーム（event['frame']）をそのまま送る
     async def location_broadcast(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'location_update',
-            'locations': event['locations']
-        }))
+        frame = event.get('frame')
+        if event.get('changes') is not None:
+            # ブローカーの差分: 他のワーカーでの変更をこのワーカーのメモリ上の状態に反映する
+            if event['origin'] != self.channel_layer.worker_id:
+                meta = session_cache.peek(self.session_id)
+                if meta is not None:
+                    location_buffer.apply_shared(
+                        meta.pk, event['version'], event['changes'],
+                        LARGE_SESSION_CELL_SIZE if self.large else None
+                    )
+            if self.viewport_cells is not None:
+                # 表示範囲を購読している接続にはセルごとの差分（viewport_broadcast）で届く
+                return
+        if event.get('snapshot') and self.viewport_cells is not None:
+            # HTTP API経由のスナップショット: 表示範囲を購読している接続には範囲内だけ送る
+            await self.send(text_data=json.dumps({
+                'type': 'viewport_snapshot',
+                'locations': await self.get_all_locations(cells=self.viewport_cells),
+            }))
+        elif self.compact:
+            await self.send(text_data=event['compact_frame'])
+        elif self.supports_delta:
+            await self.send(text_data=frame)
+        else:
+            # 差分非対応のクライアントには従来どおり全体を送る
+            await self.send_location_snapshot()
 
-    async def background_status_change_broadcast(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'background_status_change',
-            'participant_id': event['participant_id'],
-            'participant_name': event['participant_name'],
-            'is_background': event['is_background'],
-            'locations': event['locations']
-        }))
+    async def viewport_broadcast(self, event):
+        """購読中のセルの差分（送信側でエンコード済み）"""
+        await self.send(text_data=event['frame'])
 
     async def notification_broadcast(self, event):
         """クライアント発の通知をブロードキャスト"""
@@ -395,29 +685,13 @@ class LocationConsumer(AsyncWebsocketConsumer):
         if event.get('exclude_self') and event.get('sender_participant_id') == self.participant_id:
             return
         
-        await self.send(text_data=json.dumps({
-            'type': 'notification',
-            'participant_id': event['participant_id'],
-            'participant_name': event['participant_name'],
-            'message': event['message'],
-            'notification_type': event['notification_type'],
-            'icon': event['icon'],
-            'exclude_self': event['exclude_self'],
-            'timestamp': event['timestamp']
-        }))
+        await self.send(text_data=event['frame'])
 
     async def auto_notification_broadcast(self, event):
         """システム自動通知をブロードキャスト"""
         # 除外対象の参加者でない場合のみ送信
         if event.get('exclude_participant') != self.participant_id:
-            await self.send(text_data=json.dumps({
-                'type': 'notification',
-                'message': event['message'],
-                'notification_type': event['notification_type'],
-                'icon': event['icon'],
-                'timestamp': event['timestamp'],
-                'is_system_notification': True
-            }))
+            await self.send(text_data=event['frame'])
 
     async def participant_joined(self, event):
         # 自分以外に通知
@@ -431,11 +705,7 @@ class LocationConsumer(AsyncWebsocketConsumer):
     async def participant_offline(self, event):
         # 自分以外に通知
         if event['participant_id'] != self.participant_id:
-            await self.send(text_data=json.dumps({
-                'type': 'participant_offline',
-                'participant_id': event['participant_id'],
-                'participant_name': event['participant_name']
-            }))
+            await self.send(text_data=event['frame'])
 
     async def participant_left(self, event):
         # 自分以外に通知
@@ -447,120 +717,179 @@ class LocationConsumer(AsyncWebsocketConsumer):
             }))
 
     # データベース操作メソッド
-    @database_sync_to_async
-    def check_session_exists(self, session_id):
-        return LocationSession.objects.filter(session_id=session_id).exists()
+    def log_event(self, action, participant_id=None, **fields):
+        """SessionLogにイベントを記録する（キューに入れるだけでDBアクセスなし）"""
+        meta = session_cache.peek(self.session_id)
+        if meta is not None:
+            session_events.record(
+                meta.pk, action, participant_id or self.participant_id,
+                connection_id=self.channel_name, **fields
+            )
 
-    @database_sync_to_async
-    def check_session_valid(self):
-        try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            return timezone.now() < session.expires_at
-        except LocationSession.DoesNotExist:
-            return False
+    @tracing.traced
+    async def get_session_meta(self):
+        """セッションメタデータを取得（キャッシュヒット時はスレッドプールを経由しない）"""
+        meta = session_cache.peek(self.session_id)
+        if meta is None:
+            meta = await db_helper(session_cache.get)(self.session_id)
+        return meta
+
+    def get_session_pk(self):
+        """同期DBヘルパー用: キャッシュからセッションの主キーを取得"""
+        meta = session_cache.get(self.session_id)
+        if meta is None:
+            raise LocationSession.DoesNotExist
+        return meta.pk
+
+    async def check_session_exists(self, session_id):
+        return await self.get_session_meta() is not None
 
-    @database_sync_to_async
-    def get_participant_info(self, participant_id):
+    @tracing.traced
+    async def check_session_valid(self):
+        meta = await self.get_session_meta()
+        return meta is not None and not meta.is_expired()
+
+    async def get_participant_info(self, participant_id):
         """参加者の情報を取得"""
-        try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            location = LocationData.objects.filter(
-                session=session,
-                participant_id=participant_id,
-                is_active=True
-            ).first()
-            
-            if location:
-                return {
-                    'name': location.participant_name,
-                    'status': location.status,
-                    'is_sharing': location.status == 'sharing',
-                    'is_online': location.is_online
-                }
+        meta = await self.get_session_meta()
+        if meta is None:
             return None
-        except LocationSession.DoesNotExist:
+        row = await async_db.get_participant(meta.pk, participant_id)
+        if row is None:
             return None
+        name, status, is_online = row
+        return {
+            'name': name,
+            'status': status,
+            'is_sharing': status == 'sharing',
+            'is_online': is_online
+        }
 
-    @database_sync_to_async
-    def get_participant_sharing_status(self, participant_id):
+    async def get_participant_sharing_status(self, participant_id):
         """参加者の共有状態を取得"""
-        try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            location = LocationData.objects.filter(
-                session=session,
-                participant_id=participant_id,
-                is_active=True
-            ).first()
-            
-            return location and location.status == 'sharing'
-        except LocationSession.DoesNotExist:
-            return False
+        info = await self.get_participant_info(participant_id)
+        return info is not None and info['is_sharing']
+
+    @tracing.traced
+    async def get_room_pk(self):
+        """セッションの主キーを取得し、ルームの状態がメモリになければ読み込む"""
+        meta = await self.get_session_meta()
+        if meta is None:
+            return None
+        if not location_buffer.has_room(meta.pk):
+            await db_helper(location_buffer.load_room)(meta.pk)
+        return meta.pk
+
+    @tracing.traced
+    async def save_location_data(self, data):
+        """位置情報を書き込み待ちバッファに登録（DBへは定期フラッシュでまとめて書き込む）"""
+        session_pk = await self.get_room_pk()
+        if session_pk is None:
+            return
+        location_buffer.put_fix(session_pk, data['participant_id'], {
+            'participant_name': data['participant_name'],
+            'latitude': data['latitude'],
+            'longitude': data['longitude'],
+            'accuracy': data.get('accuracy'),
+            'is_online': data.get('is_online', True),
+            'is_background': data.get('is_background', False),
+            'altitude': data.get('altitude'),
+            'heading': data.get('heading'),
+            'speed': data.get('speed'),
+            'status': data.get('status', 'sharing')
+        })
+
+    @tracing.traced
+    async def get_all_locations(self, cells=None):
+        """ルームの参加者一覧をバッファから取得（未ロード時のみDBを読む）
+
+        cellsを指定した場合はそのセルにいる参加者だけを返す（大規模セッション）。
+        """
+        if cells is not None:
+            session_pk = await self.get_room_pk()
+            if session_pk is None:
+                return []
+            if self.shared:
+                return await self.get_shared_snapshot(cells=cells) or []
+            return location_buffer.viewport_snapshot(session_pk, cells, LARGE_SESSION_CELL_SIZE) or []
+        return (await self.get_versioned_locations())[2]
+
+    @tracing.traced
+    async def get_versioned_locations(self):
+        """(epoch, version, 参加者一覧) を取得"""
+        session_pk = await self.get_room_pk()
+        if session_pk is None:
+            return None, 0, []
+        # is_activeがTrueの参加者のみ（オンライン・オフライン問わず）
+        return location_buffer.versioned_snapshot(session_pk) or (None, 0, [])
+
+    async def seed_shared_room(self):
+        """複数ワーカー構成: このワーカーで最初の接続のとき、DBから読み直したルームをブローカーへ送る"""
+        meta = await self.get_session_meta()
+        if meta is None:
+            return
+        records = await db_helper(location_buffer.load_room)(meta.pk, shared=True)
+        await self.channel_layer.room_seed(self.room_group_name, records)
+
+    @tracing.traced
+    async def get_shared_snapshot(self, compact=False, cells=None):
+        """複数ワーカー構成: スナップショット（cellsを指定した場合はその範囲の参加者一覧）をブローカーから取得"""
+        options = {'cells': cells, 'cell_size': LARGE_SESSION_CELL_SIZE} if cells is not None else {'compact': compact}
+        result = await self.channel_layer.room_snapshot(self.room_group_name, **options)
+        if result is None:
+            # 同じワーカーの別の接続が送るはずの初期状態より先に問い合わせた
+            await self.seed_shared_room()
+            result = await self.channel_layer.room_snapshot(self.room_group_name, **options)
+        return result
 
-    @database_sync_to_async
-    def save_location_data(self, data):
+    async def flush_location_buffer(self):
+        meta = await self.get_session_meta()
+        if meta is not None:
+            await location_buffer.aflush(meta.pk)
+
+    @db_helper
+    def register_connection(self):
+        """この接続を参加者の接続として登録（参加のたびに呼ばれ、参加者IDが変わった場合は付け替える）"""
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            
-            location, _ = LocationData.objects.update_or_create(
-                session=session,
-                participant_id=data['participant_id'],
-                defaults={
-                    'participant_name': data['participant_name'],
-                    'latitude': data['latitude'],
-                    'longitude': data['longitude'],
-                    'accuracy': data.get('accuracy'),
-                    'last_updated': timezone.now(),
-                    'is_active': True,
-                    'is_online': data.get('is_online', True),
-                    'is_background': data.get('is_background', False),
-                    'altitude': data.get('altitude'),
-                    'heading': data.get('heading'),
-                    'speed': data.get('speed'),
-                    'status': data.get('status', 'sharing')
-                }
-            )
-            return location
+            session_pk = self.get_session_pk()
         except LocationSession.DoesNotExist:
-            return None
+            return
+        if self.registered == self.participant_id:
+            return
+        if self.registered:
+            connection_registry.unregister(session_pk, self.registered, self.channel_name)
+        connection_registry.register(session_pk, self.participant_id, self.channel_name)
+        self.registered = self.participant_id
 
-    @database_sync_to_async
-    def get_all_locations(self):
+    @db_helper
+    def unregister_connection(self):
+        """この接続の登録を外し、同じ参加者の残りの接続数を返す"""
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            # is_activeがTrueの参加者のみを取得（オンライン・オフライン問わず）
-            locations = LocationData.objects.filter(
-                session=session,
-                is_active=True
-            ).order_by('-last_updated')
-            
-            return [
-                {
-                    'participant_id': loc.participant_id,
-                    'participant_name': loc.participant_name,
-                    'latitude': float(loc.latitude) if loc.latitude else None,
-                    'longitude': float(loc.longitude) if loc.longitude else None,
-                    'accuracy': float(loc.accuracy) if loc.accuracy else None,
-                    'last_updated': loc.last_updated.isoformat(),
-                    'is_background': loc.is_background,
-                    'is_online': loc.is_online,
-                    'status': loc.status,
-                    'altitude': float(loc.altitude) if loc.altitude else None,
-                    'heading': float(loc.heading) if loc.heading else None,
-                    'speed': float(loc.speed) if loc.speed else None
-                }
-                for loc in locations
-            ]
+            session_pk = self.get_session_pk()
         except LocationSession.DoesNotExist:
-            return []
+            return 0
+        participant_id, self.registered = self.registered, None
+        return connection_registry.unregister(session_pk, participant_id, self.channel_name)
+
+    async def has_other_connections(self, participant_id):
+        """同じ参加者の別の接続があるか（このワーカーにあればDBを見ない）"""
+        meta = await self.get_session_meta()
+        if meta is None or participant_id != self.registered:
+            return False
+        if connection_registry.has_local_others(meta.pk, participant_id, self.channel_name):
+            return True
+        return await db_helper(connection_registry.count_others)(
+            meta.pk, participant_id, self.channel_name
+        ) > 0
 
-    @database_sync_to_async
+    @db_helper
     def update_participant_info(self, participant_id, participant_name, is_online=True, status=None):
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
+            session_pk = self.get_session_pk()
             
             # 既存のレコードを取得または作成
             location, created = LocationData.objects.get_or_create(
-                session=session,
+                session_id=session_pk,
                 participant_id=participant_id,
                 defaults={
                     'participant_name': participant_name,
@@ -580,17 +909,26 @@ class LocationConsumer(AsyncWebsocketConsumer):
                     location.status = status
                 location.last_updated = timezone.now()
                 location.save()
+            
+            location_buffer.apply(session_pk, participant_id, {
+                'participant_name': participant_name,
+                'is_online': is_online,
+                'is_active': True,
+                'status': location.status,
+            })
                 
         except LocationSession.DoesNotExist:
             pass
 
-    @database_sync_to_async
+    @db_helper
     def update_participant_to_waiting(self, participant_id):
         """参加者を待機状態にする（位置情報をクリアしてwaitingステータスに）"""
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
+            session_pk = self.get_session_pk()
+            location_buffer.discard(session_pk, participant_id)
+            fix_filter.forget(session_pk, participant_id)
             LocationData.objects.filter(
-                session=session,
+                session_id=session_pk,
                 participant_id=participant_id
             ).update(
                 is_online=True,  # オンラインは維持
@@ -604,45 +942,29 @@ class LocationConsumer(AsyncWebsocketConsumer):
                 last_updated=timezone.now()
                 # is_activeはTrueのまま維持してリストには残す
             )
+            location_buffer.apply(session_pk, participant_id, {
+                **CLEARED_LOCATION_FIELDS, 'is_online': True, 'status': 'waiting'
+            })
         except LocationSession.DoesNotExist:
             pass
 
-    @database_sync_to_async
-    def update_participant_last_seen(self, participant_id):
-        """参加者の最終確認時刻を更新"""
-        try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            LocationData.objects.filter(
-                session=session,
-                participant_id=participant_id
-            ).update(
-                last_updated=timezone.now(),
-                is_online=True
-            )
-        except LocationSession.DoesNotExist:
-            pass
-
-    @database_sync_to_async
-    def update_background_status(self, participant_id, is_background):
-        try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            LocationData.objects.filter(
-                session=session,
-                participant_id=participant_id
-            ).update(
-                is_background=is_background,
-                last_updated=timezone.now()
-            )
-        except LocationSession.DoesNotExist:
-            pass
+    async def update_background_status(self, participant_id, is_background):
+        meta = await self.get_session_meta()
+        if meta is None:
+            return
+        await async_db.set_background(meta.pk, participant_id, is_background)
+        location_buffer.apply(meta.pk, participant_id, {'is_background': is_background})
 
-    @database_sync_to_async
+    @db_helper
     def update_participant_offline_with_location_clear(self, participant_id):
         """参加者をオフライン状態にし、位置情報をクリアする"""
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
+            session_pk = self.get_session_pk()
+            location_buffer.discard(session_pk, participant_id)
+            fix_filter.forget(session_pk, participant_id)
+            presence.forget(session_pk, participant_id)
             LocationData.objects.filter(
-                session=session,
+                session_id=session_pk,
                 participant_id=participant_id
             ).update(
                 is_online=False,
@@ -656,16 +978,20 @@ class LocationConsumer(AsyncWebsocketConsumer):
                 last_updated=timezone.now()
                 # is_activeはTrueのまま維持してリストには残す
             )
+            location_buffer.apply(session_pk, participant_id, {
+                **CLEARED_LOCATION_FIELDS, 'is_online': False, 'status': 'stopped'
+            })
         except LocationSession.DoesNotExist:
             pass
 
-    @database_sync_to_async
+    @db_helper
     def update_participant_offline(self, participant_id):
         """参加者をオフライン状態にする（リストには残す）"""
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
+            session_pk = self.get_session_pk()
+            presence.forget(session_pk, participant_id)
             LocationData.objects.filter(
-                session=session,
+                session_id=session_pk,
                 participant_id=participant_id
             ).update(
                 is_online=False,
@@ -673,33 +999,33 @@ class LocationConsumer(AsyncWebsocketConsumer):
                 last_updated=timezone.now()
                 # is_activeはTrueのまま維持してリストに残す
             )
+            location_buffer.apply(session_pk, participant_id, {'is_online': False, 'status': 'stopped'})
         except LocationSession.DoesNotExist:
             pass
 
-    @database_sync_to_async
+    @db_helper
     def update_participant_inactive(self, participant_id):
         """参加者を完全に非アクティブ状態にする（リストから削除）"""
         try:
-            session = LocationSession.objects.get(session_id=self.session_id)
+            session_pk = self.get_session_pk()
+            location_buffer.discard(session_pk, participant_id)
+            fix_filter.forget(session_pk, participant_id)
+            presence.forget(session_pk, participant_id)
             LocationData.objects.filter(
-                session=session,
+                session_id=session_pk,
                 participant_id=participant_id
             ).update(
                 is_active=False,
                 is_online=False,
                 status='stopped'
             )
+            location_buffer.apply(session_pk, participant_id, {'is_active': False})
         except LocationSession.DoesNotExist:
             pass
 
-    @database_sync_to_async
-    def get_participant_name(self, participant_id):
-        try:
-            session = LocationSession.objects.get(session_id=self.session_id)
-            location = LocationData.objects.filter(
-                session=session,
-                participant_id=participant_id
-            ).first()
-            return location.participant_name if location else ''
-        except LocationSession.DoesNotExist:
-            return ''
\ No newline at end of file
+    async def get_participant_name(self, participant_id):
+        meta = await self.get_session_meta()
+        if meta is None:
+            return ''
+        row = await async_db.get_participant(meta.pk, participant_id, active_only=False)
+        return row[0] if row else ''
@@ -0,0 +1,132 @@
+# tracker/fix_filter.py
+"""受信した位置のサーバー側フィルタ（不感帯・外れ値）
+
+クライアントの shouldSendUpdate を通らない古いクライアントやHTTP API、バックグラウンド送信の
+細かい揺れで書き込みとブロードキャストが発生しないよう、次の位置を捨てる。
+
+- 不感帯: 前回採用した位置からの移動が精度（誤差半径）以内
+- 外れ値: 前回採用した位置からの移動速度があり得ない値
+- 不正な値: 緯度・経度・精度が有限の数値でない
+
+捨てた場合も呼び出し側で生存確認（last_updated）だけは更新する。
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+ACCEPT = 'accept'
+DEADBAND = 'deadband'
+OUTLIER = 'outlier'
+INVALID = 'invalid'
+
+EARTH_RADIUS = 6371000.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """2点間の距離（メートル）"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _is_number(value):
+    # boolはintのサブクラスなので除く（protocol.number と同じ判定）
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class FixFilter:
+    """参加者ごとに最後に採用した位置と比較して、新しい位置を採用するか判定する"""
+
+    def __init__(self, min_distance=5.0, accuracy_factor=1.0, max_speed=80.0,
+                 keepalive=30.0, max_outliers=3, maxsize=100000):
+        self.min_distance = min_distance
+        self.accuracy_factor = accuracy_factor
+        self.max_speed = max_speed
+        self.keepalive = keepalive
+        self.max_outliers = max_outliers
+        self.maxsize = maxsize
+        # (session_pk, participant_id) -> [lat, lon, accuracy, 採用時刻, 状態, 連続外れ値数]
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.suppressed = {DEADBAND: 0, OUTLIER: 0, INVALID: 0}
+
+    def check(self, session_pk, participant_id, latitude, longitude, accuracy=None, state=None, now=None):
+        """ACCEPT / DEADBAND / OUTLIER / INVALID を返す
+
+        stateには位置以外にブロードキャストすべき状態（バックグラウンド、名前など）を渡す。
+        前回から変わっていれば移動量に関係なく採用する。
+        """
+        if not (_is_number(latitude) and _is_number(longitude) and (accuracy is None or _is_number(accuracy))):
+            # 数値でない位置は比較も保存もできない（codecの量子化で失敗する）
+            with self._lock:
+                self.suppressed[INVALID] += 1
+            return INVALID
+        latitude, longitude = float(latitude), float(longitude)
+        accuracy = float(accuracy) if accuracy is not None else None
+        now = time.monotonic() if now is None else now
+        key = (session_pk, participant_id)
+        with self._lock:
+            last = self._last.get(key)
+            verdict = self._judge(last, latitude, longitude, accuracy, state, now)
+            if verdict == ACCEPT:
+                self._last[key] = [latitude, longitude, accuracy, now, state, 0]
+                self._last.move_to_end(key)
+                while len(self._last) > self.maxsize:
+                    self._last.popitem(last=False)
+                self.accepted += 1
+            else:
+                if verdict == OUTLIER:
+                    last[5] += 1
+                self.suppressed[verdict] += 1
+            return verdict
+
+    def _judge(self, last, latitude, longitude, accuracy, state, now):
+        if last is None:
+            return ACCEPT
+        last_lat, last_lon, last_accuracy, last_time, last_state, outliers = last
+        if state != last_state or now - last_time >= self.keepalive:
+            return ACCEPT
+        distance = haversine(last_lat, last_lon, latitude, longitude)
+        elapsed = now - last_time
+        # 精度の分だけは実際の移動がなくても動き得るので速度の判定から除く
+        error = max(accuracy or 0.0, last_accuracy or 0.0)
+        if elapsed > 0 and (distance - error) / elapsed > self.max_speed:
+            # 連続して外れる場合は本当に移動した（トンネルを抜けた等）とみなして採用する
+            return ACCEPT if outliers + 1 >= self.max_outliers else OUTLIER
+        if distance < max(self.min_distance, self.accuracy_factor * error):
+            # 精度が大きく改善した位置は採用する
+            if accuracy is not None and last_accuracy is not None and accuracy < last_accuracy / 2:
+                return ACCEPT
+            return DEADBAND
+        return ACCEPT
+
+    def forget(self, session_pk, participant_id):
+        """位置をクリアした参加者の比較対象を消す（次の位置は必ず採用）"""
+        with self._lock:
+            self._last.pop((session_pk, participant_id), None)
+
+    def stats(self):
+        return {
+            'accepted': self.accepted,
+            'suppressed_deadband': self.suppressed[DEADBAND],
+            'suppressed_outlier': self.suppressed[OUTLIER],
+            'suppressed_invalid': self.suppressed[INVALID],
+            # 捨てた位置1件につき、書き込みとブロードキャストを1回ずつ省いている
+            'writes_suppressed': self.suppressed[DEADBAND] + self.suppressed[OUTLIER],
+            'broadcasts_suppressed': self.suppressed[DEADBAND] + self.suppressed[OUTLIER],
+        }
+
+
+fix_filter = FixFilter(
+    min_distance=getattr(settings, 'LOCATION_FILTER_MIN_DISTANCE', 5.0),
+    accuracy_factor=getattr(settings, 'LOCATION_FILTER_ACCURACY_FACTOR', 1.0),
+    max_speed=getattr(settings, 'LOCATION_FILTER_MAX_SPEED', 80.0),
+    keepalive=getattr(settings, 'LOCATION_FILTER_KEEPALIVE', 30.0),
+    max_outliers=getattr(settings, 'LOCATION_FILTER_MAX_OUTLIERS', 3),
+)
@@ -0,0 +1,201 @@
+# tracker/history.py
+"""位置情報履歴（LocationHistory）の書き込みと軌跡の読み出し"""
+import logging
+import re
+import threading
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import LocationHistory, LocationHistoryTier
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TABLE = LocationHistory._meta.db_table
+
+# (ts, latitude, longitude, accuracy, speed, heading)
+TRACK_FIELDS = ('ts', 'latitude', 'longitude', 'accuracy', 'speed', 'heading')
+
+# 間引き済みの軌跡の解像度（秒）。rawはLocationHistoryそのもの
+TIER_RESOLUTIONS = {'10s': 10, '1m': 60}
+TIERS = ['raw', '10s', '1m']  # 細かい順
+
+# ズームレベルの下限 -> 使う解像度（Leafletのズーム）
+ZOOM_TIERS = [(16, 'raw'), (13, '10s'), (0, '1m')]
+
+# 作成済み（または作成を試みた）日付パーティション
+_partitions = set()
+_partitions_lock = threading.Lock()
+
+
+_partition_re = re.compile(rf'{HISTORY_TABLE}_p(\d{{8}})')
+
+
+def partition_name(day):
+    return f'{HISTORY_TABLE}_p{day:%Y%m%d}'
+
+
+def ensure_partition(day):
+    """UTCの1日分のパーティションがなければ作成する"""
+    if day in _partitions:
+        return
+    with _partitions_lock:
+        if day in _partitions:
+            return
+        start = datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                # DDLはパラメータを受け付けないため、自前で作った日時リテラルを埋め込む
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(day)} "
+                    f"PARTITION OF {HISTORY_TABLE} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{(start + timedelta(days=1)).isoformat()}')"
+                )
+        except Exception:
+            # defaultパーティションに同じ範囲の行が既にある場合など。行はdefaultに入るので書き込みは続ける
+            logger.warning("Could not create history partition for %s", day, exc_info=True)
+        _partitions.add(day)
+
+
+def drop_partitions_before(day):
+    """dayより前の日付パーティションを削除し、削除した数を返す"""
+    if connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [HISTORY_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    dropped = 0
+    for name in names:
+        match = _partition_re.fullmatch(name)
+        if match is None:
+            continue
+        partition_day = datetime.strptime(match.group(1), '%Y%m%d').date()
+        if partition_day >= day:
+            continue
+        try:
+            # パーティションの削除は親テーブルのロックを取るので、待たされる場合は諦めて次回にする
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SET LOCAL lock_timeout = '2s'")
+                cursor.execute(f'DROP TABLE IF EXISTS {name}')
+        except Exception:
+            logger.warning("Could not drop history partition %s", name, exc_info=True)
+            continue
+        with _partitions_lock:
+            _partitions.discard(partition_day)
+        dropped += 1
+    return dropped
+
+
+def write_points(points):
+    """履歴をまとめて追記する
+
+    points: [(session_pk, participant_id, fields), ...]  fieldsはTRACK_FIELDSのキーを持つ辞書
+    """
+    if not points:
+        return 0
+    for day in {fields['ts'].astimezone(dt_timezone.utc).date() for _, _, fields in points}:
+        ensure_partition(day)
+    LocationHistory.objects.bulk_create([
+        LocationHistory(session_id=session_pk, participant_id=participant_id, **fields)
+        for session_pk, participant_id, fields in points
+    ])
+    update_tiers(points)
+    return len(points)
+
+
+def update_tiers(points):
+    """追記した点で間引き済みの軌跡を更新する（バケットごとに最後の点を残す）"""
+    latest = {}
+    for session_pk, participant_id, fields in points:
+        epoch = int(fields['ts'].timestamp())
+        for resolution in TIER_RESOLUTIONS.values():
+            # pointsは時刻順なので後の点で上書きすればバケット内の最後の点になる
+            latest[(session_pk, participant_id, resolution, epoch // resolution)] = fields
+    LocationHistoryTier.objects.bulk_create(
+        [
+            LocationHistoryTier(session_id=session_pk, participant_id=participant_id,
+                                resolution=resolution, bucket=bucket, **fields)
+            for (session_pk, participant_id, resolution, bucket), fields in latest.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['session', 'participant_id', 'resolution', 'bucket'],
+        update_fields=list(TRACK_FIELDS),
+    )
+
+
+def track_queryset(session_pk, participant_id, since=None, tier='raw'):
+    if tier == 'raw':
+        queryset = LocationHistory.objects.filter(session_id=session_pk, participant_id=participant_id)
+    else:
+        queryset = LocationHistoryTier.objects.filter(
+            session_id=session_pk, participant_id=participant_id, resolution=TIER_RESOLUTIONS[tier]
+        )
+    if since is not None:
+        queryset = queryset.filter(ts__gt=since)
+    return queryset.order_by('ts')
+
+
+def choose_tier(session_pk, participant_id, since=None, zoom=None, max_points=None):
+    """ズームレベルと点数の上限に合う最も細かい解像度を選ぶ"""
+    candidates = TIERS
+    if zoom is not None:
+        finest = next((tier for min_zoom, tier in ZOOM_TIERS if zoom >= min_zoom), ZOOM_TIERS[-1][1])
+        candidates = TIERS[TIERS.index(finest):]
+    if max_points is None:
+        return candidates[0]
+    for tier in candidates[:-1]:
+        # 上限+1件まで数えれば足りる
+        if track_queryset(session_pk, participant_id, since, tier)[:max_points + 1].count() <= max_points:
+            return tier
+    return candidates[-1]
+
+
+def iter_track(session_pk, participant_id, since=None, tier='raw', chunk_size=2000):
+    """参加者の軌跡を時刻順に返す（サーバーサイドカーソルで少しずつ読む）"""
+    queryset = track_queryset(session_pk, participant_id, since, tier)
+    return queryset.values_list(*TRACK_FIELDS).iterator(chunk_size=chunk_size)
+
+
+async def aiter_track(session_pk, participant_id, since=None, tier='raw', chunk_size=2000):
+    """iter_track の非同期版（ASGIでは同期のイテレーターは全て読んでから送られるため）
+
+    (ts, id) のキーセットで chunk_size 件ずつ読む。
+    """
+    queryset = track_queryset(session_pk, participant_id, since, tier).order_by('ts', 'id')
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(Q(ts__gt=last[0]) | Q(ts=last[0], id__gt=last[1]))
+        rows = await sync_to_async(list)(page.values_list('id', *TRACK_FIELDS)[:chunk_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk_size:
+            return
+        last = (rows[-1][1], rows[-1][0])
+
+
+def pending_after(pending, last_ts, tier='raw'):
+    """DBから読んだ軌跡（最後の点の時刻がlast_ts）に続ける書き込み待ちの点
+
+    間引き済みの解像度ではバケットごとの最後の点にする。DBの最後の点と同じバケットの点は
+    次のフラッシュでその行が更新されるので返さない（1バケット1点を保つ）。
+    """
+    if last_ts is not None:
+        pending = [point for point in pending if point[0] > last_ts]
+    if tier == 'raw':
+        return pending
+    resolution = TIER_RESOLUTIONS[tier]
+    last_bucket = int(last_ts.timestamp()) // resolution if last_ts is not None else None
+    latest = {}
+    for point in pending:
+        bucket = int(point[0].timestamp()) // resolution
+        if bucket != last_bucket:
+            latest[bucket] = point
+    return list(latest.values())
@@ -0,0 +1,686 @@
+# tracker/location_buffer.py
+import asyncio
+import atexit
+import json
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import codec, history
+from .metrics import database_sync
+from .spatial import GridIndex, cell_of
+from .models import LocationData, LocationSession
+
+logger = logging.getLogger(__name__)
+
+# 位置情報をクリアする際にリセットするフィールド
+CLEARED_LOCATION_FIELDS = {
+    'latitude': None,
+    'longitude': None,
+    'accuracy': None,
+    'altitude': None,
+    'heading': None,
+    'speed': None,
+}
+
+# フラッシュ時にLocationDataへ書き込むフィールド
+FLUSH_FIELDS = [
+    'participant_name', 'latitude', 'longitude', 'accuracy',
+    'is_active', 'is_online', 'is_background',
+    'altitude', 'heading', 'speed', 'status', 'last_updated',
+]
+
+
+def _flush_sql(rows):
+    """rows件分のupsert文
+
+    LocationData.last_updated は auto_now なので、bulk_create ではバッファに入った時刻ではなく
+    フラッシュした時刻になる。バッファの時刻をそのまま書き込むためSQLで組み立てる。
+    削除済みのセッションの行はセッションと結合して読み飛ばす（外部キー違反でバッチ全体が失敗しないように）。
+    """
+    # 文字列は長さを付けずにキャストする（varchar(n)へのキャストは長すぎる値を黙って切り詰める）
+    types = [
+        'varchar' if f.get_internal_type() == 'CharField' else f.db_type(connection)
+        for f in (LocationData._meta.get_field(name) for name in FLUSH_FIELDS)
+    ]
+    row = '(%s::integer, %s::varchar, ' + ', '.join(f'%s::{t}' for t in types) + ')'
+    columns = ', '.join(FLUSH_FIELDS)
+    return f"""
+    INSERT INTO {LocationData._meta.db_table} (session_id, participant_id, {columns}, timestamp, connection_count)
+    SELECT v.session_id, v.participant_id, {', '.join(f'v.{name}' for name in FLUSH_FIELDS)}, v.last_updated, 0
+    FROM (VALUES {', '.join([row] * rows)}) AS v (session_id, participant_id, {columns})
+    JOIN {LocationSession._meta.db_table} s ON s.id = v.session_id
+    ON CONFLICT (session_id, participant_id) DO UPDATE SET
+        {', '.join(f'{name} = EXCLUDED.{name}' for name in FLUSH_FIELDS)}
+    """
+
+
+# フラッシュのSQLで各フィールドが無い場合の値
+FLUSH_DEFAULTS = {
+    'participant_name': '', 'is_active': True, 'is_online': True, 'is_background': False, 'status': 'waiting',
+}
+
+
+def _to_float(value):
+    return float(value) if value is not None else None
+
+
+def location_to_record(loc):
+    """LocationDataをブロードキャスト用の辞書に変換（last_updatedはdatetimeのまま）"""
+    return {
+        'participant_id': loc.participant_id,
+        'participant_name': loc.participant_name,
+        'latitude': float(loc.latitude) if loc.latitude else None,
+        'longitude': float(loc.longitude) if loc.longitude else None,
+        'accuracy': float(loc.accuracy) if loc.accuracy else None,
+        'last_updated': loc.last_updated,
+        'is_background': loc.is_background,
+        'is_online': loc.is_online,
+        'status': loc.status,
+        'altitude': float(loc.altitude) if loc.altitude else None,
+        'heading': float(loc.heading) if loc.heading else None,
+        'speed': float(loc.speed) if loc.speed else None,
+    }
+
+
+def new_record(participant_id):
+    """まだDBに行がない参加者のデフォルトレコード"""
+    return {
+        'participant_id': participant_id,
+        'participant_name': '',
+        **CLEARED_LOCATION_FIELDS,
+        'last_updated': timezone.now(),
+        'is_background': False,
+        'is_online': True,
+        'status': 'waiting',
+    }
+
+
+def serialize_record(record):
+    return {**record, 'last_updated': record['last_updated'].isoformat()}
+
+
+def encode_change(fields):
+    """変更したフィールドをJSONに変換できる形にする（複数ワーカー構成でブローカーへ送る）"""
+    if isinstance(fields.get('last_updated'), datetime):
+        return {**fields, 'last_updated': fields['last_updated'].isoformat()}
+    return fields
+
+
+def decode_change(fields):
+    if isinstance(fields.get('last_updated'), str):
+        return {**fields, 'last_updated': datetime.fromisoformat(fields['last_updated'])}
+    return fields
+
+
+class RoomState:
+    """ルーム内のアクティブ参加者とブロードキャストのバージョン
+
+    epochはルームをDBから読み込むたびに変わる。クライアントはepochが変わったら全体を再取得する。
+    複数ワーカー構成ではチャネルブローカーも同じクラスでルームを持ち、差分とスナップショットを作る
+    （tracker/channel_layer.py）。
+    """
+
+    def __init__(self, records, shared=False):
+        self.records = records
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        # 状態が変わるたびに増える（スナップショットフレームのキャッシュ判定用）
+        self.revision = 0
+        # compact -> (キャッシュキー, フレーム)
+        self.frames = {}
+        # コンパクト形式の参加者インデックス表（epochの間は固定）
+        self.indexes = {}
+        # 差分で最後に送った名前（index -> name）。退出した参加者の分は消す
+        self.sent_names = {}
+        # 大規模セッションのグリッド索引（最後にブロードキャストした位置で更新）
+        self.grid = None
+        # 複数ワーカー構成: 次の差分でブローカーへ送るフィールド（participant_id -> set、Noneは全て）
+        self.changed = {} if shared else None
+        # 複数ワーカー構成: 反映済みのブローカーの差分のバージョン
+        self.shared_version = 0
+
+    def index_of(self, participant_id):
+        index = self.indexes.get(participant_id)
+        if index is None:
+            index = self.indexes[participant_id] = len(self.indexes)
+        return index
+
+    def sorted_records(self):
+        return sorted(self.records.values(), key=lambda r: r['last_updated'], reverse=True)
+
+    def apply(self, participant_id, fields, track=True):
+        """参加者の変更を反映する（is_active=Falseで退出）"""
+        self.revision += 1
+        track = track and self.changed is not None
+        if fields.get('is_active') is False:
+            if self.records.pop(participant_id, None) is not None:
+                # 退出後に参加したクライアントのインデックス表にはこの参加者がいないので、
+                # 再参加したときは差分で定義を送り直す
+                self.sent_names.pop(self.indexes.get(participant_id), None)
+            if track:
+                self.changed[participant_id] = None
+            return
+        record = self.records.get(participant_id)
+        if record is None:
+            # 新しい参加者の行を作る変更（参加・位置更新）のみ追加する
+            if not fields.get('is_active'):
+                return
+            record = self.records[participant_id] = new_record(participant_id)
+            if track:
+                self.changed[participant_id] = None
+        elif track and self.changed.get(participant_id, ()) is not None:
+            self.changed.setdefault(participant_id, set()).update(k for k in fields if k in record)
+        record.update((k, v) for k, v in fields.items() if k in record)
+
+    def take_changes(self, participant_ids):
+        """指定した参加者の変更を [[participant_id, フィールド], ...] として取り出す
+
+        退出した参加者は {'is_active': False}、新しい参加者と変更の記録がない参加者は全てのフィールドを送る。
+        """
+        changes = []
+        changed = self.changed if self.changed is not None else {}
+        for participant_id in participant_ids:
+            record = self.records.get(participant_id)
+            if record is None:
+                changed.pop(participant_id, None)
+                changes.append([participant_id, {'is_active': False}])
+                continue
+            keys = changed.pop(participant_id, None) or record.keys()
+            fields = {k: record[k] for k in keys}
+            fields.update(is_active=True, last_updated=record['last_updated'])
+            changes.append([participant_id, encode_change(fields)])
+        return changes
+
+    def snapshot_frame(self, compact=False):
+        """全体スナップショットのフレーム（状態が変わるまで使い回す）"""
+        key = (self.revision, self.version)
+        cached = self.frames.get(compact)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        records = self.sorted_records()
+        if compact:
+            defs, rows = [], []
+            for record in records:
+                index = self.index_of(record['participant_id'])
+                defs.append([index, record['participant_id'], record['participant_name']])
+                rows.append(codec.encode_row(index, record))
+            frame = codec.dumps([codec.FRAME_SNAPSHOT, self.epoch, self.version, defs, rows])
+        else:
+            frame = json.dumps({
+                'type': 'location_update',
+                'epoch': self.epoch,
+                'version': self.version,
+                'locations': [serialize_record(r) for r in records],
+            })
+        self.frames[compact] = (key, frame)
+        return frame
+
+    def delta(self, participant_ids):
+        """指定した参加者の現在の状態を差分として取得し、バージョンを1つ進める"""
+        self.version += 1
+        updated, removed = [], []
+        defs, rows, removed_indexes = [], [], []
+        for participant_id in participant_ids:
+            index = self.index_of(participant_id)
+            record = self.records.get(participant_id)
+            if record is None:
+                removed.append(participant_id)
+                removed_indexes.append(index)
+                continue
+            updated.append(serialize_record(record))
+            # 名前が変わったとき（初回・再参加を含む）だけインデックス表の定義を送る
+            if self.sent_names.get(index) != record['participant_name']:
+                self.sent_names[index] = record['participant_name']
+                defs.append([index, participant_id, record['participant_name']])
+            rows.append(codec.encode_row(index, record))
+        return {
+            'epoch': self.epoch,
+            'version': self.version,
+            'updated': updated,
+            'removed': removed,
+            'compact': [codec.FRAME_DELTA, self.epoch, self.version, defs, rows, removed_indexes],
+        }
+
+    def viewport(self, cells, cell_size):
+        """指定したセルにいる参加者の一覧（last_updated降順、グリッド索引を使わずに数える）"""
+        return [
+            serialize_record(record) for record in self.sorted_records()
+            if cell_of(record['latitude'], record['longitude'], cell_size) in cells
+        ]
+
+
+class LocationBuffer:
+    """位置情報のライトビハインドバッファ
+
+    - 参加者ごとの最新の位置（未書き込み分）だけを保持し、一定間隔でまとめてupsertする
+    - ルームごとのアクティブ参加者のスナップショットをメモリ上に保持し、
+      ブロードキャストはDBを読まずにここから返す
+    """
+
+    def __init__(self, flush_interval=2.0, batch_size=500, max_rooms=1000, max_history=100000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_rooms = max_rooms
+        self.max_history = max_history
+        # (session_pk, participant_id) -> 書き込み待ちのフィールド
+        self._pending = {}
+        # 書き込み待ちの履歴（位置をまとめずに全件追記する）
+        self._history = []
+        # 書き込み中の履歴（軌跡APIがDBにも書き込み待ちにもない点を取りこぼさないように）
+        self._flushing_history = []
+        # session_pk -> RoomState（is_active=Trueの参加者のみ）
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        # フラッシュ中に位置クリアが追い越さないようにするためのロック
+        self._flush_lock = threading.Lock()
+        self._flusher_task = None
+        self.flushed_rows = 0
+        # 削除済みのセッション・書き込めない値のため捨てた行
+        self.dropped_rows = 0
+        self.coalesced_fixes = 0
+        self.history_rows = 0
+        self.history_dropped = 0
+
+    # --- ルームスナップショット ---
+
+    def snapshot(self, session_pk):
+        """ルームの参加者一覧（last_updated降順）。未ロードならNone"""
+        result = self.versioned_snapshot(session_pk)
+        return None if result is None else result[2]
+
+    def versioned_snapshot(self, session_pk):
+        """(epoch, version, 参加者一覧) を取得。未ロードならNone"""
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None:
+                return None
+            self._rooms.move_to_end(session_pk)
+            return room.epoch, room.version, [serialize_record(r) for r in room.sorted_records()]
+
+    def snapshot_frame(self, session_pk, compact=False):
+        """全体スナップショットのフレーム（状態が変わるまで使い回す）
+
+        compact=Trueの場合はcodecのコンパクト形式、それ以外はlocation_updateのJSON。
+        """
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None:
+                return None
+            return room.snapshot_frame(compact)
+
+    def delta(self, session_pk, participant_ids):
+        """指定した参加者の現在の状態を差分として取得し、バージョンを1つ進める
+
+        ルームにいない参加者は removed に入る。'compact' にはコンパクト形式の差分フレーム
+        （codec参照）を入れて返す。未ロードならNone。
+        """
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None:
+                return None
+            return room.delta(participant_ids)
+
+    def take_changes(self, session_pk, participant_ids):
+        """複数ワーカー構成: ブローカーへ送る変更を取り出す（RoomState.take_changes）。未ロードならNone"""
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None:
+                return None
+            return room.take_changes(participant_ids)
+
+    def apply_shared(self, session_pk, version, changes, cell_size=None):
+        """複数ワーカー構成: 他のワーカーからの変更（ブローカーの差分）をメモリ上の状態に反映する
+
+        同じワーカーの各接続が同じ差分を受け取るので、反映済みのバージョンは読み飛ばす。
+        """
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None or version <= room.shared_version:
+                return
+            room.shared_version = version
+            for participant_id, fields in changes:
+                room.apply(participant_id, decode_change(fields), track=False)
+                if room.grid is not None and cell_size == room.grid.cell_size:
+                    record = room.records.get(participant_id)
+                    room.grid.move(
+                        participant_id,
+                        cell_of(record['latitude'], record['longitude'], cell_size) if record else None
+                    )
+
+    def _grid(self, room, cell_size):
+        if room.grid is None or room.grid.cell_size != cell_size:
+            room.grid = GridIndex(cell_size)
+            for participant_id, record in room.records.items():
+                room.grid.move(participant_id, cell_of(record['latitude'], record['longitude'], cell_size))
+        return room.grid
+
+    def cell_deltas(self, session_pk, participant_ids, cell_size):
+        """指定した参加者の状態をセルごとの差分にまとめ、グリッド索引を更新する
+
+        {cell: {'updated': [...], 'removed': [...]}} を返す。別のセルへ移動した参加者は
+        移動前のセルのremovedに入る。未ロードならNone。
+        """
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None:
+                return None
+            grid = self._grid(room, cell_size)
+            result = {}
+            for participant_id in participant_ids:
+                record = room.records.get(participant_id)
+                cell = cell_of(record['latitude'], record['longitude'], cell_size) if record else None
+                old = grid.move(participant_id, cell)
+                if old is not None and old != cell:
+                    result.setdefault(old, {'updated': [], 'removed': []})['removed'].append(participant_id)
+                if cell is not None:
+                    result.setdefault(cell, {'updated': [], 'removed': []})['updated'].append(serialize_record(record))
+            return result
+
+    def viewport_snapshot(self, session_pk, cells, cell_size):
+        """指定したセルにいる参加者の一覧（last_updated降順）。未ロードならNone"""
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None:
+                return None
+            participant_ids = self._grid(room, cell_size).participants_in(cells)
+            records = [room.records[pid] for pid in participant_ids if pid in room.records]
+            records.sort(key=lambda r: r['last_updated'], reverse=True)
+            return [serialize_record(r) for r in records]
+
+    def has_room(self, session_pk):
+        return session_pk in self._rooms
+
+    def room_size(self, session_pk):
+        room = self._rooms.get(session_pk)
+        return len(room.records) if room is not None else 0
+
+    def get_record(self, session_pk, participant_id):
+        with self._lock:
+            room = self._rooms.get(session_pk)
+            if room is None or participant_id not in room.records:
+                return None
+            return dict(room.records[participant_id])
+
+    def load_room(self, session_pk, shared=False, records=None):
+        """DBからルームを読み込み、未書き込みの位置で上書きしてキャッシュする
+
+        shared=True（複数ワーカー構成でこのワーカーの最初の接続）の場合は、読み込み済みでも
+        読み込み直してブローカーへ送る変更の記録を始める（他のワーカーの変更を取りこぼしているため）。
+        records（participant_id -> レコード）を渡した場合はDBを読まずにそれを使う（upsert_fixの結果など）。
+        """
+        if records is None:
+            records = {
+                loc.participant_id: location_to_record(loc)
+                for loc in LocationData.objects.filter(session_id=session_pk, is_active=True)
+            }
+        with self._lock:
+            # 並行して読み込まれていた場合は先に登録された方を使う
+            if shared or session_pk not in self._rooms:
+                self._merge_pending(session_pk, records)
+                self._rooms[session_pk] = RoomState(records, shared=shared)
+            self._rooms.move_to_end(session_pk)
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        return self.snapshot(session_pk)
+
+    def merge_pending(self, session_pk, records):
+        """DBから読んだレコード（participant_id -> レコード）を未書き込みの位置で上書きする"""
+        with self._lock:
+            self._merge_pending(session_pk, records)
+        return records
+
+    def _merge_pending(self, session_pk, records):
+        for (pk, participant_id), fields in self._pending.items():
+            if pk == session_pk:
+                record = records.setdefault(participant_id, new_record(participant_id))
+                record.update((k, v) for k, v in fields.items() if k in record)
+
+    def invalidate(self, session_pk):
+        with self._lock:
+            self._rooms.pop(session_pk, None)
+
+    def forget_session(self, session_pk):
+        """削除されたセッションの状態と書き込み待ちを捨てる（外部キー違反でフラッシュが失敗し続けないように）"""
+        with self._lock:
+            self._rooms.pop(session_pk, None)
+            for key in [key for key in self._pending if key[0] == session_pk]:
+                del self._pending[key]
+            self._history = [p for p in self._history if p[0] != session_pk]
+
+    # --- 更新 ---
+
+    def put_fix(self, session_pk, participant_id, fields):
+        """位置情報を書き込み待ちとして登録（同じ参加者の古い位置は上書き）"""
+        fields = {
+            **fields,
+            'latitude': _to_float(fields.get('latitude')),
+            'longitude': _to_float(fields.get('longitude')),
+            'accuracy': _to_float(fields.get('accuracy')),
+            'is_active': True,
+            'last_updated': timezone.now(),
+        }
+        key = (session_pk, participant_id)
+        with self._lock:
+            if key in self._pending:
+                self.coalesced_fixes += 1
+                self._pending[key].update(fields)
+            else:
+                self._pending[key] = fields
+            self._apply_to_room(session_pk, participant_id, fields)
+            self._append_history(session_pk, participant_id, fields)
+
+    def record_history(self, session_pk, participant_id, fields):
+        """DBへ直接書き込んだ位置（HTTP API）を履歴の書き込み待ちに追加"""
+        with self._lock:
+            self._append_history(session_pk, participant_id, {
+                'last_updated': timezone.now(),
+                **fields,
+                'latitude': _to_float(fields.get('latitude')),
+                'longitude': _to_float(fields.get('longitude')),
+                'accuracy': _to_float(fields.get('accuracy')),
+            })
+
+    def _append_history(self, session_pk, participant_id, fields):
+        if fields.get('latitude') is None or fields.get('longitude') is None:
+            return
+        self._history.append((session_pk, participant_id, {
+            'ts': fields['last_updated'],
+            'latitude': fields['latitude'],
+            'longitude': fields['longitude'],
+            'accuracy': fields.get('accuracy'),
+            'speed': _to_float(fields.get('speed')),
+            'heading': _to_float(fields.get('heading')),
+        }))
+        # DBが長く書き込めない場合は古いものから捨てる
+        overflow = len(self._history) - self.max_history
+        if overflow > 0:
+            del self._history[:overflow]
+            self.history_dropped += overflow
+
+    def apply(self, session_pk, participant_id, fields):
+        """DBへ直接書き込んだ変更をメモリ上の状態に反映する"""
+        fields = {'last_updated': timezone.now(), **fields}
+        key = (session_pk, participant_id)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].update(fields)
+            self._apply_to_room(session_pk, participant_id, fields)
+
+    def touch(self, session_pk, participant_id):
+        """位置は変えずに最終受信時刻だけ更新する（フィルタで捨てた位置の生存確認用）
+
+        ブロードキャストの対象にしないため、revisionは進めない。
+        """
+        now = timezone.now()
+        with self._lock:
+            pending = self._pending.get((session_pk, participant_id))
+            if pending is not None:
+                pending['last_updated'] = now
+            room = self._rooms.get(session_pk)
+            record = room.records.get(participant_id) if room is not None else None
+            if record is not None:
+                record['last_updated'] = now
+
+    def discard(self, session_pk, participant_id):
+        """書き込み待ちの位置を破棄（位置クリア・退出の前に呼ぶ）
+
+        実行中のフラッシュが終わるまで待つので、呼び出し後のDB更新が古い位置で上書きされない。
+        """
+        with self._flush_lock, self._lock:
+            self._pending.pop((session_pk, participant_id), None)
+
+    def _apply_to_room(self, session_pk, participant_id, fields):
+        room = self._rooms.get(session_pk)
+        if room is not None:
+            room.apply(participant_id, fields)
+
+    def pending_track(self, session_pk, participant_id, since=None):
+        """DBにまだ書き込んでいない（書き込み中を含む）軌跡の点を時刻順に返す（TRACK_FIELDSの順のタプル）"""
+        with self._lock:
+            points = [
+                fields for pk, pid, fields in self._flushing_history + self._history
+                if pk == session_pk and pid == participant_id
+            ]
+        rows = [
+            tuple(fields[name] for name in history.TRACK_FIELDS)
+            for fields in points if since is None or fields['ts'] > since
+        ]
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    # --- フラッシュ ---
+
+    def has_pending(self):
+        return bool(self._pending or self._history)
+
+    def flush(self, session_pk=None):
+        """書き込み待ちの位置をまとめてupsertし、履歴を追記する（同期コンテキストで呼ぶ）"""
+        with self._flush_lock:
+            with self._lock:
+                if session_pk is None:
+                    batch, self._pending = self._pending, {}
+                    points, self._history = self._history, []
+                else:
+                    keys = [key for key in self._pending if key[0] == session_pk]
+                    batch = {key: self._pending.pop(key) for key in keys}
+                    points = [p for p in self._history if p[0] == session_pk]
+                    if points:
+                        self._history = [p for p in self._history if p[0] != session_pk]
+                self._flushing_history = points
+            try:
+                if batch:
+                    try:
+                        self._flush_locations(batch)
+                    except Exception:
+                        with self._lock:
+                            self._history[:0] = points
+                        raise
+                if points:
+                    self._flush_history(points)
+            finally:
+                with self._lock:
+                    self._flushing_history = []
+            return len(batch)
+
+    def _flush_locations(self, batch):
+        items = list(batch.items())
+        try:
+            for start in range(0, len(items), self.batch_size):
+                self._write_locations(items[start:start + self.batch_size])
+        except Exception:
+            # 1行の不正な値でバッチ全体が失敗し続けないよう、1行ずつ書き直す
+            logger.warning("Location flush failed, retrying %d rows one by one", len(items) - start, exc_info=True)
+            self._flush_rows(items[start:])
+
+    def _flush_rows(self, items):
+        retry = {}
+        error = None
+        for key, fields in items:
+            try:
+                self._write_locations([(key, fields)])
+            except (IntegrityError, DataError) as e:
+                # 値そのものが原因なので再試行しても書けない
+                self.dropped_rows += 1
+                logger.error("Dropping unwritable location %s: %s", key, e)
+            except Exception as e:
+                retry[key] = fields
+                error = e
+        if retry:
+            # DBに接続できない等は（より新しい位置が来ていなければ）次回に再試行
+            with self._lock:
+                for key, fields in retry.items():
+                    self._pending.setdefault(key, fields)
+            raise error
+
+    def _write_locations(self, items):
+        defaults = {**FLUSH_DEFAULTS, 'last_updated': timezone.now()}
+        params = []
+        for (pk, participant_id), fields in items:
+            params += [pk, participant_id]
+            params += [fields.get(name, defaults.get(name)) for name in FLUSH_FIELDS]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(_flush_sql(len(items)), params)
+                written = cursor.rowcount
+        self.flushed_rows += written
+        # セッションが削除済みの行は書き込まれない
+        self.dropped_rows += len(items) - written
+
+    def _flush_history(self, points):
+        # 削除済みのセッションの点は外部キー違反で書き込めず、再試行し続けることになるので捨てる
+        live = set(LocationSession.objects.filter(pk__in={p[0] for p in points}).values_list('pk', flat=True))
+        if len(live) < len({p[0] for p in points}):
+            kept = [p for p in points if p[0] in live]
+            self.history_dropped += len(points) - len(kept)
+            points = kept
+        start = 0
+        try:
+            for start in range(0, len(points), self.batch_size):
+                history.write_points(points[start:start + self.batch_size])
+                self.history_rows += len(points[start:start + self.batch_size])
+        except Exception:
+            # 書き込めなかった分を先頭に戻して次回に再試行
+            with self._lock:
+                self._history[:0] = points[start:]
+            raise
+
+    async def aflush(self, session_pk=None):
+        if self.has_pending():
+            await database_sync(self.flush)(session_pk)
+
+    def ensure_flusher(self):
+        """現在のイベントループで定期フラッシュタスクを起動（起動済みなら何もしない）"""
+        task = self._flusher_task
+        if task is not None and not task.done() and not task.get_loop().is_closed():
+            return
+        self._flusher_task = asyncio.get_running_loop().create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.aflush()
+            except Exception:
+                logger.exception("Location buffer flush failed")
+
+    def flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Location buffer flush at shutdown failed")
+
+
+location_buffer = LocationBuffer(
+    flush_interval=getattr(settings, 'LOCATION_FLUSH_INTERVAL', 2.0),
+    batch_size=getattr(settings, 'LOCATION_FLUSH_BATCH_SIZE', 500),
+    max_rooms=getattr(settings, 'LOCATION_BUFFER_MAX_ROOMS', 1000),
+    max_history=getattr(settings, 'LOCATION_HISTORY_MAX_PENDING', 100000),
+)
+atexit.register(location_buffer.flush_at_exit)
@@ -0,0 +1,79 @@
+# tracker/log.py
+"""イベントループを止めないログ出力
+
+BackgroundHandler はレコードをキューに入れるだけで戻り、書式化と書き出し（stderr・ファイル）は
+専用のスレッドで行う。settings.LOGGING のハンドラーに '()' で指定し、target に包むハンドラーの
+クラスを渡す。キューが一杯のときはレコードを捨てる（書き出しが詰まってもワーカーを止めない）。
+
+MessageLog はWebSocketメッセージごとの高頻度なログの出口。WEBSOCKET_MESSAGE_LOG が無効なら
+属性を1つ見るだけで戻り、有効でもメッセージ種別ごとに件数/秒を制限する。
+"""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .admission import RateLimiter
+
+
+class BackgroundHandler(QueueHandler):
+    def __init__(self, target='logging.StreamHandler', maxsize=10000, **kwargs):
+        self.target = import_string(target)(**kwargs)
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def setFormatter(self, fmt):
+        # 書式化は書き出しスレッドで行うので、フォーマッターは包んだハンドラーに設定する
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # QueueHandler.prepare はここで書式化してしまうため、レコードをそのまま渡す
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """キューに残ったレコードを書き出してスレッドを止める"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        self.target.close()
+        super().close()
+
+
+class MessageLog:
+    """メッセージ種別ごとに件数を制限するログ（既定では無効）"""
+
+    def __init__(self, logger, enabled=False, rate=5.0, burst=20):
+        self.logger = logger
+        self.enabled = enabled
+        self.limiter = RateLimiter(rate, burst)
+        self.suppressed = 0
+
+    def log(self, message_type, msg, *args):
+        if not self.enabled:
+            return
+        if not self.limiter.allow(message_type):
+            self.suppressed += 1
+            return
+        self.logger.info(msg, *args)
+
+
+message_log = MessageLog(
+    logging.getLogger('tracker.messages'),
+    enabled=getattr(settings, 'WEBSOCKET_MESSAGE_LOG', False),
+    rate=getattr(settings, 'WEBSOCKET_MESSAGE_LOG_RATE', 5.0),
+    burst=getattr(settings, 'WEBSOCKET_MESSAGE_LOG_BURST', 20),
+)
@@ -0,0 +1,176 @@
+# tracker/mail_queue.py
+"""お問い合わせメールの送信キュー
+
+ビューは enqueue() でメールをキューに入れるだけで戻り、SMTPへの送信は専用のスレッドで行う。
+1件の問い合わせ（管理者宛て・自動返信）は1つのジョブとして、同じSMTP接続で続けて送る。
+
+- 送信に失敗したジョブは retry_delay 秒から倍々に（max_delay 秒まで）間を空けて再送する
+- 送信済みのメールは再送しない（管理者宛ての送信後に自動返信が失敗しても、管理者宛ては1通のまま）
+- max_attempts 回失敗したらログに残して諦める（gave_up）
+- キューが max_size 件を超えたら enqueue() は False を返す（dropped）
+
+キューはプロセスのメモリにあるので、プロセスの再起動をまたいで再送はしない。
+終了時には送信待ちのジョブを1回ずつ送ってみる。
+"""
+import atexit
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class MailJob:
+    __slots__ = ('messages', 'attempts', 'label')
+
+    def __init__(self, messages, label=''):
+        # 未送信のメール（送れたものから取り除く）
+        self.messages = list(messages)
+        self.attempts = 0
+        self.label = label
+
+
+class MailQueue:
+    def __init__(self, max_attempts=5, retry_delay=5.0, max_delay=300.0, max_size=1000):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.max_size = max_size
+        # (送信予定時刻, 連番, ジョブ) のヒープ
+        self._jobs = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        # 送信は1度に1つ（ワーカーと flush() が同じジョブを送らないように）
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed_attempts = 0
+        self.retried = 0
+        self.gave_up = 0
+
+    def enqueue(self, messages, label=''):
+        """メール（EmailMessage のリスト）を1つのジョブとして送信待ちにする"""
+        with self._cond:
+            if len(self._jobs) >= self.max_size:
+                self.dropped += 1
+                return False
+            heapq.heappush(self._jobs, (time.monotonic(), next(self._seq), MailJob(messages, label)))
+            self._cond.notify()
+        self.ensure_started()
+        return True
+
+    # --- 送信 ---
+
+    def ensure_started(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._jobs:
+                        wait = self._jobs[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+            try:
+                self._send_ready()
+            except Exception:
+                logger.exception("Mail queue worker failed")
+
+    def _pop(self, ready_only=True):
+        with self._cond:
+            if not self._jobs or (ready_only and self._jobs[0][0] > time.monotonic()):
+                return None
+            return heapq.heappop(self._jobs)[2]
+
+    def _send_ready(self):
+        with self._send_lock:
+            while True:
+                job = self._pop()
+                if job is None:
+                    return
+                self._attempt(job)
+
+    def flush(self):
+        """送信待ちのジョブを（再送の待ち時間に関係なく）1回ずつ送り、送れたジョブの数を返す"""
+        with self._send_lock:
+            with self._cond:
+                count = len(self._jobs)
+            delivered = 0
+            for _ in range(count):
+                job = self._pop(ready_only=False)
+                if job is None:
+                    break
+                delivered += self._attempt(job)
+            return delivered
+
+    def _attempt(self, job):
+        """ジョブの未送信のメールを1つの接続で送る。全て送れたら True"""
+        job.attempts += 1
+        if job.attempts > 1:
+            self.retried += 1
+        try:
+            with get_connection(fail_silently=False) as connection:
+                while job.messages:
+                    connection.send_messages(job.messages[:1])
+                    job.messages.pop(0)
+                    self.sent += 1
+            return True
+        except Exception as e:
+            self.failed_attempts += 1
+            if job.attempts >= self.max_attempts:
+                self.gave_up += 1
+                logger.error(
+                    'Giving up on mail %s after %d attempts (%d unsent): %s',
+                    job.label, job.attempts, len(job.messages), e, exc_info=True,
+                )
+                return False
+            delay = min(self.max_delay, self.retry_delay * 2 ** (job.attempts - 1))
+            logger.warning(
+                'Failed to send mail %s (attempt %d), retrying in %.0fs: %s',
+                job.label, job.attempts, delay, e,
+            )
+            with self._cond:
+                heapq.heappush(self._jobs, (time.monotonic() + delay, next(self._seq), job))
+                self._cond.notify()
+            return False
+
+    def flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Mail queue flush at shutdown failed")
+
+    def stats(self):
+        return {
+            'queued': len(self._jobs),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed_attempts': self.failed_attempts,
+            'retried': self.retried,
+            'gave_up': self.gave_up,
+        }
+
+
+mail_queue = MailQueue(
+    max_attempts=getattr(settings, 'MAIL_QUEUE_MAX_ATTEMPTS', 5),
+    retry_delay=getattr(settings, 'MAIL_QUEUE_RETRY_DELAY', 5.0),
+    max_delay=getattr(settings, 'MAIL_QUEUE_MAX_RETRY_DELAY', 300.0),
+    max_size=getattr(settings, 'MAIL_QUEUE_MAX_SIZE', 1000),
+)
+atexit.register(mail_queue.flush_at_exit)
@@ -0,0 +1,116 @@
+# tracker/management/commands/bench_broadcast.py
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tracker.consumers import LocationConsumer
+
+
+class BenchConsumer(LocationConsumer):
+    """送信内容を捨てるだけのコンシューマー（ASGI接続なし）"""
+
+    def __init__(self, participant_id):
+        super().__init__()
+        self.participant_id = participant_id
+        self.supports_delta = True
+        self.compact = False
+        self.sent_bytes = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.sent_bytes += len(text_data or bytes_data or '')
+
+    async def legacy_location_broadcast(self, event):
+        """変更前の実装: 受信側ごとにjson.dumpsする"""
+        await self.send(text_data=json.dumps({
+            'type': 'location_delta',
+            **event['delta']
+        }))
+
+
+def make_delta(participants):
+    now = timezone.now().isoformat()
+    return {
+        'epoch': 'bench',
+        'version': 1,
+        'updated': [
+            {
+                'participant_id': f'participant-{i:04d}',
+                'participant_name': f'参加者{i}',
+                'latitude': 35.681236 + i * 1e-4,
+                'longitude': 139.767125 - i * 1e-4,
+                'accuracy': 12.5,
+                'last_updated': now,
+                'is_background': False,
+                'is_online': True,
+                'status': 'sharing',
+                'altitude': None,
+                'heading': 90.0,
+                'speed': 1.2,
+            }
+            for i in range(participants)
+        ],
+        'removed': [],
+    }
+
+
+class Command(BaseCommand):
+    help = '1回のグループブロードキャストあたりのCPU時間を計測（受信側ごとのエンコード vs 送信側で一度だけエンコード）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--receivers', type=int, default=50, help='ルーム内の接続数')
+        parser.add_argument('--participants', type=int, default=50, help='差分に含める参加者数')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(options))
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        for name in ('per_receiver', 'serialize_once'):
+            r = results[name]
+            self.stdout.write(
+                f"{name:15s} cpu/broadcast={r['cpu_us_per_broadcast']:.1f}us "
+                f"bytes/broadcast={r['bytes_per_broadcast']}"
+            )
+        self.stdout.write(f"speedup={results['speedup']:.2f}x")
+
+    async def run(self, options):
+        receivers = [BenchConsumer(f'participant-{i:04d}') for i in range(options['receivers'])]
+        delta = make_delta(options['participants'])
+        iterations = options['iterations']
+
+        async def per_receiver():
+            event = {'type': 'location_broadcast', 'delta': delta}
+            for consumer in receivers:
+                await consumer.legacy_location_broadcast(event)
+
+        async def serialize_once():
+            event = {'type': 'location_broadcast', 'frame': json.dumps({'type': 'location_delta', **delta})}
+            for consumer in receivers:
+                await consumer.location_broadcast(event)
+
+        results = {
+            'receivers': options['receivers'],
+            'participants': options['participants'],
+            'iterations': iterations,
+        }
+        for name, fanout in (('per_receiver', per_receiver), ('serialize_once', serialize_once)):
+            for consumer in receivers:
+                consumer.sent_bytes = 0
+            started = time.process_time()
+            for _ in range(iterations):
+                await fanout()
+            elapsed = time.process_time() - started
+            results[name] = {
+                'cpu_us_per_broadcast': elapsed / iterations * 1e6,
+                'bytes_per_broadcast': sum(c.sent_bytes for c in receivers) // iterations,
+            }
+        results['speedup'] = (
+            results['per_receiver']['cpu_us_per_broadcast']
+            / max(results['serialize_once']['cpu_us_per_broadcast'], 1e-9)
+        )
+        return results
@@ -0,0 +1,103 @@
+# tracker/management/commands/bench_channel_layer.py
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from tracker.channel_layer import ChannelBroker, UnixSocketChannelLayer
+
+
+def run_broker(path):
+    asyncio.run(ChannelBroker().serve(path))
+
+
+async def wait_for_socket(path, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"broker did not start: {path}")
+        await asyncio.sleep(0.01)
+
+
+class Command(BaseCommand):
+    help = 'group_sendの配送レイテンシとスループットを計測（InMemoryChannelLayer vs UnixSocketChannelLayer）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='UnixSocketChannelLayerのワーカー（レイヤーインスタンス）数')
+        parser.add_argument('--receivers', type=int, default=50, help='グループ内のチャネル数（ワーカーに均等に割り当て）')
+        parser.add_argument('--messages', type=int, default=500, help='group_sendの回数')
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+
+    def handle(self, *args, **options):
+        results = {
+            'workers': options['workers'],
+            'receivers': options['receivers'],
+            'messages': options['messages'],
+        }
+        results['inmemory'] = asyncio.run(self.measure([InMemoryChannelLayer(capacity=10000)], options))
+
+        path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+        broker = multiprocessing.Process(target=run_broker, args=(path,), daemon=True)
+        broker.start()
+        try:
+            layers = [UnixSocketChannelLayer(path=path, capacity=10000) for _ in range(options['workers'])]
+            results['unix_socket'] = asyncio.run(self.measure(layers, options, path))
+        finally:
+            broker.terminate()
+            broker.join()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        for name in ('inmemory', 'unix_socket'):
+            r = results[name]
+            self.stdout.write(
+                f"{name:12s} msgs/s={r['messages_per_sec']:.0f} deliveries/s={r['deliveries_per_sec']:.0f} "
+                f"p50={r['p50_ms']:.2f}ms p99={r['p99_ms']:.2f}ms"
+            )
+
+    async def measure(self, layers, options, path=None):
+        if path is not None:
+            await wait_for_socket(path)
+        group = 'bench'
+        channels = []
+        for i in range(options['receivers']):
+            layer = layers[i % len(layers)]
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            channels.append((layer, channel))
+        sender = layers[0]
+        messages = options['messages']
+        frame = json.dumps({'type': 'location_delta', 'epoch': 'bench', 'version': 1, 'updated': [], 'removed': []})
+
+        latencies = []
+
+        async def drain(layer, channel):
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message['sent_at'])
+
+        receivers = [asyncio.create_task(drain(layer, channel)) for layer, channel in channels]
+        # group_addがブローカーに届いてから計測を始める
+        await asyncio.sleep(0.1)
+        started = time.perf_counter()
+        for _ in range(messages):
+            await sender.group_send(group, {'type': 'location_broadcast', 'frame': frame, 'sent_at': time.perf_counter()})
+            await asyncio.sleep(0)
+        await asyncio.wait_for(asyncio.gather(*receivers), timeout=60)
+        elapsed = time.perf_counter() - started
+        for layer in layers:
+            await layer.close()
+
+        latencies.sort()
+        return {
+            'messages_per_sec': messages / elapsed,
+            'deliveries_per_sec': len(latencies) / elapsed,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        }
@@ -0,0 +1,90 @@
+# tracker/management/commands/bench_db_path.py
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from tracker import async_db
+from tracker.models import LocationSession, LocationData
+
+
+def percentile(values, p):
+    return values[max(0, int(len(values) * p) - 1)] * 1000
+
+
+class Command(BaseCommand):
+    help = 'コンシューマーのDBアクセス（参加者の読み出し＋バックグラウンド状態の更新）のレイテンシを計測（スレッドプール vs 非同期プール）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=200, help='セッションの参加者数')
+        parser.add_argument('--concurrency', type=int, default=50, help='同時に処理するメッセージ数')
+        parser.add_argument('--requests', type=int, default=20, help='1並列あたりのメッセージ数')
+        parser.add_argument('--pool-size', type=int, default=10, help='非同期プールの接続数')
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'postgresql':
+            raise CommandError('PostgreSQLでのみ計測できます')
+        session = LocationSession.objects.create(duration_minutes=30, max_participants=options['participants'])
+        LocationData.objects.bulk_create([
+            LocationData(session=session, participant_id=f'bench-{i:05d}', participant_name=f'bench {i}')
+            for i in range(options['participants'])
+        ])
+        settings_dict = connections['default'].settings_dict
+        conn_max_age = settings_dict['CONN_MAX_AGE']
+        results = {key: options[key] for key in ('participants', 'concurrency', 'requests', 'pool_size')}
+        try:
+            # 変更前の設定（CONN_MAX_AGE=0: 呼び出しごとに接続し直す）
+            settings_dict['CONN_MAX_AGE'] = 0
+            results['thread_pool_no_reuse'] = asyncio.run(self.measure(session.pk, options, pooled=False))
+            settings_dict['CONN_MAX_AGE'] = conn_max_age or 60
+            results['thread_pool'] = asyncio.run(self.measure(session.pk, options, pooled=False))
+            async_db.pool.size = options['pool_size']
+            results['async_pool'] = asyncio.run(self.measure(session.pk, options, pooled=True))
+        finally:
+            settings_dict['CONN_MAX_AGE'] = conn_max_age
+            session.delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        for name in ('thread_pool_no_reuse', 'thread_pool', 'async_pool'):
+            r = results[name]
+            self.stdout.write(
+                f"{name:22s} msgs/s={r['messages_per_sec']:.0f} "
+                f"p50={r['p50_ms']:.2f}ms p95={r['p95_ms']:.2f}ms p99={r['p99_ms']:.2f}ms"
+            )
+
+    async def measure(self, session_pk, options, pooled):
+        participants = options['participants']
+        latencies = []
+
+        async def client(index):
+            for n in range(options['requests']):
+                participant_id = f'bench-{(n * options["concurrency"] + index) % participants:05d}'
+                started = time.perf_counter()
+                # handle_background_status_update 相当
+                await async_db.get_participant(session_pk, participant_id, pooled=pooled)
+                await async_db.set_background(session_pk, participant_id, n % 2 == 0, pooled=pooled)
+                latencies.append(time.perf_counter() - started)
+
+        # 接続の確立は計測に含めない
+        await asyncio.gather(*(
+            async_db.get_participant(session_pk, 'bench-00000', pooled=pooled)
+            for _ in range(options['concurrency'])
+        ))
+        started = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(options['concurrency'])))
+        elapsed = time.perf_counter() - started
+        if pooled:
+            await async_db.pool.close()
+
+        latencies.sort()
+        return {
+            'messages_per_sec': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+        }
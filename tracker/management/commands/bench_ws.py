@@ -0,0 +1,369 @@
+# tracker/management/commands/bench_ws.py
+import asyncio
+import json
+import random
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+from location_share.asgi import application
+from tracker import async_db
+from tracker.location_buffer import location_buffer
+from tracker.models import LocationSession
+from tracker.rate_control import load_monitor
+from tracker.session_cache import session_cache
+
+# 位置を含むフレームの種別 -> 参加者レコードの一覧のキー
+LOCATION_FRAMES = {
+    'location_update': 'locations',
+    'location_delta': 'updated',
+    'viewport_delta': 'updated',
+    'viewport_snapshot': 'locations',
+}
+
+
+def percentile(values, p):
+    return values[max(0, int(len(values) * p) - 1)] * 1000 if values else None
+
+
+class QueryCounter:
+    """全スレッドで実行されたSQLを種類（SELECT/INSERT/...）ごとに数える
+
+    非同期プール（async_db）経由のアクセスは取得回数で数える。
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._original = None
+        self._pool_acquired = 0
+
+    def start(self):
+        original = self._original = CursorWrapper._execute_with_wrappers
+        counter = self
+
+        def execute(self, sql, params, many, executor):
+            with counter._lock:
+                counter.counts[sql.lstrip().split(None, 1)[0].upper()] += 1
+            return original(self, sql, params, many, executor)
+
+        CursorWrapper._execute_with_wrappers = execute
+        self._pool_acquired = async_db.pool.acquired
+
+    def stop(self):
+        CursorWrapper._execute_with_wrappers = self._original
+        pooled = async_db.pool.acquired - self._pool_acquired
+        if pooled:
+            self.counts['ASYNC_POOL'] += pooled
+        return dict(self.counts, total=sum(self.counts.values()))
+
+
+class Bench:
+    """シミュレーション全体で共有する計測値"""
+
+    def __init__(self):
+        self.sent = Counter()
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.closed = Counter()
+        # (セッション, 参加者ID, 緯度) -> 送信時刻
+        self.sent_at = {}
+        self.latencies = []
+
+    def reset(self):
+        self.sent.clear()
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.latencies = []
+
+
+class SimulatedParticipant:
+    """1つのWebSocket接続で参加者の操作を再現する（location-sharing.js の既定の送信間隔に従う）"""
+
+    def __init__(self, bench, session_id, index, options, rng):
+        self.bench = bench
+        self.session_id = session_id
+        self.participant_id = f'bench-{index:05d}'
+        self.options = options
+        self.rng = rng
+        self.latitude = 35.681236 + rng.uniform(-0.01, 0.01)
+        self.longitude = 139.767125 + rng.uniform(-0.01, 0.01)
+        self.is_background = False
+        self.update_interval = options['update_interval']
+        self.ping_interval = options['ping_interval']
+        self.connected = False
+        # 参加者ID -> 最後に受け取った緯度（同じ位置の再送をレイテンシに数えない）
+        self.seen = {}
+        self.communicator = WebsocketCommunicator(
+            application, f'/ws/location/{session_id}/?participant_id={self.participant_id}'
+        )
+        self.reader = None
+
+    async def connect(self):
+        connected, code = await self.communicator.connect(timeout=10)
+        if not connected:
+            self.bench.closed[code] += 1
+            return False
+        self.connected = True
+        self.reader = asyncio.ensure_future(self.read())
+        await self.send({
+            'type': 'join',
+            'participant_id': self.participant_id,
+            'participant_name': f'bench {self.participant_id[-5:]}',
+            'is_sharing': True,
+            'initial_status': 'sharing',
+            'supports_delta': True,
+        })
+        return True
+
+    async def send(self, data):
+        if not self.connected:
+            return
+        self.bench.sent[data['type']] += 1
+        await self.communicator.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def read(self):
+        bench = self.bench
+        while True:
+            message = await self.communicator.receive_output(timeout=3600)
+            if message['type'] == 'websocket.close':
+                self.connected = False
+                bench.closed[message.get('code', 1000)] += 1
+                return
+            text = message.get('text')
+            if text is None:
+                continue
+            received = time.perf_counter()
+            bench.received_frames += 1
+            bench.received_bytes += len(text)
+            frame = json.loads(text)
+            frame_type = frame.get('type')
+            if frame_type == 'rate_hint':
+                # 実際のクライアントと同じく、指示された間隔より短くは送らない
+                self.update_interval = max(self.options['update_interval'], frame['min_update_interval'] / 1000)
+                self.ping_interval = max(self.options['ping_interval'], frame['ping_interval'] / 1000)
+                continue
+            key = LOCATION_FRAMES.get(frame_type)
+            if key is None:
+                continue
+            for record in frame.get(key) or ():
+                participant_id = record.get('participant_id')
+                latitude = record.get('latitude')
+                if participant_id == self.participant_id or latitude is None:
+                    continue
+                if self.seen.get(participant_id) == latitude:
+                    continue
+                self.seen[participant_id] = latitude
+                sent = bench.sent_at.get((self.session_id, participant_id, latitude))
+                if sent is not None:
+                    bench.latencies.append(received - sent)
+
+    async def run(self, until):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # 送信のタイミングを参加者ごとにずらす
+        next_update = now + self.rng.uniform(0, self.update_interval)
+        next_ping = now + self.rng.uniform(0, self.ping_interval)
+        next_background = now + self.rng.uniform(0, self.options['background_interval'] * 2)
+        while self.connected:
+            due = min(next_update, next_ping, next_background)
+            if due >= until:
+                return
+            await asyncio.sleep(max(0.0, due - loop.time()))
+            now = loop.time()
+            if now >= next_update:
+                next_update = now + self.update_interval
+                await self.send_location()
+            if now >= next_ping:
+                next_ping = now + self.ping_interval
+                await self.send({
+                    'type': 'ping',
+                    'participant_id': self.participant_id,
+                    'timestamp': int(time.time() * 1000),
+                    'is_sharing': True,
+                    'has_position': True,
+                })
+            if now >= next_background:
+                next_background = now + self.options['background_interval']
+                self.is_background = not self.is_background
+                await self.send({
+                    'type': 'background_status_update',
+                    'participant_id': self.participant_id,
+                    'is_background': self.is_background,
+                    'is_sharing': True,
+                    'has_position': True,
+                })
+
+    async def send_location(self):
+        # 位置フィルタの不感帯（5m）を超えるよう、1回に約11m動かす
+        self.latitude = round(self.latitude + self.rng.choice((-1e-4, 1e-4)), 7)
+        self.longitude = round(self.longitude + self.rng.uniform(-1e-4, 1e-4), 7)
+        self.bench.sent_at[(self.session_id, self.participant_id, self.latitude)] = time.perf_counter()
+        await self.send({
+            'type': 'location_update',
+            'participant_id': self.participant_id,
+            'participant_name': f'bench {self.participant_id[-5:]}',
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'accuracy': 5,
+            'speed': 3.5,
+            'is_background': self.is_background,
+        })
+
+    async def close(self):
+        if self.connected:
+            self.connected = False
+            await self.communicator.disconnect(timeout=5)
+        if self.reader is not None:
+            self.reader.cancel()
+
+
+class Command(BaseCommand):
+    help = 'WebSocketの負荷試験（N セッション × M 参加者をプロセス内のASGIアプリに接続し、スループット・配信レイテンシ・DBクエリ数・接続あたりのメモリを計測）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=10, help='セッション数')
+        parser.add_argument('--participants', type=int, default=20, help='1セッションあたりの参加者数')
+        parser.add_argument('--duration', type=float, default=30.0, help='計測時間（秒）')
+        parser.add_argument('--update-interval', type=float, default=3.0, help='位置の送信間隔（秒）。rate_hintでさらに延びる')
+        parser.add_argument('--ping-interval', type=float, default=15.0, help='pingの間隔（秒）')
+        parser.add_argument('--background-interval', type=float, default=60.0,
+                            help='フォアグラウンド/バックグラウンドを切り替える間隔（秒）')
+        parser.add_argument('--connect-concurrency', type=int, default=50, help='同時に接続する数')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+        parser.add_argument('--output', help='結果のJSONを書き出すファイル（バージョン間の比較用）')
+
+    def handle(self, *args, **options):
+        sessions = [
+            LocationSession.objects.create(duration_minutes=60, max_participants=options['participants'])
+            for _ in range(options['sessions'])
+        ]
+        try:
+            results = asyncio.run(self.run([str(s.session_id) for s in sessions], options))
+        finally:
+            for session in sessions:
+                location_buffer.forget_session(session.pk)
+                session_cache.invalidate(session.session_id)
+                session.delete()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if options['json']:
+            self.stdout.write(json.dumps(results, sort_keys=True))
+            return
+        latency = results['broadcast_latency_ms']
+        self.stdout.write(
+            f"connections={results['connections']['opened']} rejected={sum(results['connections']['closed_by_server'].values())} "
+            f"memory/conn={results['memory']['python_bytes_per_connection'] / 1024:.1f}KiB"
+        )
+        self.stdout.write(
+            f"sent/s={results['throughput']['messages_sent_per_sec']:.0f} "
+            f"frames/s={results['throughput']['frames_received_per_sec']:.0f} "
+            f"bytes/s={results['throughput']['bytes_received_per_sec']:.0f}"
+        )
+        if latency['count']:
+            self.stdout.write(
+                f"broadcast latency p50={latency['p50']:.1f}ms p95={latency['p95']:.1f}ms "
+                f"p99={latency['p99']:.1f}ms max={latency['max']:.1f}ms (n={latency['count']})"
+            )
+        self.stdout.write(
+            f"db queries connect={results['db_queries']['connect']['total']} "
+            f"steady={results['db_queries']['steady']['total']} "
+            f"per message={results['db_queries']['per_message']:.3f}"
+        )
+
+    async def run(self, session_ids, options):
+        bench = Bench()
+        rng = random.Random(options['seed'])
+        participants = [
+            SimulatedParticipant(bench, session_id, index, options, rng)
+            for session_id in session_ids
+            for index in range(options['participants'])
+        ]
+        queries = QueryCounter()
+
+        # 接続・参加（接続あたりのメモリはここで計測。クライアント側のオブジェクトも含む）
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        queries.start()
+        slots = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(participant):
+            async with slots:
+                return await participant.connect()
+
+        started = time.perf_counter()
+        opened = sum(await asyncio.gather(*(connect(p) for p in participants)))
+        await asyncio.sleep(1.0)
+        connect_seconds = time.perf_counter() - started
+        memory_after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        connect_queries = queries.stop()
+        connect_sent = dict(bench.sent)
+
+        # 定常状態
+        bench.reset()
+        queries = QueryCounter()
+        queries.start()
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        until = loop.time() + options['duration']
+        await asyncio.gather(*(p.run(until) for p in participants))
+        # 最後に送った位置の配信を待つ
+        await asyncio.sleep(1.0)
+        elapsed = time.perf_counter() - started
+        steady_queries = queries.stop()
+        lag = load_monitor.lag
+
+        await asyncio.gather(*(p.close() for p in participants))
+        await location_buffer.aflush()
+        await async_db.pool.close()
+        await database_sync_to_async(connections.close_all)()
+
+        latencies = sorted(bench.latencies)
+        sent_total = sum(bench.sent.values())
+        return {
+            'config': {
+                key: options[key] for key in (
+                    'sessions', 'participants', 'duration', 'update_interval',
+                    'ping_interval', 'background_interval', 'seed',
+                )
+            },
+            'connections': {
+                'attempted': len(participants),
+                'opened': opened,
+                'connect_seconds': connect_seconds,
+                'closed_by_server': {str(code): n for code, n in bench.closed.items()},
+            },
+            'messages_sent': {'connect': connect_sent, 'steady': dict(bench.sent)},
+            'throughput': {
+                'messages_sent_per_sec': sent_total / elapsed,
+                'frames_received_per_sec': bench.received_frames / elapsed,
+                'bytes_received_per_sec': bench.received_bytes / elapsed,
+            },
+            'broadcast_latency_ms': {
+                'count': len(latencies),
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1] * 1000 if latencies else None,
+            },
+            'db_queries': {
+                'connect': connect_queries,
+                'steady': steady_queries,
+                'per_message': steady_queries['total'] / max(sent_total, 1),
+            },
+            'memory': {
+                'python_bytes_per_connection': (memory_after - memory_before) / max(opened, 1),
+            },
+            'event_loop_lag_ms': lag * 1000,
+        }
@@ -0,0 +1,41 @@
+# tracker/management/commands/reap_sessions.py
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from tracker.reaper import make_reaper
+
+
+class Command(BaseCommand):
+    help = '期限切れセッションと関連する行をバッチで削除（--archive-dirを指定すると先にアーカイブ）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='1バッチのセッション数')
+        parser.add_argument('--grace-minutes', type=int, default=None, help='期限切れからこの分数を過ぎたセッションのみ削除')
+        parser.add_argument('--archive-dir', default=None, help='削除前にJSON Lines（gzip）で書き出すディレクトリ')
+        parser.add_argument('--max-batches', type=int, default=None, help='処理するバッチ数の上限')
+        parser.add_argument('--pause', type=float, default=0.05, help='バッチ間の待ち時間（秒）')
+        parser.add_argument('--dry-run', action='store_true', help='削除せずに対象のセッション数だけ数える')
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+
+    def handle(self, *args, **options):
+        overrides = {'pause': options['pause']}
+        if options['batch_size'] is not None:
+            overrides['batch_size'] = options['batch_size']
+        if options['grace_minutes'] is not None:
+            overrides['grace'] = timedelta(minutes=options['grace_minutes'])
+        if options['archive_dir'] is not None:
+            overrides['archive_dir'] = options['archive_dir']
+        stats = make_reaper(**overrides).run(max_batches=options['max_batches'], dry_run=options['dry_run'])
+        if options['json']:
+            self.stdout.write(json.dumps(stats))
+            return
+        if stats['skipped']:
+            self.stdout.write('別のプロセスで実行中のためスキップしました')
+            return
+        self.stdout.write(
+            f"sessions={stats['sessions']} rows={stats['rows']} batches={stats['batches']} "
+            f"archived={stats['archived']} partitions_dropped={stats['partitions_dropped']} "
+            f"elapsed={stats['elapsed']:.2f}s rows/sec={stats['rows_per_sec']:.0f}"
+        )
@@ -0,0 +1,22 @@
+# tracker/management/commands/run_channel_broker.py
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from tracker.channel_layer import ChannelBroker, socket_path
+
+
+class Command(BaseCommand):
+    help = 'UnixSocketChannelLayer用のブローカーを起動（同一ホストの複数ASGIワーカーでグループを共有）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=None, help='Unixソケットのパス（既定: settings.CHANNEL_BROKER_SOCKET）')
+        parser.add_argument('--group-expiry', type=int, default=86400, help='グループ登録の有効期限（秒）')
+
+    def handle(self, *args, **options):
+        path = options['socket'] or socket_path()
+        self.stdout.write(f"Channel broker listening on {path}")
+        try:
+            asyncio.run(ChannelBroker(group_expiry=options['group_expiry']).serve(path))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,270 @@
+# tracker/metrics.py
+"""Prometheusのテキスト形式で公開するプロセス内のメトリクス
+
+カウンターとヒストグラムはワーカーのメモリで集計する（ラベルの組ごとに値を持ち、更新は
+ロックを1回取るだけ）。/metrics ではこれらに加えて、各モジュールの stats()（/api/stats/ と
+同じ値）をゲージとして出力する。値はワーカーごとなので、Prometheus側でワーカーを区別して集計する。
+"""
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from channels.db import database_sync_to_async
+
+from . import tracing
+
+# 秒単位のヒストグラムのバケット（ハンドラー・DBアクセス・HTTP）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# group_sendの配送先の数
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # ラベル -> [バケットごとの件数..., 合計]（累積はrender時に計算する）
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = ('le', _format_value(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """呼び出し時に値を読むゲージ（funcはラベルなしなら数値、ラベルありなら {ラベルのタプル: 数値} を返す）
+
+    他のモジュールが数えている累積値はkind='counter'で出力する。
+    """
+
+    def __init__(self, name, documentation, func, labelnames=(), kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        values = self.func()
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+# --- メトリクス ---
+
+ws_handler_seconds = Histogram('tracker_ws_handler_seconds', 'WebSocket message handler latency', ('type',))
+ws_frames_sent = Counter('tracker_ws_frames_sent_total', 'WebSocket frames sent to clients')
+ws_bytes_sent = Counter('tracker_ws_bytes_sent_total', 'WebSocket bytes sent to clients')
+db_helper_seconds = Histogram(
+    'tracker_db_helper_seconds', 'DB helper latency including the wait for the sync executor', ('helper',)
+)
+group_sends = Counter('tracker_group_send_total', 'Channel layer group_send calls by message type', ('type',))
+group_send_fanout = Histogram(
+    'tracker_group_send_fanout', 'Channels in the group per group_send (in-memory layer only)',
+    ('type',), buckets=FANOUT_BUCKETS
+)
+http_request_seconds = Histogram('tracker_http_request_seconds', 'HTTP API latency', ('view', 'status'))
+
+_db_in_flight = [0]
+
+
+class QueueDepth:
+    """スレッドプールへ送り、まだ実行が始まっていない呼び出しの数（実行するスレッドから減らす）"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        with self._lock:
+            self.value += amount
+
+
+executor_queue = QueueDepth()
+
+
+def _ws_messages():
+    from .protocol import message_stats
+    stats = message_stats.stats()
+    values = {}
+    for result in ('accepted', 'rejected'):
+        for message_type, count in stats[result].items():
+            values[(message_type, result)] = count
+    for reason, count in message_stats.malformed.items():
+        values[('', reason)] = count
+    return values
+
+
+def _active_connections():
+    from .rate_control import load_monitor
+    return load_monitor.connections
+
+
+def _active_rooms():
+    from .admission import admission
+    return admission.stats()['sessions']
+
+
+GAUGES = [
+    Gauge('tracker_ws_messages_total', 'WebSocket messages received by type and validation result',
+          _ws_messages, ('type', 'result'), kind='counter'),
+    Gauge('tracker_ws_connections', 'Open WebSocket connections in this worker', _active_connections),
+    Gauge('tracker_ws_rooms', 'Sessions with open WebSocket connections in this worker', _active_rooms),
+    Gauge('tracker_sync_executor_queue_depth', 'Calls waiting for the database_sync_to_async executor',
+          lambda: executor_queue.value),
+    Gauge('tracker_db_helper_in_flight', 'DB helper calls waiting or running', lambda: _db_in_flight[0]),
+]
+
+METRICS = [
+    ws_handler_seconds, ws_frames_sent, ws_bytes_sent, db_helper_seconds,
+    group_sends, group_send_fanout, http_request_seconds, *GAUGES,
+]
+
+
+# --- 計測用のヘルパー ---
+
+def database_sync(func):
+    """database_sync_to_async と同じ。スレッドプールで実行を待っている呼び出しを数える"""
+    @wraps(func)
+    def run(*args, **kwargs):
+        executor_queue.add(-1)
+        return func(*args, **kwargs)
+
+    call = database_sync_to_async(run)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        executor_queue.add(1)
+        return await call(*args, **kwargs)
+    return wrapper
+
+
+def db_helper(func):
+    """DBアクセスの時間を関数名ごとに計測する
+
+    同期関数は database_sync_to_async でスレッドプールへ回し、待ち時間も含めて計測する。
+    コルーチン関数（async_dbの非同期プール）はそのまま計測する。トレース中はスパンとして記録する。
+    """
+    name = func.__name__
+    if asyncio.iscoroutinefunction(func):
+        call = func
+    else:
+        call = database_sync(tracing.count_queries(func))
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        _db_in_flight[0] += 1
+        started = time.perf_counter()
+        try:
+            with tracing.span(name):
+                return await call(*args, **kwargs)
+        finally:
+            db_helper_seconds.observe(time.perf_counter() - started, name)
+            _db_in_flight[0] -= 1
+    return wrapper
+
+
+async def group_send(channel_layer, group, message):
+    """channel_layer.group_send を呼び、回数と配送先の数を記録する"""
+    message_type = message['type']
+    group_sends.inc(message_type)
+    # InMemoryChannelLayerはグループのメンバーを持っている（ブローカー型のレイヤーでは分からない）
+    groups = getattr(channel_layer, 'groups', None)
+    if isinstance(groups, dict):
+        group_send_fanout.observe(len(groups.get(group, ())), message_type)
+    with tracing.span(f'group_send:{message_type}'):
+        await channel_layer.group_send(group, message)
+
+
+def _render_stats(stats):
+    """/api/stats/ の値を tracker_<セクション>_<キー> のゲージとして出力する"""
+    lines = []
+    for section, values in stats.items():
+        for key, value in values.items():
+            name = f'tracker_{section}_{key}'
+            if isinstance(value, dict):
+                lines.append(f'# HELP {name} /api/stats/ {section}.{key} by type')
+                lines.append(f'# TYPE {name} gauge')
+                for label, item in sorted(value.items()):
+                    lines.append(f'{name}{{type="{_escape(label)}"}} {_format_value(item)}')
+            elif isinstance(value, (int, float)):
+                lines.append(f'# HELP {name} /api/stats/ {section}.{key}')
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {_format_value(value)}')
+    return lines
+
+
+def render(stats=None):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    if stats:
+        lines.extend(_render_stats(stats))
+    return '\n'.join(lines) + '\n'
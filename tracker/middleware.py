@@ -0,0 +1,21 @@
+# tracker/middleware.py
+import time
+
+from . import metrics
+
+
+class MetricsMiddleware:
+    """HTTP API（URL名が api_ で始まるビュー）の処理時間を記録する"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        if match is not None and match.url_name and match.url_name.startswith('api_'):
+            metrics.http_request_seconds.observe(
+                time.perf_counter() - started, match.url_name, str(response.status_code)
+            )
+        return response
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Djangoはパーティションテーブルを作れないため、DB側はSQLで作成する。
+# 日ごとのパーティションは tracker.history.ensure_partition で書き込み前に作成し、
+# 範囲外の行はdefaultパーティションに入る。
+CREATE_SQL = """
+CREATE TABLE tracker_locationhistory (
+    id bigint GENERATED BY DEFAULT AS IDENTITY,
+    session_id bigint NOT NULL
+        REFERENCES tracker_locationsession (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+    participant_id varchar(50) NOT NULL,
+    ts timestamp with time zone NOT NULL,
+    latitude double precision NOT NULL,
+    longitude double precision NOT NULL,
+    accuracy double precision NULL,
+    speed double precision NULL,
+    heading double precision NULL,
+    PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+CREATE INDEX tracker_loc_session_2deccc_idx
+    ON tracker_locationhistory (session_id, participant_id, ts);
+CREATE TABLE tracker_locationhistory_default
+    PARTITION OF tracker_locationhistory DEFAULT;
+"""
+
+DROP_SQL = "DROP TABLE tracker_locationhistory CASCADE;"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(CREATE_SQL, DROP_SQL),
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name='LocationHistory',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('participant_id', models.CharField(max_length=50)),
+                        ('ts', models.DateTimeField()),
+                        ('latitude', models.FloatField()),
+                        ('longitude', models.FloatField()),
+                        ('accuracy', models.FloatField(blank=True, null=True)),
+                        ('speed', models.FloatField(blank=True, null=True)),
+                        ('heading', models.FloatField(blank=True, null=True)),
+                        ('session', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='history', to='tracker.locationsession')),
+                    ],
+                    options={
+                        'ordering': ['ts'],
+                        'indexes': [models.Index(fields=['session', 'participant_id', 'ts'], name='tracker_loc_session_2deccc_idx')],
+                    },
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0002_location_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationHistoryTier',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('participant_id', models.CharField(max_length=50)),
+                ('resolution', models.IntegerField()),
+                ('bucket', models.BigIntegerField()),
+                ('ts', models.DateTimeField()),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('accuracy', models.FloatField(blank=True, null=True)),
+                ('speed', models.FloatField(blank=True, null=True)),
+                ('heading', models.FloatField(blank=True, null=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history_tiers', to='tracker.locationsession')),
+            ],
+            options={
+                'ordering': ['bucket'],
+                'unique_together': {('session', 'participant_id', 'resolution', 'bucket')},
+            },
+        ),
+    ]
@@ -151,6 +151,54 @@ class LocationData(models.Model):
         name = self.get_display_name()
         return f"{name} - {self.latitude}, {self.longitude}"
 
+class LocationHistory(models.Model):
+    """位置情報の履歴（追記のみ）
+
+    DB上はtsで日ごとにレンジパーティション分割している（マイグレーション0002参照）。
+    実際の主キーは (id, ts)。セッション削除時はDB側のON DELETE CASCADEで消える。
+    """
+    session = models.ForeignKey(LocationSession, on_delete=models.DO_NOTHING, related_name='history')
+    participant_id = models.CharField(max_length=50)
+    ts = models.DateTimeField()
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    accuracy = models.FloatField(blank=True, null=True)
+    speed = models.FloatField(blank=True, null=True)
+    heading = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['ts']
+        indexes = [
+            models.Index(fields=['session', 'participant_id', 'ts']),
+        ]
+
+    def __str__(self):
+        return f"{self.participant_id} @ {self.ts:%H:%M:%S} - {self.latitude}, {self.longitude}"
+
+class LocationHistoryTier(models.Model):
+    """LocationHistoryを一定間隔ごとに間引いた軌跡
+
+    resolution秒ごとのバケットにつき、そのバケットで最後に受信した点を1行だけ持つ。
+    履歴の書き込み時にあわせて更新する。
+    """
+    session = models.ForeignKey(LocationSession, on_delete=models.CASCADE, related_name='history_tiers')
+    participant_id = models.CharField(max_length=50)
+    resolution = models.IntegerField()  # 秒
+    bucket = models.BigIntegerField()  # epoch秒 // resolution
+    ts = models.DateTimeField()
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    accuracy = models.FloatField(blank=True, null=True)
+    speed = models.FloatField(blank=True, null=True)
+    heading = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ['session', 'participant_id', 'resolution', 'bucket']
+        ordering = ['bucket']
+
+    def __str__(self):
+        return f"{self.participant_id} {self.resolution}s @ {self.ts:%H:%M:%S}"
+
 class SessionLog(models.Model):
     """セッション利用ログ（統計・デバッグ用）"""
     ACTION_CHOICES = [
@@ -0,0 +1,202 @@
+# tracker/presence.py
+"""参加者の在席状況（最終受信時刻・オンライン・バックグラウンド）をメモリで管理する
+
+- ping・位置を受信するたびにメモリ上の最終受信時刻だけを更新する（DBへは書かない）
+- 最終受信時刻は一定間隔でセッションごとにまとめてLocationData（とWebSocketConnection）へ書き込む
+- 一定時間何も届かない参加者はスイーパーがオフラインにし、ルームへ1回だけ通知する
+
+このワーカーに接続している参加者だけを扱う。切断時の処理（disconnect）はそのまま残し、
+切断が届かないまま通信が途絶えた参加者をスイーパーが拾う。
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from .broadcaster import get_room_broadcaster
+from .location_buffer import location_buffer
+from .metrics import database_sync
+from .models import LocationData, WebSocketConnection
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceEntry:
+    __slots__ = ('group_name', 'cell_size', 'last_seen', 'seen_at', 'timeout', 'online', 'is_background')
+
+    def __init__(self, group_name, cell_size):
+        self.group_name = group_name
+        self.cell_size = cell_size
+        self.last_seen = 0.0
+        self.seen_at = None
+        self.timeout = 0.0
+        self.online = True
+        self.is_background = False
+
+
+class PresenceTracker:
+    def __init__(self, timeout=150.0, sweep_interval=10.0, persist_interval=30.0):
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.persist_interval = persist_interval
+        # (session_pk, participant_id) -> PresenceEntry
+        self._entries = {}
+        # DBへの書き込みを待っている参加者
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._task = None
+        self.persisted = 0
+        self.swept = 0
+
+    def seen(self, session_pk, participant_id, group_name, cell_size=None, is_background=None, ping_interval=None):
+        """参加者から何か届いたことを記録する
+
+        スイーパーがオフラインにしていた参加者ならTrueを返す（呼び出し側でオンラインに戻して通知する）。
+        ping_interval（秒）を渡した場合は、その3倍まではタイムアウトを延ばす。
+        """
+        key = (session_pk, participant_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = PresenceEntry(group_name, cell_size)
+            entry.last_seen = time.monotonic()
+            entry.seen_at = timezone.now()
+            entry.timeout = max(self.timeout, 3 * ping_interval) if ping_interval else self.timeout
+            if is_background is not None:
+                entry.is_background = is_background
+            returned = not entry.online
+            entry.online = True
+            self._dirty.add(key)
+        return returned
+
+    def forget(self, session_pk, participant_id):
+        """切断・退出した参加者を外す（DBは呼び出し側で更新済み）"""
+        key = (session_pk, participant_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._dirty.discard(key)
+
+    def is_online(self, session_pk, participant_id):
+        entry = self._entries.get((session_pk, participant_id))
+        return entry is not None and entry.online
+
+    def stats(self):
+        return {
+            'tracked': len(self._entries),
+            'online': sum(1 for entry in self._entries.values() if entry.online),
+            'dirty': len(self._dirty),
+            'persisted': self.persisted,
+            'swept': self.swept,
+        }
+
+    # --- DBへの反映 ---
+
+    def persist(self):
+        """最終受信時刻をセッションごとにまとめてDBへ書き込み、書き込んだ参加者数を返す"""
+        with self._lock:
+            by_session = {}
+            for key in self._dirty:
+                entry = self._entries.get(key)
+                if entry is None or not entry.online:
+                    continue
+                pids, seen_at = by_session.get(key[0], ([], entry.seen_at))
+                pids.append(key[1])
+                by_session[key[0]] = (pids, max(seen_at, entry.seen_at))
+            self._dirty = set()
+        count = 0
+        for session_pk, (pids, seen_at) in by_session.items():
+            # 間隔内の最後の受信時刻でまとめて更新する（参加者ごとの誤差はpersist_interval以内）
+            LocationData.objects.filter(
+                session_id=session_pk,
+                participant_id__in=pids
+            ).update(
+                last_updated=seen_at,
+                is_online=True
+            )
+            # 接続数の判定で生きている接続として数えられるようにする（connections.py）
+            WebSocketConnection.objects.filter(
+                session_id=session_pk,
+                participant_id__in=pids,
+                is_active=True
+            ).update(last_ping=seen_at)
+            count += len(pids)
+        self.persisted += count
+        return count
+
+    def take_stale(self, now=None):
+        """タイムアウトした参加者をオフラインにし、(session_pk, participant_id, entry) の一覧を返す"""
+        now = time.monotonic() if now is None else now
+        stale = []
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.online and now - entry.last_seen > entry.timeout:
+                    entry.online = False
+                    self._dirty.discard(key)
+                    stale.append((key[0], key[1], entry))
+        self.swept += len(stale)
+        return stale
+
+    @staticmethod
+    def mark_offline(stale):
+        """スイーパーでオフラインにした参加者をDBとメモリ上のルームに反映する"""
+        by_session = {}
+        for session_pk, participant_id, _ in stale:
+            by_session.setdefault(session_pk, []).append(participant_id)
+        for session_pk, pids in by_session.items():
+            LocationData.objects.filter(
+                session_id=session_pk,
+                participant_id__in=pids
+            ).update(is_online=False)
+            for participant_id in pids:
+                location_buffer.apply(session_pk, participant_id, {'is_online': False})
+
+    # --- 定期実行 ---
+
+    def ensure_started(self):
+        task = self._task
+        if task is not None and not task.done() and not task.get_loop().is_closed():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        last_persist = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+                if time.monotonic() - last_persist >= self.persist_interval:
+                    last_persist = time.monotonic()
+                    await database_sync(self.persist)()
+            except Exception:
+                logger.exception("Presence sweep failed")
+
+    async def sweep(self, now=None):
+        """タイムアウトした参加者をオフラインにし、ルームごとに1回だけ差分を送る"""
+        stale = self.take_stale(now)
+        if not stale:
+            return 0
+        await database_sync(self.mark_offline)(stale)
+        channel_layer = get_channel_layer()
+        broadcasters = {}
+        for session_pk, participant_id, entry in stale:
+            broadcaster = broadcasters.get(entry.group_name)
+            if broadcaster is None:
+                broadcaster = broadcasters[entry.group_name] = get_room_broadcaster(
+                    channel_layer, entry.group_name, session_pk, entry.cell_size
+                )
+            broadcaster.dirty.add(participant_id)
+        for broadcaster in broadcasters.values():
+            await broadcaster.flush_now()
+        logger.info("Marked %d silent participants offline", len(stale))
+        return len(stale)
+
+
+presence = PresenceTracker(
+    timeout=getattr(settings, 'PRESENCE_TIMEOUT', 150.0),
+    sweep_interval=getattr(settings, 'PRESENCE_SWEEP_INTERVAL', 10.0),
+    persist_interval=getattr(settings, 'PRESENCE_PERSIST_INTERVAL', 30.0),
+)
@@ -0,0 +1,259 @@
+# tracker/protocol.py
+"""WebSocketで受信するメッセージの検証
+
+メッセージ種別ごとのスキーマ（フィールド -> 検証関数）を読み込み時に検証関数へ変換しておき、
+受信時は parse() でJSONの解析と検証をまとめて行う。不正なフレームはDBやスレッドプールに
+触れる前にここで捨て、種別ごとに受理・拒否の件数を数える。
+
+スキーマにないフィールドは無視する（クライアントが追加情報を送っても拒否しない）。
+値がnullのフィールドは省略されたものとして扱う。
+"""
+import json
+import math
+import threading
+
+from django.conf import settings
+
+# 1フレームの上限（文字数）。位置更新は200文字程度
+MAX_MESSAGE_LENGTH = getattr(settings, 'WEBSOCKET_MAX_MESSAGE_LENGTH', 8192)
+
+PARTICIPANT_ID_MAX_LENGTH = 50  # LocationData.participant_id
+PARTICIPANT_NAME_MAX_LENGTH = 100  # LocationData.participant_name
+STATUS_CHOICES = ('waiting', 'sharing', 'stopped')
+
+
+class MessageError(ValueError):
+    pass
+
+
+# --- フィールドの検証関数 ---
+
+def string(max_length, choices=None):
+    def check(value):
+        if not isinstance(value, str):
+            raise MessageError('must be a string')
+        if len(value) > max_length:
+            raise MessageError(f'longer than {max_length} characters')
+        if choices is not None and value not in choices:
+            raise MessageError('unexpected value')
+    return check
+
+
+def boolean():
+    def check(value):
+        if not isinstance(value, bool):
+            raise MessageError('must be a boolean')
+    return check
+
+
+def number(min_value=None, max_value=None):
+    def check(value):
+        # boolはintのサブクラスなので除く。json.loadsはNaN/Infinityも受け付けるので除く
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise MessageError('must be a finite number')
+        if min_value is not None and value < min_value:
+            raise MessageError(f'less than {min_value}')
+        if max_value is not None and value > max_value:
+            raise MessageError(f'greater than {max_value}')
+    return check
+
+
+def timestamp():
+    """ISO 8601の文字列またはエポックミリ秒"""
+    check_string = string(64)
+    check_number = number()
+
+    def check(value):
+        (check_string if isinstance(value, str) else check_number)(value)
+    return check
+
+
+def bbox():
+    """[south, west, north, east]"""
+    check_lat = number(-90, 90)
+    check_lon = number(-180, 180)
+
+    def check(value):
+        if not isinstance(value, list) or len(value) != 4:
+            raise MessageError('must be [south, west, north, east]')
+        south, west, north, east = value
+        check_lat(south)
+        check_lon(west)
+        check_lat(north)
+        check_lon(east)
+    return check
+
+
+def required(check):
+    check.required = True
+    return check
+
+
+# --- スキーマ ---
+
+participant_id = string(PARTICIPANT_ID_MAX_LENGTH)
+participant_name = string(PARTICIPANT_NAME_MAX_LENGTH)
+flag = boolean()
+
+SCHEMAS = {
+    'join': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'is_sharing': flag,
+        'has_cached_position': flag,
+        'initial_status': string(20, STATUS_CHOICES),
+        'supports_delta': flag,
+        'supports_viewport': flag,
+    },
+    'location_update': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'latitude': required(number(-90, 90)),
+        'longitude': required(number(-180, 180)),
+        'accuracy': number(0),
+        'altitude': number(-1000, 100000),
+        'heading': number(0, 360),
+        'speed': number(0),
+        'is_background': flag,
+        'timestamp': timestamp(),
+    },
+    'name_update': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+    },
+    'background_status_update': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'is_background': flag,
+        'is_sharing': flag,
+        'has_position': flag,
+        'timestamp': timestamp(),
+    },
+    'stop_sharing': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'is_background': flag,
+        'clear_location': flag,
+        'timestamp': timestamp(),
+    },
+    'confirm_stop_sharing': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'is_background': flag,
+        'timestamp': timestamp(),
+    },
+    'sync_status': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'is_sharing': flag,
+        'status': string(20, STATUS_CHOICES),
+        'is_background': flag,
+    },
+    'offline': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'is_background': flag,
+    },
+    'leave': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+    },
+    'ping': {
+        'participant_id': participant_id,
+        'timestamp': timestamp(),
+        'is_sharing': flag,
+        'has_position': flag,
+    },
+    'notification': {
+        'participant_id': required(string(PARTICIPANT_ID_MAX_LENGTH)),
+        'participant_name': participant_name,
+        'message': required(string(500)),
+        'notification_type': string(20),
+        'icon': string(100),
+        'exclude_self': flag,
+        'timestamp': timestamp(),
+    },
+    'resync': {
+        'participant_id': participant_id,
+    },
+    'viewport': {
+        'participant_id': participant_id,
+        'bbox': required(bbox()),
+    },
+}
+
+
+def compile_schema(schema):
+    """スキーマを1つの検証関数にまとめる（必須フィールドの一覧とチェックの組を先に作っておく）"""
+    required_fields = tuple(name for name, check in schema.items() if getattr(check, 'required', False))
+    checks = tuple(schema.items())
+
+    def validate(data):
+        for name in required_fields:
+            if data.get(name) is None:
+                raise MessageError(f'{name}: required')
+        for name, check in checks:
+            value = data.get(name)
+            if value is not None:
+                try:
+                    check(value)
+                except MessageError as e:
+                    raise MessageError(f'{name}: {e}') from None
+    return validate
+
+
+VALIDATORS = {message_type: compile_schema(schema) for message_type, schema in SCHEMAS.items()}
+
+
+class MessageStats:
+    """種別ごとの受理・拒否件数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted = dict.fromkeys(VALIDATORS, 0)
+        self.rejected = dict.fromkeys(VALIDATORS, 0)
+        # 種別を判定できなかったフレーム
+        self.malformed = {'oversized': 0, 'invalid_json': 0, 'unknown_type': 0}
+
+    def count(self, table, key):
+        with self._lock:
+            table[key] += 1
+
+    def stats(self):
+        return {
+            'accepted': dict(self.accepted),
+            'rejected': dict(self.rejected),
+            **self.malformed,
+        }
+
+
+message_stats = MessageStats()
+
+
+def parse(text_data):
+    """受信したフレームを解析・検証して (メッセージ, None) または (None, 拒否理由) を返す"""
+    if text_data is None:
+        # バイナリフレームは使わない
+        message_stats.count(message_stats.malformed, 'invalid_json')
+        return None, 'Invalid JSON format'
+    if len(text_data) > MAX_MESSAGE_LENGTH:
+        message_stats.count(message_stats.malformed, 'oversized')
+        return None, 'Message too large'
+    try:
+        data = json.loads(text_data)
+    except (json.JSONDecodeError, RecursionError):
+        message_stats.count(message_stats.malformed, 'invalid_json')
+        return None, 'Invalid JSON format'
+    message_type = data.get('type') if isinstance(data, dict) else None
+    validate = VALIDATORS.get(message_type) if isinstance(message_type, str) else None
+    if validate is None:
+        message_stats.count(message_stats.malformed, 'unknown_type')
+        return None, 'Unknown message type'
+    # nullのフィールドは取り除く（ハンドラーの data.get(name, 既定値) で既定値になる）
+    data = {name: value for name, value in data.items() if value is not None}
+    try:
+        validate(data)
+    except MessageError as e:
+        message_stats.count(message_stats.rejected, message_type)
+        return None, f'Invalid {message_type}: {e}'
+    message_stats.count(message_stats.accepted, message_type)
+    return data, None
@@ -0,0 +1,115 @@
+# tracker/rate_control.py
+"""クライアントの送信間隔の制御（rate_hint）
+
+ルームの人数・ワーカーの接続数とイベントループの遅延・参加者の移動速度から、
+クライアントに位置送信とpingの間隔を指示する。ルーム全体・ワーカー全体の
+位置の受信件数が予算（件/秒）を超えないように、人数が増えるほど間隔を延ばす。
+"""
+import asyncio
+import time
+
+from django.conf import settings
+
+# location-sharing.js の CONFIG の既定値（これより短い間隔は指示しない）
+MIN_UPDATE_INTERVAL = 3.0
+MAX_UPDATE_INTERVAL = 45.0
+BACKGROUND_UPDATE_INTERVAL = 60.0
+PING_INTERVAL = 15.0
+MOVEMENT_THRESHOLD = 10.0
+
+# 指示する間隔の上限（秒）
+MAX_HINT_INTERVAL = 120.0
+
+# 止まっているとみなす速度（m/s）。境界付近の速度で指示が切り替わり続けないよう、
+# 止まったと判定する速度より動き出したと判定する速度を高くする
+STATIONARY_ENTER_SPEED = 0.5
+STATIONARY_EXIT_SPEED = 1.0
+
+
+class LoadMonitor:
+    """イベントループの遅延（sleepの遅れ）を計測してワーカーの負荷の目安にする"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lag = 0.0
+        self.connections = 0
+        self._task = None
+
+    def ensure_started(self):
+        task = self._task
+        if task is not None and not task.done() and not task.get_loop().is_closed():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - started - self.interval
+            # 指数移動平均で平滑化
+            self.lag = self.lag * 0.7 + max(0.0, lag) * 0.3
+
+
+load_monitor = LoadMonitor()
+
+
+def _budget(name, default):
+    return getattr(settings, name, default)
+
+
+def compute_rate_hint(room_size, speed=None, connections=None, lag=None, previous=None):
+    """クライアントに送る間隔（ミリ秒）と移動閾値（メートル）を計算
+
+    previousは前回送った指示。止まっているかの判定はそこから引き継ぐ。
+    """
+    connections = load_monitor.connections if connections is None else connections
+    lag = load_monitor.lag if lag is None else lag
+    room_budget = _budget('LOCATION_RATE_ROOM_BUDGET', 20.0)
+    worker_budget = _budget('LOCATION_RATE_WORKER_BUDGET', 300.0)
+    lag_threshold = _budget('LOCATION_RATE_LAG_THRESHOLD', 0.1)
+
+    # 予算を人数で割った間隔。ルームとワーカーの厳しい方に合わせる
+    interval = max(
+        MIN_UPDATE_INTERVAL,
+        max(room_size, 1) / room_budget,
+        max(connections, 1) / worker_budget,
+    )
+    reason = 'normal'
+    if interval > MIN_UPDATE_INTERVAL:
+        reason = 'room_size' if room_size / room_budget >= connections / worker_budget else 'connections'
+    # イベントループが遅れている間はさらに延ばす
+    if lag > lag_threshold:
+        interval *= min(4.0, 1 + lag / lag_threshold)
+        reason = 'load'
+
+    interval = min(interval, MAX_HINT_INTERVAL)
+    scale = interval / MIN_UPDATE_INTERVAL
+    movement_threshold = MOVEMENT_THRESHOLD * max(1.0, scale ** 0.5)
+    # 予算の範囲内で、止まっている参加者は粗く、速く動いている参加者は移動閾値を小さいままにする
+    stationary = bool(previous and previous.get('stationary'))
+    if speed is not None:
+        stationary = speed < (STATIONARY_EXIT_SPEED if stationary else STATIONARY_ENTER_SPEED)
+        if stationary:
+            interval = min(interval * 2, MAX_HINT_INTERVAL)
+        elif speed >= 10:
+            movement_threshold = MOVEMENT_THRESHOLD
+    return {
+        'type': 'rate_hint',
+        'min_update_interval': int(interval * 1000),
+        'max_update_interval': int(min(MAX_HINT_INTERVAL, max(MAX_UPDATE_INTERVAL, interval * 3)) * 1000),
+        'background_update_interval': int(min(MAX_HINT_INTERVAL * 2, BACKGROUND_UPDATE_INTERVAL * max(1.0, scale / 2)) * 1000),
+        'ping_interval': int(min(MAX_HINT_INTERVAL / 2, PING_INTERVAL * max(1.0, scale / 2)) * 1000),
+        'movement_threshold': round(movement_threshold, 1),
+        'stationary': stationary,
+        'reason': reason,
+    }
+
+
+def hint_changed(previous, hint, tolerance=0.2):
+    """前回送った指示から20%以上変わったか（細かい変動で送り直さない）"""
+    if previous is None:
+        return True
+    for key in ('min_update_interval', 'ping_interval', 'background_update_interval'):
+        if abs(hint[key] - previous[key]) > previous[key] * tolerance:
+            return True
+    return False
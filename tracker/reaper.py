@@ -0,0 +1,210 @@
+# tracker/reaper.py
+"""期限切れセッションの削除（必要ならアーカイブしてから）
+
+- 期限切れのセッションをid順のキーセットページングでbatch_size件ずつ処理する
+- 1バッチごとに短いトランザクションで子テーブルから順に削除し、バッチ間で少し待つ
+- PostgreSQLではlock_timeoutを設定し、ロック待ちが長引く場合はそのバッチで打ち切る
+- 複数ワーカーで同時に動かないようadvisory lockを取る
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connection, transaction
+from django.db.utils import OperationalError
+from django.utils import timezone
+
+from .history import drop_partitions_before
+from .models import (
+    LocationSession, LocationData, LocationHistory, LocationHistoryTier,
+    SessionLog, WebSocketConnection,
+)
+
+logger = logging.getLogger(__name__)
+
+# advisory lockのキー（任意の定数）
+REAPER_LOCK_KEY = 0x7265617065
+
+# 子テーブルを先に消す（セッションのCASCADEでまとめて消すより1文あたりのロックが短い）
+CHILD_MODELS = [
+    LocationHistoryTier,
+    LocationHistory,
+    LocationData,
+    SessionLog,
+    WebSocketConnection,
+]
+
+
+class SessionReaper:
+    def __init__(self, batch_size=500, grace=timedelta(hours=1), archive_dir=None,
+                 pause=0.05, lock_timeout='2s'):
+        self.batch_size = batch_size
+        self.grace = grace
+        self.archive_dir = archive_dir
+        self.pause = pause
+        self.lock_timeout = lock_timeout
+
+    def run(self, max_batches=None, dry_run=False):
+        """期限切れセッションを削除し、件数と処理速度を返す"""
+        stats = {'sessions': 0, 'rows': 0, 'batches': 0, 'archived': 0, 'partitions_dropped': 0, 'skipped': False}
+        cutoff = timezone.now() - self.grace
+        started = time.monotonic()
+        if not self._try_lock():
+            stats['skipped'] = True
+            return self._finish(stats, started)
+        try:
+            last_id = 0
+            # 期限切れのセッションを最後まで処理できたか（途中で打ち切った場合はパーティションを捨てない）
+            complete = False
+            while max_batches is None or stats['batches'] < max_batches:
+                ids = list(
+                    LocationSession.objects
+                    .filter(expires_at__lt=cutoff, id__gt=last_id)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:self.batch_size]
+                )
+                if not ids:
+                    complete = True
+                    break
+                last_id = ids[-1]
+                stats['batches'] += 1
+                if dry_run:
+                    stats['sessions'] += len(ids)
+                    continue
+                if self.archive_dir:
+                    stats['archived'] += self.archive(ids)
+                try:
+                    stats['rows'] += self.delete_batch(ids)
+                except OperationalError:
+                    # lock_timeout。残りは次回に回す
+                    logger.warning("Session reaper stopped: lock timeout on batch after id %s", ids[0])
+                    break
+                stats['sessions'] += len(ids)
+                if self.pause:
+                    time.sleep(self.pause)
+            # アーカイブする設定なら、削除したセッションが全てアーカイブ済みの場合だけ
+            archived_all = not self.archive_dir or stats['archived'] == stats['sessions']
+            if complete and archived_all and not dry_run:
+                # 期限切れのセッションしか含まない古い日のパーティションは丸ごと捨てる
+                max_duration = max(minutes for minutes, _ in LocationSession.DURATION_CHOICES)
+                stats['partitions_dropped'] = drop_partitions_before(
+                    (cutoff - timedelta(minutes=max_duration, days=1)).date()
+                )
+        finally:
+            self._unlock()
+        return self._finish(stats, started)
+
+    def delete_batch(self, ids):
+        """1バッチ分のセッションと子の行を削除し、削除した行数を返す"""
+        rows = 0
+        with transaction.atomic():
+            if connection.vendor == 'postgresql' and self.lock_timeout:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL lock_timeout = %s', [self.lock_timeout])
+            for model in CHILD_MODELS:
+                deleted, _ = model.objects.filter(session_id__in=ids).delete()
+                rows += deleted
+            # セッションはシグナル（キャッシュ・バッファの破棄）を送るため通常のdeleteで消す
+            deleted, _ = LocationSession.objects.filter(id__in=ids).delete()
+            rows += deleted
+        return rows
+
+    def archive(self, ids):
+        """削除前にセッションと子の行をJSON Lines（gzip）で書き出す
+
+        sessions-YYYYMMDD.jsonl.gz にはセッション1件につき1行（参加者とログを含む）、
+        履歴は件数が多いため history-YYYYMMDD.jsonl.gz に1点1行で書き出す。
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        day = f'{timezone.now():%Y%m%d}'
+        children = {'locations': LocationData, 'logs': SessionLog}
+        grouped = {name: {} for name in children}
+        for name, model in children.items():
+            for row in model.objects.filter(session_id__in=ids).order_by().values().iterator(chunk_size=2000):
+                grouped[name].setdefault(row['session_id'], []).append(row)
+        count = 0
+        with gzip.open(os.path.join(self.archive_dir, f'sessions-{day}.jsonl.gz'), 'at', encoding='utf-8') as fp:
+            for session in LocationSession.objects.filter(id__in=ids).values():
+                record = {**session, **{name: rows.get(session['id'], []) for name, rows in grouped.items()}}
+                fp.write(json.dumps(record, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+                count += 1
+        with gzip.open(os.path.join(self.archive_dir, f'history-{day}.jsonl.gz'), 'at', encoding='utf-8') as fp:
+            history = LocationHistory.objects.filter(session_id__in=ids).order_by().values()
+            for row in history.iterator(chunk_size=5000):
+                fp.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+        return count
+
+    def _try_lock(self):
+        if connection.vendor != 'postgresql':
+            return True
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [REAPER_LOCK_KEY])
+            return cursor.fetchone()[0]
+
+    def _unlock(self):
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [REAPER_LOCK_KEY])
+
+    def _finish(self, stats, started):
+        stats['elapsed'] = time.monotonic() - started
+        stats['rows_per_sec'] = stats['rows'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+        return stats
+
+
+def make_reaper(**overrides):
+    options = {
+        'batch_size': getattr(settings, 'SESSION_REAPER_BATCH_SIZE', 500),
+        'grace': timedelta(minutes=getattr(settings, 'SESSION_REAPER_GRACE_MINUTES', 60)),
+        'archive_dir': getattr(settings, 'SESSION_REAPER_ARCHIVE_DIR', None),
+    }
+    options.update(overrides)
+    return SessionReaper(**options)
+
+
+_reaper_task = None
+
+
+def ensure_reaper():
+    """SESSION_REAPER_INTERVALが設定されていれば、現在のイベントループで定期実行を始める"""
+    global _reaper_task
+    interval = getattr(settings, 'SESSION_REAPER_INTERVAL', None)
+    if not interval:
+        return
+    task = _reaper_task
+    if task is not None and not task.done() and not task.get_loop().is_closed():
+        return
+    _reaper_task = asyncio.get_running_loop().create_task(_run_reaper(interval))
+
+
+def _reap_once():
+    """スレッドプールの1スレッドで1回分を実行し、そのスレッドのDB接続を閉じて返す"""
+    close_old_connections()
+    try:
+        return make_reaper().run()
+    finally:
+        connection.close()
+
+
+async def _run_reaper(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # バッチ間の待ち・アーカイブの書き出しの間もコンシューマーのDBアクセス
+            # （database_sync_to_asyncの共有スレッド）を止めないよう、別のスレッドで動かす
+            stats = await sync_to_async(_reap_once, thread_sensitive=False)()
+            if stats['sessions']:
+                logger.info(
+                    "Reaped %d expired sessions (%d rows, %.0f rows/sec)",
+                    stats['sessions'], stats['rows'], stats['rows_per_sec']
+                )
+        except Exception:
+            logger.exception("Session reaper failed")
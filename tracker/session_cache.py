@@ -0,0 +1,121 @@
+# tracker/session_cache.py
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.utils import timezone
+
+from .models import LocationSession
+
+
+class SessionMeta(NamedTuple):
+    """セッションの不変メタデータ（作成後に変わらない列のみ）"""
+    pk: int
+    session_id: uuid.UUID
+    duration_minutes: int
+    created_at: datetime
+    expires_at: datetime
+    max_participants: int
+
+    @classmethod
+    def from_session(cls, session):
+        return cls(
+            pk=session.pk,
+            session_id=session.session_id,
+            duration_minutes=session.duration_minutes,
+            created_at=session.created_at,
+            expires_at=session.expires_at,
+            max_participants=session.max_participants,
+        )
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+    def get_share_url(self):
+        return f"/share/{self.session_id}"
+
+
+class SessionMetaCache:
+    """プロセス内で共有するセッションメタデータキャッシュ（TTL + LRU）
+
+    コンシューマー（スレッドプール）とHTTPビューの両方から参照されるためロックで保護する。
+    存在しないセッションはキャッシュしない。
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def peek(self, session_id):
+        """キャッシュのみを参照（DBアクセスなし）。イベントループから直接呼んでよい"""
+        key = str(session_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            meta, deadline = entry
+            if time.monotonic() >= deadline:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return meta
+
+    def get(self, session_id):
+        """メタデータを取得（キャッシュミス時はDBから読み込む）"""
+        meta = self.peek(session_id)
+        if meta is not None:
+            return meta
+        with self._lock:
+            self.misses += 1
+        try:
+            session = LocationSession.objects.get(session_id=session_id)
+        except (LocationSession.DoesNotExist, ValidationError, ValueError):
+            return None
+        return self.prime(session)
+
+    def prime(self, session):
+        """セッションオブジェクトからキャッシュを登録・更新"""
+        meta = SessionMeta.from_session(session)
+        key = str(meta.session_id)
+        with self._lock:
+            self._entries[key] = (meta, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return meta
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(str(session_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+session_cache = SessionMetaCache(
+    maxsize=getattr(settings, 'SESSION_META_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'SESSION_META_CACHE_TTL', 300),
+)
+
+
+def get_session_meta_or_404(session_id):
+    """ビュー用: get_object_or_404 のキャッシュ版"""
+    meta = session_cache.get(session_id)
+    if meta is None:
+        raise Http404('セッションが見つかりません')
+    return meta
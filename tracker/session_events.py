@@ -0,0 +1,162 @@
+# tracker/session_events.py
+"""SessionLog の書き込みをまとめて行う
+
+ビュー・コンシューマーは record() でイベントをキューに入れるだけで戻る（DBアクセスなし）。
+書き込みスレッドが batch_size 件たまるか flush_interval 秒ごとに bulk_create でまとめて書き込む。
+
+- キューが max_queue 件を超えたら新しいイベントを捨てる（dropped）
+- 件数の多い種類（位置更新など）は sample_rates の割合だけ記録する（sampled_out）
+- timestamp（auto_now_add）はDBへの書き込み時刻になる（最大 flush_interval 秒遅れる）
+
+ビューは同期・コンシューマーはイベントループで動くため、どちらからも使えるよう
+書き込みはイベントループではなく専用のスレッドで行う。
+"""
+import atexit
+import logging
+import random
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection
+
+from .models import LocationSession, SessionLog
+
+logger = logging.getLogger(__name__)
+
+
+class SessionEventLog:
+    def __init__(self, batch_size=500, flush_interval=2.0, max_queue=10000, sample_rates=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        # action -> 記録する割合（指定のないものは全て記録）
+        self.sample_rates = sample_rates or {}
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed_batches = 0
+
+    def record(self, session_pk, action, participant_id='', ip_address=None, user_agent='',
+               connection_id='', error_message='', additional_data=None):
+        """イベントをキューに入れる（書き込みを待たない）"""
+        rate = self.sample_rates.get(action)
+        if rate is not None and random.random() >= rate:
+            self.sampled_out += 1
+            return
+        event = {
+            'session_id': session_pk,
+            'action': action,
+            'participant_id': participant_id or '',
+            'ip_address': ip_address,
+            'user_agent': user_agent or '',
+            'connection_id': connection_id or '',
+            'error_message': error_message or '',
+            'additional_data': additional_data,
+        }
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append(event)
+            size = len(self._queue)
+        self.ensure_started()
+        if size >= self.batch_size:
+            self._wake.set()
+
+    def forget_session(self, session_pk):
+        """削除されたセッションのイベントを捨てる（外部キー違反で書き込みが失敗しないように）"""
+        with self._lock:
+            kept = [event for event in self._queue if event['session_id'] != session_pk]
+            self._queue = deque(kept)
+
+    # --- 書き込み ---
+
+    def ensure_started(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='session-events', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            woken = self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                written = self.flush()
+            except Exception:
+                logger.exception("Session log flush failed")
+                written = 0
+            if written or woken:
+                close_old_connections()
+            else:
+                # 何もない間はDB接続を持ち続けない
+                connection.close()
+
+    def flush(self):
+        """たまっているイベントを書き込み、書き込んだ件数を返す"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._queue:
+                        break
+                    batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                written += self._write(batch)
+        return written
+
+    def _write(self, batch):
+        objs = [SessionLog(**event) for event in batch]
+        try:
+            SessionLog.objects.bulk_create(objs)
+        except IntegrityError:
+            # 書き込み待ちの間に削除されたセッションのイベントを除いて書き直す
+            live = set(LocationSession.objects.filter(
+                pk__in={obj.session_id for obj in objs}
+            ).values_list('pk', flat=True))
+            kept = [obj for obj in objs if obj.session_id in live]
+            self.dropped += len(objs) - len(kept)
+            SessionLog.objects.bulk_create(kept)
+            objs = kept
+        except Exception:
+            # DBに書き込めない間は（キューの上限まで）先頭に戻して次回に再試行
+            self.failed_batches += 1
+            with self._lock:
+                room = max(0, self.max_queue - len(self._queue))
+                self._queue.extendleft(reversed(batch[:room]))
+                self.dropped += len(batch) - min(len(batch), room)
+            raise
+        self.written += len(objs)
+        return len(objs)
+
+    def flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Session log flush at shutdown failed")
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'failed_batches': self.failed_batches,
+        }
+
+
+session_events = SessionEventLog(
+    batch_size=getattr(settings, 'SESSION_LOG_BATCH_SIZE', 500),
+    flush_interval=getattr(settings, 'SESSION_LOG_FLUSH_INTERVAL', 2.0),
+    max_queue=getattr(settings, 'SESSION_LOG_MAX_QUEUE', 10000),
+    sample_rates=getattr(settings, 'SESSION_LOG_SAMPLE_RATES', {'location_updated': 0.1}),
+)
+atexit.register(session_events.flush_at_exit)
@@ -0,0 +1,22 @@
+# tracker/signals.py
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import LocationSession
+from .session_cache import session_cache
+from .location_buffer import location_buffer
+from .session_events import session_events
+
+
+@receiver(post_save, sender=LocationSession)
+def prime_session_cache(sender, instance, **kwargs):
+    """作成・更新されたセッションのメタデータをキャッシュに反映"""
+    session_cache.prime(instance)
+
+
+@receiver(post_delete, sender=LocationSession)
+def invalidate_session_cache(sender, instance, **kwargs):
+    """削除されたセッションをキャッシュとバッファから除外"""
+    session_cache.invalidate(instance.session_id)
+    location_buffer.forget_session(instance.pk)
+    session_events.forget_session(instance.pk)
@@ -0,0 +1,117 @@
+# tracker/simplify.py
+"""軌跡の間引き（Douglas-Peucker / Visvalingam-Whyatt）
+
+点は (ts, latitude, longitude, ...) のタプル。距離は点列の中心付近で平面近似したメートルで計算する。
+どちらも始点と終点は必ず残し、元の順序を保ったまま返す。
+"""
+import heapq
+import math
+
+EARTH_RADIUS = 6371000.0
+
+
+def _project(points):
+    """緯度経度を平面座標（メートル）に変換"""
+    if not points:
+        return []
+    lat0 = math.radians(sum(p[1] for p in points) / len(points))
+    kx = EARTH_RADIUS * math.cos(lat0) * math.pi / 180
+    ky = EARTH_RADIUS * math.pi / 180
+    return [(p[2] * kx, p[1] * ky) for p in points]
+
+
+def _segment_distance(p, a, b):
+    """点pと線分abの距離"""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+
+def douglas_peucker(points, tolerance=None, max_points=None):
+    """線分からの距離がtolerance（メートル）以下の点を間引く
+
+    max_pointsを指定した場合は線分から遠い点から順に残し、点数がmax_pointsに達したら止める。
+    """
+    if len(points) < 3:
+        return list(points)
+    tolerance = tolerance or 0.0
+    xy = _project(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    kept = 2
+    # 再帰だと長い軌跡でスタックが深くなるので、区間をヒープ（最も遠い点の距離が大きい順）で処理する
+    heap = []
+
+    def push(first, last):
+        max_distance, index = 0.0, None
+        for i in range(first + 1, last):
+            distance = _segment_distance(xy[i], xy[first], xy[last])
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance:
+            heapq.heappush(heap, (-max_distance, first, last, index))
+
+    push(0, len(points) - 1)
+    while heap and (max_points is None or kept < max_points):
+        _, first, last, index = heapq.heappop(heap)
+        keep[index] = True
+        kept += 1
+        push(first, index)
+        push(index, last)
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _triangle_area(a, b, c):
+    return abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])) / 2
+
+
+def visvalingam(points, tolerance=None, max_points=None):
+    """有効面積の小さい点から順に間引く
+
+    tolerance（メートル）を指定した場合は面積がtolerance²未満の点を、
+    max_pointsを指定した場合は点数がmax_points以下になるまで取り除く。
+    """
+    n = len(points)
+    if n < 3:
+        return list(points)
+    min_area = tolerance * tolerance if tolerance is not None else None
+    xy = _project(points)
+    prev = list(range(-1, n - 1))
+    next_ = list(range(1, n + 1))
+    removed = [False] * n
+    areas = [math.inf] * n
+    heap = []
+    for i in range(1, n - 1):
+        areas[i] = _triangle_area(xy[i - 1], xy[i], xy[i + 1])
+        heap.append((areas[i], i))
+    heapq.heapify(heap)
+    remaining = n
+    last_area = 0.0
+    while heap:
+        area, i = heapq.heappop(heap)
+        if removed[i] or area != areas[i]:
+            continue
+        # 取り除いた点より先に隣の点が消えないよう、面積は単調に増やす
+        area = max(area, last_area)
+        within_tolerance = min_area is not None and area < min_area
+        over_budget = max_points is not None and remaining > max_points
+        if not (within_tolerance or over_budget):
+            break
+        last_area = area
+        removed[i] = True
+        remaining -= 1
+        p, q = prev[i], next_[i]
+        next_[p], prev[q] = q, p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                areas[j] = _triangle_area(xy[prev[j]], xy[j], xy[next_[j]])
+                heapq.heappush(heap, (areas[j], j))
+    return [p for p, r in zip(points, removed) if not r]
+
+
+SIMPLIFIERS = {
+    'dp': douglas_peucker,
+    'vw': visvalingam,
+}
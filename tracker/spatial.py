@@ -0,0 +1,73 @@
+# tracker/spatial.py
+"""大規模セッション用の一様グリッド索引
+
+緯度経度をcell_size度ごとのセルに分け、参加者がどのセルにいるかを保持する。
+各接続は表示範囲（bbox）に重なるセルのグループだけを購読する。
+"""
+import math
+
+
+def cell_of(latitude, longitude, cell_size):
+    """位置を含むセル (x, y)。位置がなければNone"""
+    if latitude is None or longitude is None:
+        return None
+    return (math.floor(longitude / cell_size), math.floor(latitude / cell_size))
+
+
+def cells_for_bbox(bbox, cell_size, limit=None):
+    """bbox [south, west, north, east] に重なるセルの集合
+
+    limitを超える場合はNone（呼び出し側でルーム全体の購読に切り替える）。
+    日付変更線をまたぐbboxはwest > eastで表す。
+    """
+    south, west, north, east = (float(v) for v in bbox)
+    south, north = max(-90.0, min(south, north)), min(90.0, max(south, north))
+    y0, y1 = math.floor(south / cell_size), math.floor(north / cell_size)
+    if west <= east:
+        x_ranges = [(math.floor(west / cell_size), math.floor(east / cell_size))]
+    else:
+        x_ranges = [
+            (math.floor(west / cell_size), math.floor(180.0 / cell_size)),
+            (math.floor(-180.0 / cell_size), math.floor(east / cell_size)),
+        ]
+    count = sum(x1 - x0 + 1 for x0, x1 in x_ranges) * (y1 - y0 + 1)
+    if limit is not None and count > limit:
+        return None
+    return {(x, y) for x0, x1 in x_ranges for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)}
+
+
+def cell_group_name(room_group_name, cell):
+    """セル単位のチャネルレイヤーグループ名"""
+    return f'{room_group_name}_c{cell[0]}_{cell[1]}'
+
+
+class GridIndex:
+    """参加者 -> セル と セル -> 参加者 の対応"""
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # cell -> set(participant_id)
+        self.positions = {}  # participant_id -> cell
+
+    def move(self, participant_id, cell):
+        """参加者のセルを更新し、移動前のセルを返す（cell=Noneで削除）"""
+        old = self.positions.get(participant_id)
+        if old == cell:
+            return old
+        if old is not None:
+            members = self.cells.get(old)
+            if members is not None:
+                members.discard(participant_id)
+                if not members:
+                    del self.cells[old]
+            del self.positions[participant_id]
+        if cell is not None:
+            self.cells.setdefault(cell, set()).add(participant_id)
+            self.positions[participant_id] = cell
+        return old
+
+    def participants_in(self, cells):
+        result = set()
+        for cell in cells:
+            result |= self.cells.get(cell, set())
+        return result
@@ -42,7 +42,25 @@
         MAX_TIME_WITHOUT_UPDATE: 45000,
         BACKGROUND_UPDATE_INTERVAL: 60000,
         POSITION_CACHE_DURATION: 300000,
+        USE_DELTA_UPDATES: true,  // location_delta（差分配信）を受け取る
+        USE_COMPACT_PROTOCOL: true,  // 位置情報をコンパクト形式（サブプロトコル）で受け取る
     };
+    // サーバーのrate_hintで延ばす前の値
+    const DEFAULT_INTERVALS = {
+        CONNECTION_CHECK_INTERVAL: CONFIG.CONNECTION_CHECK_INTERVAL,
+        MOVEMENT_THRESHOLD: CONFIG.MOVEMENT_THRESHOLD,
+        MIN_TIME_BETWEEN_UPDATES: CONFIG.MIN_TIME_BETWEEN_UPDATES,
+        MAX_TIME_WITHOUT_UPDATE: CONFIG.MAX_TIME_WITHOUT_UPDATE,
+        BACKGROUND_UPDATE_INTERVAL: CONFIG.BACKGROUND_UPDATE_INTERVAL,
+    };
+    // サーバーが接続を拒否したときの終了コード（tracker/admission.py と対応）
+    const CLOSE_CODES = { SESSION_FULL: 4001, RATE_LIMITED: 4029, SERVER_BUSY: 4503 };
+
+    // === コンパクト形式（tracker/codec.py と対応） ===
+    const COMPACT_SUBPROTOCOL = 'location.compact.v1';
+    const COMPACT_FRAME = { SNAPSHOT: 1, DELTA: 2 };
+    const COMPACT_STATUS = ['waiting', 'sharing', 'stopped'];
+    let compactParticipants = [];  // index -> { id, name }
 
     // === 状態保存用の変数 ===
     let backgroundLocationUpdate = null;
@@ -58,6 +76,14 @@
 let lastNotificationTime = {};
 let lastWebSocketStatus = null;
 let statusChangeTimeout = null;
+    // === 差分配信（location_delta）の状態 ===
+    let locationsEpoch = null;
+    let locationsVersion = null;
+    let resyncRequested = false;
+    // === 大規模セッション（表示範囲ごとの配信）の状態 ===
+    let largeSessionMode = false;
+    let viewportListenerAttached = false;
+    let viewportTimeout = null;
     // === 追従対象管理用変数 ===
     let followingParticipantId = null;
 
@@ -436,7 +462,8 @@ function detectAndNotifyStateChanges(newLocations) {
     // === WebSocket初期化（修正版） ===
     function initWebSocket() {
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${protocol}//${window.location.host}/ws/location/${sessionId}/`;
+    // 参加者IDを付けると、満員のセッションでも既存の参加者として再接続できる
+    const wsUrl = `${protocol}//${window.location.host}/ws/location/${sessionId}/?participant_id=${encodeURIComponent(participantId)}`;
     
     if (websocket) {
         websocket.onclose = null; // 既存の接続のイベントハンドラーを無効化
@@ -451,7 +478,10 @@ function detectAndNotifyStateChanges(newLocations) {
     }
     
     try {
-        websocket = new WebSocket(wsUrl);
+        // サーバーが対応していなければサブプロトコルなし（JSON）で接続される
+        websocket = CONFIG.USE_COMPACT_PROTOCOL
+            ? new WebSocket(wsUrl, [COMPACT_SUBPROTOCOL])
+            : new WebSocket(wsUrl);
         
         websocket.onopen = function(event) {
             console.log('WebSocket接続確立');
@@ -471,7 +501,9 @@ function detectAndNotifyStateChanges(newLocations) {
                 participant_name: sessionState.participantName || elements.participantName?.value || '',
                 is_sharing: isSharing,
                 has_cached_position: !!lastKnownPosition,
-                initial_status: isSharing ? 'sharing' : 'waiting'
+                initial_status: isSharing ? 'sharing' : 'waiting',
+                supports_delta: CONFIG.USE_DELTA_UPDATES,
+                supports_viewport: true
             };
             websocket.send(JSON.stringify(joinMessage));
             
@@ -484,7 +516,8 @@ function detectAndNotifyStateChanges(newLocations) {
         
         websocket.onmessage = function(event) {
             try {
-                const data = JSON.parse(event.data);
+                const raw = JSON.parse(event.data);
+                const data = Array.isArray(raw) ? decodeCompactFrame(raw) : raw;
                 handleWebSocketMessage(data);
                 lastSuccessfulConnection = Date.now();
             } catch (error) {
@@ -504,6 +537,12 @@ function detectAndNotifyStateChanges(newLocations) {
                 }
             }, 2000);
             
+            if (event.code === CLOSE_CODES.SESSION_FULL) {
+                // 満員のセッションには再接続しない
+                updateStatus('ws', 'error', '満員のため参加できません');
+                return;
+            }
+            
             if (!sessionExpired) {
                 const maxAttempts = isInBackground ? 5 : maxReconnectAttempts;
                 const currentAttempts = isInBackground ? backgroundReconnectAttempts : reconnectAttempts;
@@ -515,7 +554,9 @@ function detectAndNotifyStateChanges(newLocations) {
                         reconnectAttempts++;
                     }
                     
-                    const delay = Math.min(
+                    // 接続頻度の制限・サーバー混雑で拒否された場合は最大間隔まで待つ
+                    const throttled = event.code === CLOSE_CODES.RATE_LIMITED || event.code === CLOSE_CODES.SERVER_BUSY;
+                    const delay = throttled ? CONFIG.RECONNECT_MAX_DELAY : Math.min(
                         CONFIG.RECONNECT_BASE_DELAY * Math.pow(CONFIG.RECONNECT_MULTIPLIER, currentAttempts),
                         CONFIG.RECONNECT_MAX_DELAY
                     );
@@ -564,6 +605,11 @@ function handleWebSocketMessage(data) {
     switch (data.type) {
         case 'location_update':
             if (data.locations) {
+                // 全体のスナップショットを基準にする
+                locationsEpoch = data.epoch ?? null;
+                locationsVersion = data.version ?? null;
+                resyncRequested = false;
+                
                 // 状態変化を検知して通知
                 detectAndNotifyStateChanges(data.locations);
                 
@@ -573,6 +619,25 @@ function handleWebSocketMessage(data) {
                 participantsData = data.locations;
             }
             break;
+        case 'location_delta':
+            applyLocationDelta(data);
+            break;
+        case 'session_mode':
+            // 大規模セッション: 表示範囲の参加者だけを受け取る
+            largeSessionMode = data.mode === 'large';
+            if (largeSessionMode) {
+                startViewportSubscription();
+            }
+            break;
+        case 'viewport_snapshot':
+            // 表示範囲の出入りを参加・退出として通知しない
+            updateMapMarkers(data.locations);
+            updateParticipantsList(data.locations);
+            participantsData = data.locations;
+            break;
+        case 'viewport_delta':
+            mergeLocations(data.updated, data.removed);
+            break;
         case 'background_status_change':
             if (data.locations) {
                 // 状態変化を検知して通知
@@ -608,9 +673,182 @@ function handleWebSocketMessage(data) {
                 elements.lastCommunication.textContent = new Date().toLocaleTimeString() + ' (pong)';
             }
             break;
+        case 'rate_hint':
+            applyRateHint(data);
+            break;
     }
 }
 
+// === サーバーからの送信間隔の指示（rate_hint） ===
+function applyRateHint(hint) {
+    // CONFIGの既定値より短くはしない
+    const next = {
+        MIN_TIME_BETWEEN_UPDATES: Math.max(DEFAULT_INTERVALS.MIN_TIME_BETWEEN_UPDATES, hint.min_update_interval || 0),
+        MAX_TIME_WITHOUT_UPDATE: Math.max(DEFAULT_INTERVALS.MAX_TIME_WITHOUT_UPDATE, hint.max_update_interval || 0),
+        BACKGROUND_UPDATE_INTERVAL: Math.max(DEFAULT_INTERVALS.BACKGROUND_UPDATE_INTERVAL, hint.background_update_interval || 0),
+        CONNECTION_CHECK_INTERVAL: Math.max(DEFAULT_INTERVALS.CONNECTION_CHECK_INTERVAL, hint.ping_interval || 0),
+        MOVEMENT_THRESHOLD: Math.max(DEFAULT_INTERVALS.MOVEMENT_THRESHOLD, hint.movement_threshold || 0),
+    };
+    const pingChanged = next.CONNECTION_CHECK_INTERVAL !== CONFIG.CONNECTION_CHECK_INTERVAL;
+    const backgroundChanged = next.BACKGROUND_UPDATE_INTERVAL !== CONFIG.BACKGROUND_UPDATE_INTERVAL;
+    const updateChanged = next.MIN_TIME_BETWEEN_UPDATES !== CONFIG.MIN_TIME_BETWEEN_UPDATES;
+    Object.assign(CONFIG, next);
+    console.log('送信間隔を変更:', hint.reason, next);
+    
+    // 実行中のタイマーと位置監視を新しい間隔で張り直す
+    if (pingChanged && connectionInterval) {
+        startConnectionManagement();
+    }
+    if (backgroundChanged && backgroundLocationUpdate) {
+        startBackgroundLocationUpdate();
+    }
+    if (updateChanged && watchId) {
+        startLocationTracking();
+    }
+}
+
+// === コンパクト形式フレームの復号 ===
+function decodeCompactFrame(frame) {
+    const [kind, epoch, version, defs, rows, removed] = frame;
+    if (kind === COMPACT_FRAME.SNAPSHOT) {
+        compactParticipants = [];
+    }
+    (defs || []).forEach(([index, id, name]) => {
+        compactParticipants[index] = { id, name };
+    });
+    
+    const locations = (rows || []).map(decodeCompactRow).filter(Boolean);
+    if (kind === COMPACT_FRAME.SNAPSHOT) {
+        return { type: 'location_update', epoch, version, locations };
+    }
+    return {
+        type: 'location_delta',
+        epoch,
+        version,
+        updated: locations,
+        removed: (removed || [])
+            .map(index => compactParticipants[index]?.id)
+            .filter(Boolean)
+    };
+}
+
+function decodeCompactRow(row) {
+    const [index, lat, lon, accuracy, timestamp, flags, altitude, heading, speed] = row;
+    const participant = compactParticipants[index];
+    if (!participant) {
+        // インデックス表にない参加者（定義を受け取っていない）は全体を再取得して解消する
+        if (!resyncRequested) requestLocationResync();
+        return null;
+    }
+    
+    const scaled = (value, scale) => (value == null ? null : value / scale);
+    return {
+        participant_id: participant.id,
+        participant_name: participant.name,
+        latitude: scaled(lat, 1e6),
+        longitude: scaled(lon, 1e6),
+        accuracy: scaled(accuracy, 10),
+        last_updated: new Date(timestamp).toISOString(),
+        is_background: !!(flags & 1),
+        is_online: !!(flags & 2),
+        status: COMPACT_STATUS[(flags >> 2) & 3],
+        altitude: scaled(altitude, 10),
+        heading: scaled(heading, 10),
+        speed: scaled(speed, 10)
+    };
+}
+
+// === 差分（location_delta）の適用 ===
+function applyLocationDelta(data) {
+    if (resyncRequested) return;
+    
+    // epochが変わった、またはバージョンが飛んだ場合は全体を再取得
+    if (locationsEpoch !== null && data.epoch !== locationsEpoch) {
+        requestLocationResync();
+        return;
+    }
+    if (locationsVersion !== null) {
+        if (data.version <= locationsVersion) return; // スナップショットに反映済み
+        if (data.version !== locationsVersion + 1) {
+            requestLocationResync();
+            return;
+        }
+    }
+    locationsEpoch = data.epoch;
+    locationsVersion = data.version;
+    mergeLocations(data.updated, data.removed);
+}
+
+function mergeLocations(updated, removed) {
+    const byId = new Map(participantsData.map(loc => [loc.participant_id, loc]));
+    (removed || []).forEach(id => byId.delete(id));
+    (updated || []).forEach(loc => byId.set(loc.participant_id, loc));
+    const locations = [...byId.values()].sort(
+        (a, b) => new Date(b.last_updated) - new Date(a.last_updated)
+    );
+    
+    if (!largeSessionMode) {
+        detectAndNotifyStateChanges(locations);
+    }
+    updateMapMarkers(locations);
+    updateParticipantsList(locations);
+    participantsData = locations;
+}
+
+// === 大規模セッションの表示範囲購読 ===
+function startViewportSubscription() {
+    if (!mapInitialized) {
+        // 地図の初期化を待つ
+        setTimeout(startViewportSubscription, 500);
+        return;
+    }
+    if (!viewportListenerAttached) {
+        map.on('moveend', () => {
+            clearTimeout(viewportTimeout);
+            viewportTimeout = setTimeout(sendViewport, 300);
+        });
+        viewportListenerAttached = true;
+    }
+    sendViewport();
+}
+
+function sendViewport() {
+    if (!largeSessionMode || !websocket || websocket.readyState !== WebSocket.OPEN) return;
+    websocket.send(JSON.stringify({
+        type: 'viewport',
+        participant_id: participantId,
+        bbox: viewportBbox(map.getBounds())
+    }));
+}
+
+// LeafletのgetBounds()は低ズーム・日付変更線付近で±180度を超えるので、サーバーが受け付ける範囲に直す
+// （日付変更線をまたぐ範囲は west > east で表す）
+function viewportBbox(bounds) {
+    const south = Math.max(-90, bounds.getSouth());
+    const north = Math.min(90, bounds.getNorth());
+    const west = bounds.getWest();
+    const east = bounds.getEast();
+    if (east - west >= 360) {
+        return [south, -180, north, 180];
+    }
+    const wrap = (lng) => ((lng + 180) % 360 + 360) % 360 - 180;
+    const wrappedWest = wrap(west);
+    let wrappedEast = wrap(east);
+    if (wrappedEast === -180 && east > west) {
+        wrappedEast = 180;
+    }
+    return [south, wrappedWest, north, wrappedEast];
+}
+
+function requestLocationResync() {
+    if (!websocket || websocket.readyState !== WebSocket.OPEN) return;
+    resyncRequested = true;
+    websocket.send(JSON.stringify({
+        type: 'resync',
+        participant_id: participantId
+    }));
+}
+
     // === 位置情報共有開始時の通知追加 ===
 // === 位置情報共有開始時の通知削除版 ===
 function startLocationSharing() {
@@ -745,7 +983,8 @@ function startLocationSharing() {
             {
                 enableHighAccuracy: true,
                 timeout: 5000,
-                maximumAge: 1000
+                // 送信間隔が延びている間は端末のキャッシュ位置を使わせて測位を減らす
+                maximumAge: Math.max(1000, CONFIG.MIN_TIME_BETWEEN_UPDATES - 1000)
             }
         );
     }
@@ -1,3 +1,1695 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, channel_layers, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.db import OperationalError, connections
+from django.db.backends.utils import CursorWrapper
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path, reverse
+from django.utils import timezone
+
+from location_share.asgi import application
+
+from . import async_db, codec, metrics, protocol, tracing
+from .admission import (
+    CLOSE_RATE_LIMITED, CLOSE_SERVER_BUSY, CLOSE_SESSION_FULL, AdmissionControl, RateLimiter, client_ip,
+)
+from .async_db import pool
+from .broadcaster import RoomBroadcaster, broadcast_tick
+from .channel_layer import ChannelBroker, UnixSocketChannelLayer
+from .fix_filter import ACCEPT, DEADBAND, INVALID, OUTLIER, FixFilter
+from .consumers import LocationConsumer
+from .history import aiter_track, pending_after, write_points
+from .log import BackgroundHandler
+from .location_buffer import LocationBuffer, RoomState, location_buffer
+from .mail_queue import MailQueue, mail_queue
+from .presence import PresenceTracker
+from .models import LocationSession, LocationData, LocationHistory, LocationHistoryTier, SessionLog
+from .rate_control import compute_rate_hint, hint_changed
+from .reaper import make_reaper
+from .session_cache import SessionMeta, SessionMetaCache, session_cache
+from .session_events import SessionEventLog, session_events
+from .simplify import douglas_peucker, visvalingam
+from .spatial import GridIndex, cells_for_bbox
+from .upsert import upsert_fix
+
+
+@contextmanager
+def count_queries():
+    """全スレッドで実行されたSQLを記録する（コンシューマーはスレッドプールの別接続を使うため）"""
+    queries = []
+    lock = threading.Lock()
+    original = CursorWrapper._execute_with_wrappers
+
+    def execute(self, sql, params, many, executor):
+        with lock:
+            queries.append(sql)
+        return original(self, sql, params, many, executor)
+
+    acquired = pool.acquired
+    CursorWrapper._execute_with_wrappers = execute
+    try:
+        yield queries
+    finally:
+        CursorWrapper._execute_with_wrappers = original
+        # 非同期プール経由のアクセスも1件として数える
+        queries.extend(['async_db'] * (pool.acquired - acquired))
+
+
+class UpsertFixTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        LocationData.objects.create(
+            session=self.session, participant_id='other', participant_name='B',
+            latitude=35.1, longitude=139.1,
+        )
+        LocationData.objects.create(session=self.session, participant_id='gone', is_active=False)
+
+    def fix(self, latitude=35.0):
+        return {'participant_name': 'A', 'latitude': latitude, 'longitude': 139.0, 'accuracy': 5.0}
+
+    def test_single_statement_returns_room(self):
+        with self.assertNumQueries(1):
+            created, records = upsert_fix(self.session.pk, 'me', self.fix(), ip_address='127.0.0.1')
+        self.assertTrue(created)
+        self.assertEqual(sorted(r['participant_id'] for r in records), ['me', 'other'])
+        me = next(r for r in records if r['participant_id'] == 'me')
+        self.assertEqual(me['latitude'], 35.0)
+        self.assertEqual(SessionLog.objects.filter(session=self.session, action='joined').count(), 1)
+
+        created, records = upsert_fix(self.session.pk, 'me', self.fix(35.5))
+        self.assertFalse(created)
+        self.assertEqual(LocationData.objects.get(session=self.session, participant_id='me').latitude, 35.5)
+        self.assertEqual(SessionLog.objects.filter(session=self.session, action='joined').count(), 1)
+
+    def test_expired_session_writes_nothing(self):
+        LocationSession.objects.filter(pk=self.session.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        with self.assertNumQueries(1):
+            self.assertIsNone(upsert_fix(self.session.pk, 'me', self.fix()))
+        self.assertFalse(LocationData.objects.filter(session=self.session, participant_id='me').exists())
+
+
+class UpdateLocationApiTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        self.url = reverse('tracker:api_update_location', args=[self.session.session_id])
+        # セッションのメタデータはキャッシュ済みの状態で計測する
+        session_cache.get(self.session.session_id)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def post(self, latitude, participant_name='A'):
+        # 名前を変えると位置フィルタに捨てられない
+        return self.client.post(self.url, json.dumps({
+            'participant_id': 'me', 'participant_name': participant_name,
+            'latitude': latitude, 'longitude': 139.0, 'accuracy': 5,
+        }), content_type='application/json')
+
+    def test_update_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.post(35.0)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            response = self.post(35.01, 'B')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(float(LocationData.objects.get(session=self.session).latitude), 35.01)
+
+    def test_expired_after_cache(self):
+        LocationSession.objects.filter(pk=self.session.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        with self.assertNumQueries(1):
+            response = self.post(35.0)
+        self.assertEqual(response.status_code, 400)
+
+
+class WebSocketLocationUpdateTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_fixes_are_written_by_one_upsert(self):
+        async def run():
+            communicator = WebsocketCommunicator(application, f'/ws/location/{self.session.session_id}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'join', 'participant_id': 'me', 'participant_name': 'A'})
+            while not await communicator.receive_nothing(0.3):
+                await communicator.receive_output()
+            await location_buffer.aflush()
+            with count_queries() as fixes:
+                for i in range(5):
+                    await communicator.send_json_to({
+                        'type': 'location_update', 'participant_id': 'me', 'participant_name': f'A{i}',
+                        'latitude': 35.0 + i / 100, 'longitude': 139.0, 'accuracy': 5,
+                    })
+                while not await communicator.receive_nothing(0.3):
+                    await communicator.receive_output()
+            with count_queries() as flush:
+                await location_buffer.aflush(self.session.pk)
+            stored = await database_sync_to_async(LocationData.objects.get)(session=self.session, participant_id='me')
+            await communicator.disconnect()
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return fixes, flush, stored
+
+        fixes, flush, stored = asyncio.run(run())
+        # 参加ログは書き込みスレッドがまとめて書くので、計測中に定期書き込みが入ることがある
+        fixes = [sql for sql in fixes if SessionLog._meta.db_table not in sql]
+        self.assertEqual(fixes, [])
+        table = LocationData._meta.db_table
+        upserts = [sql for sql in flush if table in sql]
+        self.assertEqual(len(upserts), 1)
+        self.assertIn('ON CONFLICT', upserts[0])
+        self.assertEqual((float(stored.latitude), stored.participant_name), (35.04, 'A4'))
+
+
+class SessionEventLogTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        # 書き込みスレッドに先に書かせない
+        self.events = SessionEventLog(batch_size=100, flush_interval=60, max_queue=5,
+                                      sample_rates={'location_updated': 0.0})
+
+    def test_events_are_written_in_one_insert(self):
+        with self.assertNumQueries(0):
+            self.events.record(self.session.pk, 'websocket_connected', connection_id='c1')
+            self.events.record(self.session.pk, 'joined', 'me', connection_id='c1')
+            self.events.record(self.session.pk, 'location_updated', 'me')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.events.flush(), 2)
+        self.assertEqual(
+            sorted(SessionLog.objects.filter(session=self.session).values_list('action', flat=True)),
+            ['joined', 'websocket_connected'],
+        )
+        self.assertEqual(self.events.stats()['sampled_out'], 1)
+
+    def test_overflow_is_dropped(self):
+        for _ in range(8):
+            self.events.record(self.session.pk, 'joined', 'me')
+        self.assertEqual(self.events.stats()['dropped'], 3)
+        self.assertEqual(self.events.flush(), 5)
+
+
+class FlakyEmailBackend(LocmemEmailBackend):
+    """最初の failures 回の送信で失敗する locmem バックエンド（fail_subject を指定するとその件名だけ）"""
+    failures = 0
+    fail_subject = None
+
+    def send_messages(self, messages):
+        targeted = FlakyEmailBackend.fail_subject in (None, messages[0].subject)
+        if targeted and FlakyEmailBackend.failures > 0:
+            FlakyEmailBackend.failures -= 1
+            raise ConnectionError('SMTP unavailable')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class ContactMailTests(TestCase):
+    def setUp(self):
+        mail.outbox = []
+
+    def post_contact(self):
+        return self.client.post(reverse('tracker:contact'), {
+            'name': 'テスト',
+            'email': 'user@example.com',
+            'subject_category': 'bug',
+            'subject': '地図',
+            'message': '表示されません',
+        }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_contact_queues_mail_and_returns(self):
+        response = self.post_contact()
+        self.assertTrue(response.json()['success'])
+        mail_queue.flush()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['hujisimariku33@gmail.com', 'user@example.com'])
+        self.assertEqual(mail_queue.stats()['queued'], 0)
+
+    def test_full_queue_rejects_contact(self):
+        with mock.patch.object(mail_queue, 'max_size', 0):
+            response = self.post_contact()
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(mail.outbox, [])
+
+
+@override_settings(EMAIL_BACKEND='tracker.tests.FlakyEmailBackend')
+class MailQueueRetryTests(TestCase):
+    def setUp(self):
+        mail.outbox = []
+        self.queue = MailQueue(max_attempts=3, retry_delay=60)
+
+    def messages(self):
+        return [EmailMessage('admin', 'body', to=['admin@example.com']),
+                EmailMessage('reply', 'body', to=['user@example.com'])]
+
+    def tearDown(self):
+        FlakyEmailBackend.failures = 0
+        FlakyEmailBackend.fail_subject = None
+
+    def test_failed_job_is_retried_without_resending(self):
+        # 管理者宛ては送れて自動返信だけ失敗した場合、再送は自動返信だけ
+        FlakyEmailBackend.failures = 1
+        FlakyEmailBackend.fail_subject = 'reply'
+        self.queue.enqueue(self.messages())
+        self.queue.flush()
+        self.queue.flush()
+        self.assertEqual([m.subject for m in mail.outbox], ['admin', 'reply'])
+        self.assertEqual(self.queue.stats()['failed_attempts'], 1)
+        self.assertEqual(self.queue.stats()['queued'], 0)
+
+    def test_job_is_abandoned_after_max_attempts(self):
+        FlakyEmailBackend.failures = 10
+        self.queue.enqueue(self.messages())
+        for _ in range(4):
+            self.queue.flush()
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(self.queue.stats()['gave_up'], 1)
+        self.assertEqual(self.queue.stats()['queued'], 0)
+
+
+class SessionReaperTests(TestCase):
+    def setUp(self):
+        for _ in range(2):
+            LocationSession.objects.create(duration_minutes=30, expires_at=timezone.now() - timedelta(days=2))
+
+    def test_partitions_are_kept_when_run_stops_early(self):
+        with mock.patch('tracker.reaper.drop_partitions_before', return_value=0) as drop:
+            stats = make_reaper(batch_size=1, pause=0).run(max_batches=1)
+        self.assertEqual(stats['sessions'], 1)
+        drop.assert_not_called()
+        with mock.patch('tracker.reaper.drop_partitions_before', return_value=0) as drop:
+            stats = make_reaper(batch_size=1, pause=0).run()
+        self.assertEqual(stats['sessions'], 1)
+        drop.assert_called_once()
+
+
+class CompactDeltaTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = LocationBuffer()
+        self.buffer._rooms[1] = RoomState({})
+
+    def defs(self, participant_id):
+        return self.buffer.delta(1, [participant_id])['compact'][3]
+
+    def test_rejoined_participant_is_redefined(self):
+        self.buffer.apply(1, 'p', {'participant_name': 'P', 'is_active': True})
+        self.assertEqual(self.defs('p'), [[0, 'p', 'P']])
+        self.buffer.apply(1, 'p', {'participant_name': 'P', 'is_active': True})
+        self.assertEqual(self.defs('p'), [])
+        # 退出中に参加したクライアントのスナップショットにはpの定義がない
+        self.buffer.apply(1, 'p', {'is_active': False})
+        self.assertEqual(self.defs('p'), [])
+        self.buffer.apply(1, 'p', {'participant_name': 'P', 'is_active': True})
+        self.assertEqual(self.defs('p'), [[0, 'p', 'P']])
+
+
+class TrackApiTests(TestCase):
+    def setUp(self):
+        session = LocationSession.objects.create(duration_minutes=30)
+        self.url = reverse('tracker:api_get_track', args=[session.session_id, 'p'])
+
+    def test_out_of_range_parameters_are_rejected(self):
+        for params in ({'zoom': '-1'}, {'max_points': '0'}, {'max_points': '-5', 'simplify': 'vw'}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400, params)
+        self.assertEqual(self.client.get(self.url, {'zoom': '0', 'max_points': '1'}).status_code, 200)
+
+
+class ClientIpTests(SimpleTestCase):
+    def scope(self, client, forwarded):
+        return {'client': (client, 50000), 'headers': [(b'x-forwarded-for', forwarded.encode())]}
+
+    def test_forwarded_for_is_ignored_from_untrusted_peers(self):
+        self.assertEqual(client_ip(self.scope('203.0.113.5', '198.51.100.1')), '203.0.113.5')
+
+    def test_forwarded_for_is_used_behind_trusted_proxy(self):
+        # 先頭はクライアントが自由に書けるので、プロキシが付けた右端から数える
+        self.assertEqual(client_ip(self.scope('127.0.0.1', '198.51.100.1, 203.0.113.5')), '203.0.113.5')
+
+
+class SharedRoomTests(SimpleTestCase):
+    """2つのワーカー（UnixSocketChannelLayer）から1つのルームに変更を送る"""
+
+    def test_versions_and_snapshot_are_shared_across_workers(self):
+        async def scenario(path):
+            broker = ChannelBroker()
+            server = await asyncio.start_unix_server(broker.handle_worker, path=path)
+            workers = [UnixSocketChannelLayer(path=path), UnixSocketChannelLayer(path=path)]
+            try:
+                channels = [await layer.new_channel() for layer in workers]
+                # 各ワーカーは最初の接続で初期状態を送る（2つ目は無視される）
+                for layer, channel in zip(workers, channels):
+                    await layer.group_add('location_x', channel)
+                    await layer.room_seed('location_x', [])
+                    # 応答が返れば、それまでに送ったフレームはブローカーで処理済み
+                    await layer.room_snapshot('location_x')
+                now = timezone.now().isoformat()
+                for i, layer in enumerate(workers * 2):
+                    await layer.room_delta('location_x', [[f'p{i % 2}', {
+                        'participant_name': f'P{i % 2}', 'latitude': 35.0 + i, 'longitude': 139.0,
+                        'is_active': True, 'last_updated': now,
+                    }]])
+                frames = []
+                for layer, channel in zip(workers, channels):
+                    for _ in range(4):
+                        message = await asyncio.wait_for(layer.receive(channel), 5)
+                        frames.append((layer.worker_id, message['origin'], json.loads(message['frame'])))
+                snapshot = json.loads(await workers[0].room_snapshot('location_x'))
+                return frames, snapshot
+            finally:
+                for layer in workers:
+                    await layer.close()
+                while broker.workers:
+                    await asyncio.sleep(0.01)
+                server.close()
+                await server.wait_closed()
+
+        with tempfile.TemporaryDirectory() as directory:
+            frames, snapshot = asyncio.run(scenario(os.path.join(directory, 'broker.sock')))
+        # どちらのワーカーの接続にも、同じエポックの連続したバージョンが届く
+        self.assertEqual(len({frame['epoch'] for _, _, frame in frames}), 1)
+        for worker_id in {worker_id for worker_id, _, _ in frames}:
+            versions = [frame['version'] for w, _, frame in frames if w == worker_id]
+            self.assertEqual(versions, [1, 2, 3, 4])
+        # ワーカー0のスナップショットにワーカー1が送った変更が入っている
+        self.assertEqual(snapshot['version'], 4)
+        latitudes = {loc['participant_id']: loc['latitude'] for loc in snapshot['locations']}
+        self.assertEqual(latitudes, {'p0': 37.0, 'p1': 38.0})
+
+
+class SecondWorkerConsumer(LocationConsumer):
+    channel_layer_alias = 'second_worker'
+
+
+class SharedRoomConsumerTests(TransactionTestCase):
+    """別々のワーカー（チャネルレイヤー）に接続したクライアントが同じルームの差分を受け取る"""
+
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        self.directory = tempfile.TemporaryDirectory()
+        config = {
+            'BACKEND': 'tracker.channel_layer.UnixSocketChannelLayer',
+            'CONFIG': {'path': os.path.join(self.directory.name, 'broker.sock')},
+        }
+        self.layers = override_settings(CHANNEL_LAYERS={'default': config, 'second_worker': config})
+        self.layers.enable()
+
+    def tearDown(self):
+        self.layers.disable()
+        self.directory.cleanup()
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_clients_on_two_workers_share_epoch_and_versions(self):
+        url = f'/ws/location/{self.session.session_id}/'
+
+        async def drain(communicator, frames):
+            while not await communicator.receive_nothing(0.3):
+                frames.append(json.loads(await communicator.receive_from()))
+
+        async def run():
+            broker = ChannelBroker()
+            server = await asyncio.start_unix_server(
+                broker.handle_worker, path=os.path.join(self.directory.name, 'broker.sock')
+            )
+            clients = {}
+            frames = {'a': [], 'b': []}
+            for name, consumer in (('a', LocationConsumer), ('b', SecondWorkerConsumer)):
+                clients[name] = WebsocketCommunicator(URLRouter([
+                    path('ws/location/<str:session_id>/', consumer.as_asgi()),
+                ]), url)
+                connected, _ = await clients[name].connect()
+                self.assertTrue(connected)
+                await clients[name].send_json_to({
+                    'type': 'join', 'participant_id': name, 'participant_name': name.upper(),
+                    'supports_delta': True,
+                })
+                await drain(clients[name], frames[name])
+            for latitude, (name, client) in zip((35.0, 36.0), clients.items()):
+                await client.send_json_to({
+                    'type': 'location_update', 'participant_id': name, 'participant_name': name.upper(),
+                    'latitude': latitude, 'longitude': 139.0, 'accuracy': 5,
+                })
+            for name, client in clients.items():
+                await drain(client, frames[name])
+            # ワーカーaに接続したクライアントの再同期にワーカーbでの変更が入っている
+            await clients['a'].send_json_to({'type': 'resync'})
+            await drain(clients['a'], frames['a'])
+            for client in clients.values():
+                await client.disconnect()
+            await location_buffer.aflush(self.session.pk)
+            for alias in ('default', 'second_worker'):
+                await channel_layers[alias].close()
+            server.close()
+            await server.wait_closed()
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return frames
+
+        frames = asyncio.run(run())
+        epochs = {frame['epoch'] for name in frames for frame in frames[name] if 'epoch' in frame}
+        self.assertEqual(len(epochs), 1)
+        for name in frames:
+            synced = [f for f in frames[name] if f['type'] in ('location_update', 'location_delta')]
+            self.assertEqual(synced[0]['type'], 'location_update')
+            # スナップショット以前の差分はクライアントが読み飛ばす。それ以降は欠けずに続く
+            current = synced[0]['version']
+            for frame in synced[1:]:
+                if frame['type'] == 'location_delta' and frame['version'] > current:
+                    self.assertEqual(frame['version'], current + 1)
+                    current = frame['version']
+            self.assertEqual(current, max(f['version'] for n in frames for f in frames[n] if 'version' in f))
+        resync = frames['a'][-1]
+        self.assertEqual(resync['type'], 'location_update')
+        latitudes = {loc['participant_id']: loc['latitude'] for loc in resync['locations']}
+        self.assertEqual(latitudes, {'a': 35.0, 'b': 36.0})
+
+
+class SpatialTests(SimpleTestCase):
+    def test_cells_for_bbox(self):
+        self.assertEqual(cells_for_bbox([0.0, 0.0, 0.15, 0.25], 0.1), {(x, y) for x in range(3) for y in range(2)})
+        # 日付変更線をまたぐ範囲は west > east
+        self.assertEqual(cells_for_bbox([0.0, 179.95, 0.05, -179.95], 0.1), {(1799, 0), (1800, 0), (-1800, 0)})
+        # セルが多すぎる場合はルーム全体の購読に切り替える
+        self.assertIsNone(cells_for_bbox([0.0, 0.0, 1.0, 1.0], 0.1, limit=100))
+        self.assertEqual(len(cells_for_bbox([0.0, 0.0, 0.95, 0.95], 0.1, limit=100)), 100)
+
+    def test_grid_index_moves_participants_between_cells(self):
+        grid = GridIndex(0.1)
+        self.assertIsNone(grid.move('a', (0, 0)))
+        grid.move('b', (0, 0))
+        self.assertEqual(grid.move('a', (1, 0)), (0, 0))
+        self.assertEqual(grid.participants_in([(0, 0)]), {'b'})
+        self.assertEqual(grid.participants_in([(0, 0), (1, 0)]), {'a', 'b'})
+        grid.move('b', None)
+        self.assertNotIn((0, 0), grid.cells)
+
+    def test_cell_deltas_split_moves_into_removed_and_updated(self):
+        buffer = LocationBuffer()
+        buffer._rooms[1] = RoomState({})
+        buffer.apply(1, 'a', {'latitude': 0.05, 'longitude': 0.05, 'is_active': True})
+        buffer.apply(1, 'b', {'latitude': 0.05, 'longitude': 0.15, 'is_active': True})
+        cells = buffer.cell_deltas(1, ['a', 'b'], 0.1)
+        self.assertEqual({cell: [r['participant_id'] for r in d['updated']] for cell, d in cells.items()},
+                         {(0, 0): ['a'], (1, 0): ['b']})
+        # aが(1, 0)へ移動し、bが退出した
+        buffer.apply(1, 'a', {'latitude': 0.05, 'longitude': 0.15})
+        buffer.apply(1, 'b', {'is_active': False})
+        cells = buffer.cell_deltas(1, ['a', 'b'], 0.1)
+        self.assertEqual(cells[(0, 0)], {'updated': [], 'removed': ['a']})
+        self.assertEqual([r['participant_id'] for r in cells[(1, 0)]['updated']], ['a'])
+        self.assertEqual(cells[(1, 0)]['removed'], ['b'])
+        self.assertEqual(buffer.viewport_snapshot(1, {(0, 0)}, 0.1), [])
+
+
+class LargeSessionViewportTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30, max_participants=500)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_room_snapshot_is_sent_until_a_viewport_is_accepted(self):
+        async def receive_all(communicator):
+            frames = []
+            while not await communicator.receive_nothing(0.3):
+                frames.append(json.loads(await communicator.receive_from()))
+            return frames
+
+        async def run():
+            communicator = WebsocketCommunicator(application, f'/ws/location/{self.session.session_id}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({
+                'type': 'join', 'participant_id': 'me', 'participant_name': 'A', 'supports_viewport': True,
+            })
+            joined = await receive_all(communicator)
+            # ±180度を超えるbboxは拒否されるが、参加時のスナップショットで地図は埋まっている
+            await communicator.send_json_to({'type': 'viewport', 'participant_id': 'me', 'bbox': [0, -200, 10, 200]})
+            rejected = await receive_all(communicator)
+            await communicator.send_json_to({'type': 'viewport', 'participant_id': 'me', 'bbox': [35, 139, 35.1, 139.1]})
+            accepted = await receive_all(communicator)
+            await communicator.disconnect()
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return joined, rejected, accepted
+
+        joined, rejected, accepted = asyncio.run(run())
+        self.assertIn('session_mode', [f['type'] for f in joined])
+        self.assertIn('location_update', [f['type'] for f in joined])
+        self.assertEqual([f['type'] for f in rejected], ['error'])
+        self.assertIn('viewport_snapshot', [f['type'] for f in accepted])
+
+
+class LocationFlushTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        self.buffer = LocationBuffer()
+
+    def put(self, session, participant_id, **fields):
+        self.buffer.put_fix(session.pk, participant_id, {
+            'participant_name': participant_id, 'latitude': 35.0, 'longitude': 139.0, **fields,
+        })
+
+    def test_fixes_are_coalesced_and_written_with_buffered_timestamp(self):
+        self.put(self.session, 'a', latitude=35.0)
+        self.put(self.session, 'a', latitude=35.5)
+        buffered = timezone.now() - timedelta(minutes=1)
+        self.buffer._pending[(self.session.pk, 'a')]['last_updated'] = buffered
+        self.buffer.flush()
+        stored = LocationData.objects.get(session=self.session, participant_id='a')
+        self.assertEqual((float(stored.latitude), stored.last_updated), (35.5, buffered))
+        self.assertEqual((self.buffer.coalesced_fixes, self.buffer.flushed_rows), (1, 1))
+        self.assertFalse(self.buffer._pending)
+
+    def test_rows_of_deleted_session_do_not_block_others(self):
+        deleted = LocationSession.objects.create(duration_minutes=30)
+        self.put(self.session, 'a')
+        self.put(deleted, 'b')
+        deleted.delete()
+        self.buffer.flush()
+        self.assertTrue(LocationData.objects.filter(session=self.session, participant_id='a').exists())
+        self.assertEqual((self.buffer.flushed_rows, self.buffer.dropped_rows), (1, 1))
+        self.assertFalse(self.buffer._pending)
+
+    def test_unwritable_row_is_dropped_and_the_rest_written(self):
+        self.put(self.session, 'a')
+        self.put(self.session, 'b', participant_name='x' * 500)
+        self.buffer.flush()
+        self.assertEqual(
+            list(LocationData.objects.filter(session=self.session).values_list('participant_id', flat=True)), ['a']
+        )
+        self.assertEqual(self.buffer.dropped_rows, 1)
+        self.assertFalse(self.buffer._pending)
+
+    def test_failed_rows_are_retried_on_next_flush(self):
+        self.put(self.session, 'a')
+        with mock.patch.object(self.buffer, '_write_locations', side_effect=OperationalError('down')):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.assertIn((self.session.pk, 'a'), self.buffer._pending)
+        self.buffer.flush()
+        self.assertTrue(LocationData.objects.filter(session=self.session, participant_id='a').exists())
+
+
+class FlushOnDisconnectTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_pending_fix_is_written_when_last_connection_closes(self):
+        async def run():
+            communicator = WebsocketCommunicator(application, f'/ws/location/{self.session.session_id}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'join', 'participant_id': 'me', 'participant_name': 'A'})
+            await communicator.send_json_to({
+                'type': 'location_update', 'participant_id': 'me', 'participant_name': 'Renamed',
+                'latitude': 35.0, 'longitude': 139.0, 'accuracy': 5,
+            })
+            while not await communicator.receive_nothing(0.3):
+                await communicator.receive_output()
+            self.assertIn((self.session.pk, 'me'), location_buffer._pending)
+            await communicator.disconnect()
+            stored = await database_sync_to_async(LocationData.objects.get)(session=self.session, participant_id='me')
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return stored
+
+        stored = asyncio.run(run())
+        self.assertNotIn((self.session.pk, 'me'), location_buffer._pending)
+        self.assertEqual((stored.participant_name, stored.is_online), ('Renamed', False))
+
+
+class TrackStreamTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        self.url = reverse('tracker:api_get_track', args=[self.session.session_id, 'p'])
+        self.start = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=5)
+
+    def tearDown(self):
+        location_buffer.forget_session(self.session.pk)
+
+    def point(self, seconds, latitude):
+        return (self.session.pk, 'p', {
+            'ts': self.start + timedelta(seconds=seconds), 'latitude': latitude, 'longitude': 139.0,
+            'accuracy': None, 'speed': None, 'heading': None,
+        })
+
+    def test_buffered_points_follow_stored_track_without_flushing(self):
+        write_points([self.point(0, 35.0), self.point(1, 35.1)])
+        location_buffer._history += [self.point(2, 35.2), self.point(3, 35.3)]
+        response = self.client.get(self.url)
+        self.assertTrue(response.is_async)
+        body = json.loads(b''.join(response))
+        self.assertEqual([p[1] for p in body['points']], [35.0, 35.1, 35.2, 35.3])
+        # GETではDBへ書き込まない
+        self.assertEqual(len(location_buffer.pending_track(self.session.pk, 'p')), 2)
+        self.assertEqual(LocationHistory.objects.filter(session=self.session).count(), 2)
+
+    def test_track_is_read_in_keyset_pages(self):
+        # 同じ時刻の点があってもページの境目で重複・欠落しない
+        write_points([self.point(0, 35.0), self.point(1, 35.1), self.point(1, 35.2), self.point(2, 35.3)])
+
+        async def read():
+            return [p async for p in aiter_track(self.session.pk, 'p', chunk_size=1)]
+
+        self.assertEqual(sorted(p[1] for p in async_to_sync(read)()), [35.0, 35.1, 35.2, 35.3])
+
+    def test_buffered_points_keep_one_point_per_tier_bucket(self):
+        stored = [self.point(0, 35.0)[2]['ts']]
+        pending = [tuple(self.point(s, 35.0 + s / 100)[2].values()) for s in (5, 12, 18, 25)]
+        # DBの最後の点と同じバケット（0-9秒）の点は除き、以降はバケットごとに最後の点
+        self.assertEqual([p[0] for p in pending_after(pending, stored[-1], '10s')],
+                         [pending[2][0], pending[3][0]])
+        self.assertEqual(pending_after(pending, stored[-1], 'raw'), pending)
+
+
+class TracingTests(SimpleTestCase):
+    def run_message(self, elapsed):
+        token = tracing.begin()
+        with tracing.span('load'):
+            tracing.count_query()
+            tracing.count_query()
+        tracing.count_query()
+        tracing.finish(token, 'session', 'location_update', elapsed)
+        return token
+
+    def test_sampled_slow_message_is_logged_with_breakdown(self):
+        with mock.patch.object(tracing, 'SAMPLE_RATE', 1.0), self.assertLogs('tracker.slow', 'WARNING') as logs:
+            self.run_message(tracing.SLOW_MESSAGE_THRESHOLD + 0.1)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['type'], record['traced'], record['queries']), ('location_update', True, 3))
+        self.assertEqual(record['breakdown']['load']['calls'], 1)
+        self.assertEqual(record['breakdown']['load']['queries'], 2)
+        self.assertEqual(record['breakdown']['(other)']['queries'], 1)
+        self.assertIsNone(tracing._trace.get())
+
+    def test_unsampled_messages_are_logged_only_when_slow(self):
+        with mock.patch.object(tracing, 'SAMPLE_RATE', 0.0):
+            with self.assertNoLogs('tracker.slow', 'WARNING'):
+                self.assertIsNone(self.run_message(0.0))
+            with self.assertLogs('tracker.slow', 'WARNING') as logs:
+                self.run_message(tracing.SLOW_MESSAGE_THRESHOLD)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertFalse(record['traced'])
+        self.assertNotIn('breakdown', record)
+
+
+class RecordingHandler(logging.Handler):
+    """BackgroundHandler のテスト用: 受け取ったレコードと書き出したスレッドを記録する"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((threading.current_thread(), record.msg, record.args, self.format(record)))
+
+
+class BackgroundHandlerTests(SimpleTestCase):
+    def test_records_are_formatted_and_written_by_listener_thread(self):
+        handler = BackgroundHandler(target='tracker.tests.RecordingHandler')
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger = logging.getLogger('tracker.tests.background')
+        logger.addHandler(handler)
+        try:
+            logger.warning('slow %s', 'message')
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        [(thread, msg, args, formatted)] = handler.target.records
+        self.assertIsNot(thread, threading.current_thread())
+        # 呼び出し側では書式化せず、メッセージと引数のまま渡す
+        self.assertEqual((msg, args), ('slow %s', ('message',)))
+        self.assertEqual(formatted, 'WARNING slow message')
+
+
+class RoomVersionTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = LocationBuffer()
+        self.buffer._rooms[1] = RoomState({})
+
+    def snapshot(self):
+        return json.loads(self.buffer.snapshot_frame(1))
+
+    def test_deltas_continue_the_snapshot_version(self):
+        self.buffer.apply(1, 'p', {'participant_name': 'P', 'latitude': 35.0, 'longitude': 139.0, 'is_active': True})
+        snapshot = self.snapshot()
+        first = self.buffer.delta(1, ['p'])
+        second = self.buffer.delta(1, ['p'])
+        self.assertEqual((first['epoch'], first['version']), (snapshot['epoch'], snapshot['version'] + 1))
+        self.assertEqual(second['version'], first['version'] + 1)
+        # 差分の後のスナップショットは最新のバージョンを持つ
+        self.assertEqual(self.snapshot()['version'], second['version'])
+
+    def test_reloaded_room_has_new_epoch(self):
+        epoch = self.snapshot()['epoch']
+        self.buffer._rooms[1] = RoomState({})
+        self.assertNotEqual(self.snapshot()['epoch'], epoch)
+        self.assertEqual(self.snapshot()['version'], 0)
+
+
+class HttpBroadcastVersionTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_http_update_carries_epoch_and_version(self):
+        url = reverse('tracker:api_update_location', args=[self.session.session_id])
+
+        async def receive_all(communicator):
+            frames = []
+            while not await communicator.receive_nothing(0.3):
+                frames.append(json.loads(await communicator.receive_from()))
+            return frames
+
+        async def run():
+            communicator = WebsocketCommunicator(application, f'/ws/location/{self.session.session_id}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({
+                'type': 'join', 'participant_id': 'ws', 'participant_name': 'W', 'supports_delta': True,
+            })
+            joined = await receive_all(communicator)
+            response = await sync_to_async(self.client.post)(url, json.dumps({
+                'participant_id': 'http', 'participant_name': 'H',
+                'latitude': 35.0, 'longitude': 139.0, 'accuracy': 5,
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            broadcast = await receive_all(communicator)
+            # 欠落を検出したクライアントの再同期は同じエポック・バージョンのスナップショットを返す
+            await communicator.send_json_to({'type': 'resync', 'participant_id': 'ws'})
+            resync = await receive_all(communicator)
+            await communicator.disconnect()
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return joined, broadcast, resync
+
+        joined, broadcast, resync = asyncio.run(run())
+        snapshot = [f for f in joined if f['type'] == 'location_update'][-1]
+        updates = [f for f in broadcast if f['type'] == 'location_update']
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]['epoch'], snapshot['epoch'])
+        self.assertIsInstance(updates[0]['version'], int)
+        self.assertIn('http', [loc['participant_id'] for loc in updates[0]['locations']])
+        self.assertEqual(
+            [(f['epoch'], f['version']) for f in resync if f['type'] == 'location_update'],
+            [(updates[0]['epoch'], updates[0]['version'])]
+        )
+
+
+class RateHintTests(SimpleTestCase):
+    def hint(self, room_size=1, **kwargs):
+        return compute_rate_hint(room_size, connections=1, lag=0.0, **kwargs)
+
+    def test_interval_grows_with_room_size(self):
+        small, large = self.hint(), self.hint(room_size=400)
+        self.assertEqual(small['min_update_interval'], 3000)
+        self.assertEqual(large['min_update_interval'], 20000)
+        self.assertEqual(large['reason'], 'room_size')
+        self.assertGreater(large['movement_threshold'], small['movement_threshold'])
+
+    def test_stationary_has_hysteresis(self):
+        moving = self.hint(speed=2.0)
+        self.assertFalse(moving['stationary'])
+        stopped = self.hint(speed=0.4, previous=moving)
+        self.assertTrue(stopped['stationary'])
+        self.assertEqual(stopped['min_update_interval'], 2 * moving['min_update_interval'])
+        # 0.5m/s前後を行き来しても止まっている判定のまま
+        hint = stopped
+        for speed in (0.6, 0.45, 0.9, 0.55):
+            hint = self.hint(speed=speed, previous=hint)
+            self.assertTrue(hint['stationary'])
+            self.assertFalse(hint_changed(stopped, hint))
+        self.assertFalse(self.hint(speed=1.2, previous=hint)['stationary'])
+        # 速度が分からない間は前回の判定を引き継ぐ
+        self.assertTrue(self.hint(previous=stopped)['stationary'])
+
+    def test_hint_changed_ignores_small_changes(self):
+        previous = self.hint()
+        self.assertTrue(hint_changed(None, previous))
+        self.assertFalse(hint_changed(previous, dict(previous, min_update_interval=3500)))
+        self.assertTrue(hint_changed(previous, dict(previous, min_update_interval=4000)))
+        self.assertTrue(hint_changed(previous, dict(previous, ping_interval=previous['ping_interval'] * 2)))
+
+
+class MetricsTests(TestCase):
+    SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*"(?:,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*")*\})? (\S+)$')
+
+    def parse(self, text):
+        """テキスト形式を検証し、{メトリクス名: 型} を返す"""
+        helps, types, samples = [], {}, []
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                helps.append(line.split(' ', 3)[2])
+            elif line.startswith('# TYPE '):
+                _, _, name, kind = line.split(' ')
+                self.assertNotIn(name, types)
+                self.assertIn(kind, ('counter', 'gauge', 'histogram'))
+                types[name] = kind
+            else:
+                match = self.SAMPLE.match(line)
+                self.assertIsNotNone(match, line)
+                float(match.group(3))
+                name = match.group(1)
+                if name not in types:
+                    name = re.sub(r'_(bucket|sum|count)$', '', name)
+                    self.assertEqual(types.get(name), 'histogram', line)
+                samples.append(name)
+        self.assertEqual(len(helps), len(set(helps)))
+        self.assertEqual(set(helps), set(types))
+        self.assertTrue(set(samples) <= set(types))
+        return types
+
+    def test_metrics_text_format(self):
+        metrics.ws_handler_seconds.observe(0.01, 'ping')
+        metrics.group_sends.inc('location_broadcast')
+        response = self.client.get(reverse('tracker:metrics'))
+        self.assertEqual(response.status_code, 200)
+        types = self.parse(response.content.decode())
+        self.assertEqual(types['tracker_ws_handler_seconds'], 'histogram')
+        self.assertEqual(types['tracker_sync_executor_queue_depth'], 'gauge')
+        self.assertIn('tracker_location_buffer_dropped_rows', types)
+
+    def test_executor_queue_depth_returns_to_zero(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+
+        async def run():
+            first = asyncio.ensure_future(metrics.database_sync(blocking)())
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            # 1件目の実行中に送った呼び出しは実行を待っている
+            second = asyncio.ensure_future(metrics.database_sync(lambda: None)())
+            await asyncio.sleep(0.05)
+            queued = metrics.executor_queue.value
+            release.set()
+            await asyncio.gather(first, second)
+            return queued
+
+        depth = metrics.executor_queue.value
+        self.assertEqual(asyncio.run(run()), depth + 1)
+        self.assertEqual(metrics.executor_queue.value, depth)
+
+
+class ChannelBrokerTests(SimpleTestCase):
+    """ChannelBrokerとUnixSocketChannelLayerのグループ・ルームの配送"""
+
+    def run_workers(self, scenario, count=2):
+        async def run(path):
+            broker = ChannelBroker()
+            server = await asyncio.start_unix_server(broker.handle_worker, path=path)
+            workers = [UnixSocketChannelLayer(path=path) for _ in range(count)]
+            try:
+                return await scenario(broker, workers)
+            finally:
+                for layer in workers:
+                    await layer.close()
+                while broker.workers:
+                    await asyncio.sleep(0.01)
+                server.close()
+                await server.wait_closed()
+
+        with tempfile.TemporaryDirectory() as directory:
+            return asyncio.run(run(os.path.join(directory, 'broker.sock')))
+
+    def test_socket_is_restricted_when_bound(self):
+        async def run(path):
+            broker = ChannelBroker()
+            # chmodしなくてもbindの時点で0o660になっている
+            with mock.patch('tracker.channel_layer.os.chmod'):
+                task = asyncio.ensure_future(broker.serve(path))
+                while not os.path.exists(path):
+                    await asyncio.sleep(0.01)
+            mode = os.stat(path).st_mode & 0o777
+            task.cancel()
+            return mode
+
+        umask = os.umask(0o022)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                mode = asyncio.run(run(os.path.join(directory, 'broker.sock')))
+            self.assertEqual(os.umask(0o022), 0o022)
+        finally:
+            os.umask(umask)
+        self.assertEqual(mode, 0o660)
+
+    def test_group_send_fans_out_to_members_of_all_workers(self):
+        async def scenario(broker, workers):
+            first, second = workers
+            channels = [await first.new_channel(), await first.new_channel(), await second.new_channel()]
+            outsider = await second.new_channel()
+            layers = [first, first, second]
+            for layer, channel in zip(layers, channels):
+                await layer.group_add('room', channel)
+            # 応答が返れば、それまでに送ったフレームはブローカーで処理済み
+            await second.room_snapshot('room')
+            await first.group_send('room', {'type': 'hello'})
+            received = [
+                (await asyncio.wait_for(layer.receive(channel), 5))['type']
+                for layer, channel in zip(layers, channels)
+            ]
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(outsider), 0.2)
+            await second.group_discard('room', channels[2])
+            await second.room_snapshot('room')
+            await first.group_send('room', {'type': 'again'})
+            again = [(await asyncio.wait_for(first.receive(c), 5))['type'] for c in channels[:2]]
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(channels[2]), 0.2)
+            return received, again
+
+        received, again = self.run_workers(scenario)
+        self.assertEqual(received, ['hello'] * 3)
+        self.assertEqual(again, ['again'] * 2)
+
+    def test_messages_keep_their_order(self):
+        async def scenario(broker, workers):
+            first, second = workers
+            channel = await second.new_channel()
+            await second.group_add('room', channel)
+            await second.room_snapshot('room')
+            for i in range(50):
+                if i % 2:
+                    await first.group_send('room', {'type': 'm', 'i': i})
+                else:
+                    await first.send(channel, {'type': 'm', 'i': i})
+            return [(await asyncio.wait_for(second.receive(channel), 5))['i'] for _ in range(50)]
+
+        self.assertEqual(self.run_workers(scenario), list(range(50)))
+
+    def test_room_exists_only_while_the_group_has_members(self):
+        record = {
+            'participant_id': 'p', 'participant_name': 'P', 'latitude': 35.0, 'longitude': 139.0,
+            'accuracy': 5, 'is_background': False, 'is_active': True,
+            'last_updated': timezone.now().isoformat(),
+        }
+
+        async def scenario(broker, workers):
+            layer, = workers
+            channel = await layer.new_channel()
+            # メンバーのいないグループにはルームを作らない
+            await layer.room_seed('room', [record])
+            before = await layer.room_snapshot('room')
+            await layer.group_add('room', channel)
+            await layer.room_seed('room', [record])
+            await layer.room_delta('room', [['q', {'participant_name': 'Q', 'is_active': True}]])
+            delta = await asyncio.wait_for(layer.receive(channel), 5)
+            snapshot = json.loads(await layer.room_snapshot('room'))
+            await layer.group_discard('room', channel)
+            after = await layer.room_snapshot('room')
+            return before, delta, snapshot, after
+
+        before, delta, snapshot, after = self.run_workers(scenario, count=1)
+        self.assertIsNone(before)
+        self.assertEqual(json.loads(delta['frame'])['version'], 1)
+        self.assertEqual(delta['changes'], [['q', {'participant_name': 'Q', 'is_active': True}]])
+        self.assertEqual(snapshot['version'], 1)
+        self.assertEqual({loc['participant_id'] for loc in snapshot['locations']}, {'p', 'q'})
+        self.assertIsNone(after)
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_null_fields_are_dropped(self):
+        data, error = protocol.parse(json.dumps({
+            'type': 'join', 'participant_id': 'me', 'participant_name': None, 'supports_delta': None,
+        }))
+        self.assertIsNone(error)
+        self.assertEqual(data, {'type': 'join', 'participant_id': 'me'})
+        self.assertEqual(data.get('participant_name', ''), '')
+
+    def test_invalid_frames_are_rejected(self):
+        cases = [
+            ('{', 'Invalid JSON format'),
+            (json.dumps({'type': 'nope'}), 'Unknown message type'),
+            (json.dumps({'type': 'location_update', 'participant_id': 'me', 'latitude': 91, 'longitude': 0}),
+             'Invalid location_update: latitude: greater than 90'),
+            (json.dumps({'type': 'location_update', 'participant_id': 'me', 'latitude': None, 'longitude': 0}),
+             'Invalid location_update: latitude: required'),
+            (json.dumps({'type': 'ping', 'is_sharing': 'yes'}), 'Invalid ping: is_sharing: must be a boolean'),
+            ('x' * (protocol.MAX_MESSAGE_LENGTH + 1), 'Message too large'),
+        ]
+        for text, expected in cases:
+            with self.subTest(expected):
+                self.assertEqual(protocol.parse(text), (None, expected))
+
+
+class RejectedMessageTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_bad_frames_get_error_and_are_counted(self):
+        stats = protocol.message_stats
+
+        async def run():
+            communicator = WebsocketCommunicator(application, f'/ws/location/{self.session.session_id}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            replies = []
+            for frame in (
+                '{"type": "location_update", "participant_id": "me", "latitude": "35", "longitude": 139}',
+                'not json',
+                '{"type": "teleport"}',
+            ):
+                await communicator.send_to(text_data=frame)
+                replies.append(json.loads(await communicator.receive_from()))
+            # nullの名前は省略と同じ扱いで受理される
+            await communicator.send_json_to({'type': 'join', 'participant_id': 'me', 'participant_name': None})
+            while not await communicator.receive_nothing(0.3):
+                replies.append(json.loads(await communicator.receive_from()))
+            await communicator.disconnect()
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return replies
+
+        before = stats.stats()
+        replies = asyncio.run(run())
+        after = stats.stats()
+        self.assertEqual([r['type'] for r in replies[:3]], ['error'] * 3)
+        self.assertNotIn('error', [r['type'] for r in replies[3:]])
+        self.assertEqual(after['rejected']['location_update'], before['rejected']['location_update'] + 1)
+        self.assertEqual(after['invalid_json'], before['invalid_json'] + 1)
+        self.assertEqual(after['unknown_type'], before['unknown_type'] + 1)
+        self.assertEqual(after['accepted']['join'], before['accepted']['join'] + 1)
+        self.assertEqual(
+            LocationData.objects.get(session=self.session, participant_id='me').participant_name, ''
+        )
+
+
+class SessionMetaCacheTests(TestCase):
+    def setUp(self):
+        self.cache = SessionMetaCache(maxsize=2, ttl=60)
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def test_miss_then_hit(self):
+        with self.assertNumQueries(1):
+            meta = self.cache.get(self.session.session_id)
+            self.assertEqual(self.cache.get(str(self.session.session_id)), meta)
+        self.assertEqual((meta.pk, meta.max_participants), (self.session.pk, self.session.max_participants))
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+
+    def test_unknown_sessions_are_not_cached(self):
+        for session_id in ('not-a-uuid', '00000000-0000-0000-0000-000000000000'):
+            self.assertIsNone(self.cache.get(session_id))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_entries_expire_after_ttl(self):
+        with mock.patch('tracker.session_cache.time.monotonic', return_value=1000.0):
+            self.cache.get(self.session.session_id)
+        with mock.patch('tracker.session_cache.time.monotonic', return_value=1059.0):
+            self.assertIsNotNone(self.cache.peek(self.session.session_id))
+        with mock.patch('tracker.session_cache.time.monotonic', return_value=1060.0):
+            self.assertIsNone(self.cache.peek(self.session.session_id))
+            with self.assertNumQueries(1):
+                self.cache.get(self.session.session_id)
+
+    def test_least_recently_used_is_evicted(self):
+        others = [LocationSession.objects.create(duration_minutes=30) for _ in range(2)]
+        self.cache.get(self.session.session_id)
+        self.cache.get(others[0].session_id)
+        self.cache.peek(self.session.session_id)
+        self.cache.get(others[1].session_id)
+        self.assertIsNotNone(self.cache.peek(self.session.session_id))
+        self.assertIsNone(self.cache.peek(others[0].session_id))
+
+    def test_deleted_session_is_invalidated(self):
+        session_cache.get(self.session.session_id)
+        self.session.delete()
+        self.assertIsNone(session_cache.peek(self.session.session_id))
+        self.assertIsNone(session_cache.get(self.session.session_id))
+
+    def test_expired_session_is_invalidated_when_reaped(self):
+        self.session.expires_at = timezone.now() - timedelta(days=2)
+        self.session.save()
+        # 保存時にキャッシュも更新されるので、期限切れはDBを読まずに判定できる
+        with self.assertNumQueries(0):
+            self.assertTrue(session_cache.get(self.session.session_id).is_expired())
+        with mock.patch('tracker.reaper.drop_partitions_before', return_value=0):
+            make_reaper(batch_size=10, pause=0).run()
+        self.assertIsNone(session_cache.peek(self.session.session_id))
+
+
+class RecordingLayer:
+    """group_sendを記録するだけのチャネルレイヤー"""
+    extensions = ['groups']
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class RoomBroadcasterTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = LocationBuffer()
+        for pk in (1, 2):
+            self.buffer._rooms[pk] = RoomState({})
+        patcher = mock.patch('tracker.broadcaster.location_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def move(self, pk, participant_id, latitude):
+        self.buffer.apply(pk, participant_id, {
+            'participant_name': participant_id, 'latitude': latitude, 'longitude': 139.0, 'is_active': True,
+        })
+
+    @override_settings(LOCATION_BROADCAST_TICKS=[(None, 0.1)])
+    def test_changes_within_a_tick_are_one_delta_per_room(self):
+        layer = RecordingLayer()
+
+        async def run():
+            broadcasters = {pk: RoomBroadcaster(layer, f'location_{pk}', pk) for pk in (1, 2)}
+            for i in range(3):
+                for participant_id in ('a', 'b'):
+                    self.move(1, participant_id, 35.0 + i)
+                    broadcasters[1].mark_dirty(participant_id)
+            self.move(2, 'c', 36.0)
+            broadcasters[2].mark_dirty('c')
+            await asyncio.sleep(0.3)
+            return broadcasters
+
+        broadcasters = asyncio.run(run())
+        self.assertEqual([group for group, _ in layer.sent], ['location_1', 'location_2'])
+        delta = json.loads(layer.sent[0][1]['frame'])
+        self.assertEqual((delta['version'], sorted(loc['participant_id'] for loc in delta['updated'])), (1, ['a', 'b']))
+        self.assertEqual({loc['participant_id']: loc['latitude'] for loc in delta['updated']}, {'a': 37.0, 'b': 37.0})
+        self.assertEqual((broadcasters[1].emitted, broadcasters[1].coalesced), (1, 4))
+
+    @override_settings(LOCATION_BROADCAST_TICKS=[(1, 0.05), (None, 0.4)])
+    def test_tick_follows_the_setting(self):
+        self.assertEqual((broadcast_tick(1), broadcast_tick(2)), (0.05, 0.4))
+        layer = RecordingLayer()
+
+        async def run():
+            broadcaster = RoomBroadcaster(layer, 'location_1', 1)
+            for participant_id in ('a', 'b'):
+                self.move(1, participant_id, 35.0)
+            broadcaster.mark_dirty('a')
+            await asyncio.sleep(0.2)
+            early = len(layer.sent)
+            await asyncio.sleep(0.4)
+            return early
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(len(layer.sent), 1)
+
+    def test_flush_now_does_not_wait_for_the_tick(self):
+        layer = RecordingLayer()
+
+        async def run():
+            broadcaster = RoomBroadcaster(layer, 'location_1', 1)
+            self.move(1, 'a', 35.0)
+            broadcaster.mark_dirty('a')
+            self.move(1, 'b', 35.0)
+            await broadcaster.flush_now('b')
+            sent = len(layer.sent)
+            await asyncio.sleep(0.6)
+            return sent
+
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(len(layer.sent), 1)
+        delta = json.loads(layer.sent[0][1]['frame'])
+        self.assertEqual(sorted(loc['participant_id'] for loc in delta['updated']), ['a', 'b'])
+
+
+class EncodeOnceTests(SimpleTestCase):
+    def test_frame_is_encoded_once_and_shared_by_receivers(self):
+        buffer = LocationBuffer()
+        buffer._rooms[1] = RoomState({})
+        buffer.apply(1, 'a', {'participant_name': 'A', 'latitude': 35.0, 'longitude': 139.0, 'is_active': True})
+        layer = InMemoryChannelLayer()
+
+        async def run():
+            receivers = []
+            for compact in (False, False, False, True):
+                consumer = LocationConsumer()
+                consumer.channel_layer = layer
+                consumer.channel_name = await layer.new_channel()
+                consumer.supports_delta, consumer.compact, consumer.viewport_cells = True, compact, None
+                consumer.sent = []
+
+                async def send(text_data=None, consumer=consumer):
+                    consumer.sent.append(text_data)
+                consumer.send = send
+                await layer.group_add('location_1', consumer.channel_name)
+                receivers.append(consumer)
+            with mock.patch('tracker.broadcaster.location_buffer', buffer), \
+                    mock.patch('tracker.broadcaster.json', wraps=json) as sender_json, \
+                    mock.patch('tracker.broadcaster.codec', wraps=codec) as sender_codec, \
+                    mock.patch('tracker.consumers.json', wraps=json) as receiver_json:
+                await RoomBroadcaster(layer, 'location_1', 1).flush_now('a')
+                for consumer in receivers:
+                    await consumer.location_broadcast(await layer.receive(consumer.channel_name))
+                calls = (sender_json.dumps.call_count, sender_codec.dumps.call_count, receiver_json.dumps.call_count)
+            return receivers, calls
+
+        receivers, calls = asyncio.run(run())
+        self.assertEqual(calls, (1, 1, 0))
+        frames = [consumer.sent for consumer in receivers]
+        self.assertEqual([len(sent) for sent in frames], [1, 1, 1, 1])
+        # JSONの受信者には同じ文字列オブジェクトがそのまま送られる
+        self.assertIs(frames[1][0], frames[0][0])
+        self.assertIs(frames[2][0], frames[0][0])
+        self.assertEqual(json.loads(frames[0][0])['type'], 'location_delta')
+        self.assertEqual(json.loads(frames[3][0])[0], codec.FRAME_DELTA)
+
+
+class SimplifyTests(SimpleTestCase):
+    def track(self, count):
+        """東へ進みながら南北に約50mずつ振れる軌跡"""
+        start = timezone.now()
+        return [
+            (start + timedelta(seconds=i), 35.0 + (0.00045 if i % 2 else 0.0), 139.0 + i * 0.0001)
+            for i in range(count)
+        ]
+
+    def test_endpoints_are_kept(self):
+        points = self.track(101)
+        for simplified in (douglas_peucker(points, 1000.0), visvalingam(points, 1000.0)):
+            self.assertEqual(simplified, [points[0], points[-1]])
+        # 振れ幅より小さい許容値ではどの点も残る
+        self.assertEqual(douglas_peucker(points, 10.0), points)
+
+    def test_max_points_is_respected(self):
+        points = self.track(101)
+        for simplifier in (douglas_peucker, visvalingam):
+            for max_points in (2, 5, 50):
+                with self.subTest(simplifier=simplifier.__name__, max_points=max_points):
+                    simplified = simplifier(points, max_points=max_points)
+                    self.assertEqual(len(simplified), max_points)
+                    self.assertEqual((simplified[0], simplified[-1]), (points[0], points[-1]))
+                    self.assertEqual(simplified, sorted(simplified))
+
+    def test_douglas_peucker_keeps_the_farthest_point_first(self):
+        start = timezone.now()
+        points = [(start + timedelta(seconds=i), lat, 139.0 + i * 0.001) for i, lat in enumerate(
+            [35.0, 35.0001, 35.01, 35.0001, 35.0]
+        )]
+        self.assertEqual(douglas_peucker(points, max_points=3), [points[0], points[2], points[4]])
+
+
+class HistoryTierTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def point(self, ts, latitude):
+        return (self.session.pk, 'p', {
+            'ts': ts, 'latitude': latitude, 'longitude': 139.0, 'accuracy': 5.0, 'speed': None, 'heading': None,
+        })
+
+    def test_one_tier_row_per_bucket(self):
+        # 10秒・1分のバケットの境界にそろえる
+        start = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=5)
+        write_points([self.point(start + timedelta(seconds=s), 35.0 + s / 1000) for s in range(0, 30, 2)])
+        # 後から届いた点は同じバケットの行を更新する
+        write_points([self.point(start + timedelta(seconds=29), 36.0)])
+        rows = LocationHistoryTier.objects.filter(session=self.session)
+        self.assertEqual(rows.filter(resolution=10).count(), 3)
+        self.assertEqual(rows.filter(resolution=60).count(), 1)
+        last = {row.resolution: row for row in rows.filter(bucket__in=[
+            int((start + timedelta(seconds=29)).timestamp()) // r for r in (10, 60)
+        ])}
+        self.assertEqual((last[10].latitude, last[60].latitude), (36.0, 36.0))
+        self.assertEqual(
+            list(rows.filter(resolution=10).values_list('latitude', flat=True)[:2]), [35.008, 35.018]
+        )
+        self.assertEqual(LocationHistory.objects.filter(session=self.session).count(), 16)
+
+
+class FixFilterTests(SimpleTestCase):
+    def setUp(self):
+        self.filter = FixFilter(min_distance=5.0, max_speed=80.0, keepalive=30.0, max_outliers=3)
+
+    def check(self, latitude, now, accuracy=5.0, state=None, longitude=139.0):
+        return self.filter.check(1, 'p', latitude, longitude, accuracy, state=state, now=now)
+
+    def test_small_moves_are_dropped_until_keepalive(self):
+        self.assertEqual(self.check(35.0, now=0), ACCEPT)
+        # 約1m・精度以内の移動
+        self.assertEqual(self.check(35.00001, now=5), DEADBAND)
+        self.assertEqual(self.check(35.00003, now=10), DEADBAND)
+        # 状態が変わったときと、keepaliveを過ぎたときは動いていなくても採用する
+        self.assertEqual(self.check(35.00001, now=11, state='background'), ACCEPT)
+        self.assertEqual(self.check(35.00001, now=20, state='background'), DEADBAND)
+        self.assertEqual(self.check(35.00001, now=41, state='background'), ACCEPT)
+        # 約100mの移動は採用する
+        self.assertEqual(self.check(35.0009, now=45, state='background'), ACCEPT)
+        self.assertEqual(self.filter.stats()['suppressed_deadband'], 3)
+
+    def test_outliers_are_rejected_until_repeated(self):
+        self.assertEqual(self.check(35.0, now=0), ACCEPT)
+        # 1秒で約11km
+        self.assertEqual(self.check(35.1, now=1), OUTLIER)
+        self.assertEqual(self.check(35.1, now=2), OUTLIER)
+        # 連続して同じ方向に外れるなら本当に移動したとみなす
+        self.assertEqual(self.check(35.1, now=3), ACCEPT)
+        self.assertEqual(self.check(35.1, now=4), DEADBAND)
+        self.assertEqual(self.filter.stats()['suppressed_outlier'], 2)
+
+    def test_forget_accepts_the_next_fix(self):
+        self.assertEqual(self.check(35.0, now=0), ACCEPT)
+        self.assertEqual(self.check(35.0, now=1), DEADBAND)
+        self.filter.forget(1, 'p')
+        self.assertEqual(self.check(35.0, now=2), ACCEPT)
+
+    def test_non_numeric_values_are_invalid(self):
+        for latitude, longitude, accuracy in (
+            ('35', 139.0, 5.0), (35.0, None, 5.0), (35.0, 139.0, 'x'), (float('nan'), 139.0, None), (True, 139.0, None),
+        ):
+            with self.subTest(latitude=latitude, longitude=longitude, accuracy=accuracy):
+                self.assertEqual(self.check(latitude, now=0, accuracy=accuracy, longitude=longitude), INVALID)
+        self.assertEqual(self.filter.stats()['suppressed_invalid'], 5)
+        self.assertEqual(self.filter.stats()['accepted'], 0)
+
+
+class UpdateLocationValidationTests(TestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        self.url = reverse('tracker:api_update_location', args=[self.session.session_id])
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_non_numeric_fields_are_rejected(self):
+        for fields in ({'accuracy': 'good'}, {'latitude': '35'}, {'longitude': 200}, {'accuracy': -1}):
+            with self.subTest(fields=fields):
+                response = self.client.post(self.url, json.dumps({
+                    'participant_id': 'me', 'latitude': 35.0, 'longitude': 139.0, 'accuracy': 5, **fields,
+                }), content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(LocationData.objects.filter(session=self.session).exists())
+
+
+class PresenceSweepTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        for participant_id in ('quiet', 'active'):
+            LocationData.objects.create(
+                session=self.session, participant_id=participant_id, participant_name=participant_id,
+                latitude=35.0, longitude=139.0, is_online=True,
+            )
+        location_buffer.load_room(self.session.pk)
+        self.group = f'location_{self.session.session_id}'
+
+    def tearDown(self):
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_silent_participants_are_marked_offline_once(self):
+        tracker = PresenceTracker(timeout=10.0)
+
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(self.group, channel)
+            for participant_id in ('quiet', 'active'):
+                tracker.seen(self.session.pk, participant_id, self.group)
+            now = time.monotonic()
+            tracker._entries[(self.session.pk, 'quiet')].last_seen = now - 11
+            swept = await tracker.sweep(now=now)
+            message = await asyncio.wait_for(layer.receive(channel), 5)
+            # 2回目のスイープでは何も送らない
+            again = await tracker.sweep(now=now + 1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(channel), 0.2)
+            await layer.group_discard(self.group, channel)
+            await database_sync_to_async(connections.close_all)()
+            return swept, again, json.loads(message['frame'])
+
+        swept, again, delta = asyncio.run(run())
+        self.assertEqual((swept, again), (1, 0))
+        self.assertEqual([(loc['participant_id'], loc['is_online']) for loc in delta['updated']], [('quiet', False)])
+        online = dict(LocationData.objects.filter(session=self.session).values_list('participant_id', 'is_online'))
+        self.assertEqual(online, {'quiet': False, 'active': True})
+        self.assertTrue(tracker.is_online(self.session.pk, 'active'))
+        self.assertFalse(tracker.is_online(self.session.pk, 'quiet'))
+        # 何か届けばオンラインに戻す（呼び出し側で通知する）
+        self.assertTrue(tracker.seen(self.session.pk, 'quiet', self.group))
+        self.assertFalse(tracker.seen(self.session.pk, 'active', self.group))
+
+
+class MultipleTabsTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_participant_goes_offline_after_the_last_tab(self):
+        url = f'/ws/location/{self.session.session_id}/'
+
+        async def drain(communicator):
+            frames = []
+            while not await communicator.receive_nothing(0.3):
+                frames.append(json.loads(await communicator.receive_from()))
+            return [frame['type'] for frame in frames]
+
+        def participant():
+            return LocationData.objects.filter(session=self.session, participant_id='me') \
+                .values_list('connection_count', 'is_online').first()
+
+        async def run():
+            clients = {}
+            for name, participant_id in (('observer', 'other'), ('tab1', 'me'), ('tab2', 'me')):
+                clients[name] = WebsocketCommunicator(application, url)
+                connected, _ = await clients[name].connect()
+                self.assertTrue(connected)
+                await clients[name].send_json_to({
+                    'type': 'join', 'participant_id': participant_id, 'participant_name': participant_id,
+                    'supports_delta': True,
+                })
+                await drain(clients[name])
+            await drain(clients['observer'])
+            states = [await database_sync_to_async(participant)()]
+            await clients['tab1'].disconnect()
+            received = [await drain(clients['observer'])]
+            states.append(await database_sync_to_async(participant)())
+            await clients['tab2'].disconnect()
+            received.append(await drain(clients['observer']))
+            states.append(await database_sync_to_async(participant)())
+            await clients['observer'].disconnect()
+            await location_buffer.aflush(self.session.pk)
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return states, received
+
+        states, received = asyncio.run(run())
+        self.assertEqual(states[0], (2, True))
+        # 1つ目のタブを閉じても他の参加者には何も届かない
+        self.assertEqual(states[1], (1, True))
+        self.assertEqual(received[0], [])
+        self.assertEqual(states[2], (0, False))
+        self.assertIn('participant_offline', received[1])
+
+
+class AdmissionTests(SimpleTestCase):
+    def meta(self, max_participants=2):
+        now = timezone.now()
+        return SessionMeta(1, None, 30, now, now + timedelta(minutes=30), max_participants)
+
+    def test_token_bucket_refills_at_rate(self):
+        limiter = RateLimiter(rate=1.0, burst=3)
+        self.assertEqual([limiter.allow('ip', now=0) for _ in range(4)], [True, True, True, False])
+        self.assertFalse(limiter.allow('ip', now=0.5))
+        self.assertTrue(limiter.allow('ip', now=1.5))
+        # キーごとに別のバケット
+        self.assertTrue(limiter.allow('other', now=1.5))
+
+    def test_worker_limits(self):
+        control = AdmissionControl(max_connections=10, ip_rate=0.001, ip_burst=2)
+        self.assertEqual(control.check_worker(10, '10.0.0.1'), CLOSE_SERVER_BUSY)
+        self.assertEqual([control.check_worker(0, '10.0.0.1') for _ in range(3)], [None, None, CLOSE_RATE_LIMITED])
+        self.assertIsNone(control.check_worker(0, '10.0.0.2'))
+        stats = control.stats()
+        self.assertEqual((stats['rejected_server_busy'], stats['rejected_rate_limited']), (1, 1))
+
+    def test_full_session_admits_existing_members_only(self):
+        control = AdmissionControl(sockets_per_participant=2)
+        meta = self.meta(max_participants=2)
+        self.assertEqual(control.check_session(meta, 2, 'new'), CLOSE_SESSION_FULL)
+        self.assertIsNone(control.check_session(meta, 2, 'member', is_member=True))
+        # 参加者IDを送らない古いクライアントはjoinで判定する
+        self.assertIsNone(control.check_session(meta, 2))
+        self.assertTrue(control.is_full(meta, 2, is_member=False))
+        self.assertFalse(control.is_full(meta, 2, is_member=True))
+        # 参加者1人あたりの接続数の上限（2人 x 2）
+        for _ in range(2):
+            self.assertIsNone(control.check_session(meta, 1, 'member', is_member=True))
+        self.assertEqual(control.check_session(meta, 1, 'member', is_member=True), CLOSE_SESSION_FULL)
+        control.release(meta.pk)
+        self.assertIsNone(control.check_session(meta, 1, 'member', is_member=True))
+        self.assertEqual(control.stats()['rejected_session_full'], 3)
+
+
+class SessionFullConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30, max_participants=1)
+        LocationData.objects.create(session=self.session, participant_id='member', latitude=35.0, longitude=139.0)
+
+    def tearDown(self):
+        session_events.flush()
+        location_buffer.forget_session(self.session.pk)
+        session_cache.invalidate(self.session.session_id)
+
+    def test_new_participant_is_rejected_when_full(self):
+        async def attempt(participant_id):
+            communicator = WebsocketCommunicator(
+                application, f'/ws/location/{self.session.session_id}/?participant_id={participant_id}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            if await communicator.receive_nothing(0.3):
+                await communicator.disconnect()
+                return 'open', None
+            output = await communicator.receive_output()
+            return output['type'], output.get('code')
+
+        async def run():
+            await database_sync_to_async(location_buffer.load_room)(self.session.pk)
+            results = [await attempt('newcomer'), await attempt('member')]
+            await pool.close()
+            await database_sync_to_async(connections.close_all)()
+            return results
+
+        newcomer, member = asyncio.run(run())
+        self.assertEqual(newcomer, ('websocket.close', CLOSE_SESSION_FULL))
+        # 既存の参加者は満員でも接続できる
+        self.assertEqual(member, ('open', None))
+
+
+class AsyncDbTests(TransactionTestCase):
+    def setUp(self):
+        self.session = LocationSession.objects.create(duration_minutes=30)
+        LocationData.objects.create(
+            session=self.session, participant_id='active', participant_name='名前', status='sharing',
+            latitude=35.0, longitude=139.0,
+        )
+        LocationData.objects.create(session=self.session, participant_id='left', is_active=False)
+
+    def tearDown(self):
+        session_cache.invalidate(self.session.session_id)
+
+    def run_async(self, coroutine):
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                await pool.close()
+                await database_sync_to_async(connections.close_all)()
+        return asyncio.run(run())
+
+    def test_pooled_and_orm_versions_agree(self):
+        async def compare():
+            results = []
+            for participant_id in ('active', 'left', 'missing'):
+                for active_only in (True, False):
+                    results.append([
+                        await async_db.get_participant(self.session.pk, participant_id, active_only, pooled=pooled)
+                        for pooled in (True, False)
+                    ])
+            for participant_id in ('active', 'missing'):
+                results.append([
+                    await async_db.set_background(self.session.pk, participant_id, True, pooled=pooled)
+                    for pooled in (True, False)
+                ])
+            return results
+
+        for pooled, orm in self.run_async(compare()):
+            self.assertEqual(pooled, orm)
+        self.assertTrue(LocationData.objects.get(session=self.session, participant_id='active').is_background)
+
+    def test_acquire_times_out_when_pool_is_exhausted(self):
+        small = async_db.AsyncConnectionPool(size=1, timeout=0.1)
+
+        async def run():
+            async with small.connection():
+                with self.assertRaises(asyncio.TimeoutError):
+                    async with small.connection():
+                        pass
+            # 解放後は待たずに同じ接続を使える
+            async with small.connection() as conn:
+                await conn.execute('SELECT 1')
+            await small.close()
+            return small.stats()
+
+        stats = self.run_async(run())
+        self.assertEqual((stats['waited'], stats['acquired'], stats['opened']), (1, 3, 0))
+
+    def test_broken_connection_is_not_reused(self):
+        small = async_db.AsyncConnectionPool(size=1, timeout=1.0)
+
+        async def run():
+            with self.assertRaises(RuntimeError):
+                async with small.connection() as broken:
+                    raise RuntimeError
+            opened = small.stats()['opened']
+            async with small.connection() as conn:
+                replaced = conn is not broken
+            await small.close()
+            await asyncio.sleep(0)
+            return opened, replaced, broken.closed
+
+        self.assertEqual(self.run_async(run()), (0, True, True))
+
+    def test_pool_is_rebound_to_a_new_event_loop(self):
+        small = async_db.AsyncConnectionPool(size=1, timeout=1.0)
+
+        async def use():
+            async with small.connection() as conn:
+                cursor = await conn.execute('SELECT 1')
+                return conn, await cursor.fetchone()
+
+        first, row = asyncio.run(use())
+        self.assertEqual(row, (1,))
+        # 前のループの接続は使わずに開き直す（セマフォも作り直すので待たされない）
+        second, row = self.run_async(use())
+        self.assertIsNot(second, first)
+        self.assertEqual(row, (1,))
+        self.assertEqual(small.stats()['opened'], 1)
+        first.pgconn.finish()
+        second.pgconn.finish()
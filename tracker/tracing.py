@@ -0,0 +1,140 @@
+# tracker/tracing.py
+"""WebSocketメッセージ単位のトレース（サンプリング）と遅いメッセージのログ
+
+TRACE_SAMPLE_RATE の割合のメッセージについて、receive の処理全体をトレースとし、
+その中のDBアクセス（metrics.db_helper）・group_send・@traced を付けたヘルパーをスパンとして
+時間とSQLの件数を記録する。スパンは名前ごとに集計する（入れ子のスパンの時間は親にも含まれる）。
+
+処理に SLOW_MESSAGE_THRESHOLD 秒以上かかったメッセージは、トレースしていなくても
+'tracker.slow' ロガーに1行のJSONで書き出す（トレースしていれば内訳付き）。
+
+トレースはcontextvarで持つため、database_sync_to_async で実行される同期処理からも参照できる。
+"""
+import contextvars
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+slow_logger = logging.getLogger('tracker.slow')
+
+SAMPLE_RATE = getattr(settings, 'TRACE_SAMPLE_RATE', 0.0)
+SLOW_MESSAGE_THRESHOLD = getattr(settings, 'SLOW_MESSAGE_THRESHOLD', 0.5)
+
+_trace = contextvars.ContextVar('tracker_trace', default=None)
+# SQLの件数を付けるスパンの名前
+_span = contextvars.ContextVar('tracker_span', default=None)
+
+
+class Trace:
+    __slots__ = ('spans', 'queries')
+
+    def __init__(self):
+        # スパン名 -> [呼び出し回数, 合計秒数]
+        self.spans = {}
+        # スパン名（スパンの外ならNone） -> SQLの件数
+        self.queries = {}
+
+    def add(self, name, duration):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, duration]
+        else:
+            span[0] += 1
+            span[1] += duration
+
+    def count_query(self, name):
+        self.queries[name] = self.queries.get(name, 0) + 1
+
+    def breakdown(self):
+        result = {
+            name: {'calls': calls, 'ms': round(seconds * 1000, 3), 'queries': self.queries.get(name, 0)}
+            for name, (calls, seconds) in self.spans.items()
+        }
+        if None in self.queries:
+            result['(other)'] = {'calls': 0, 'ms': 0, 'queries': self.queries[None]}
+        return result
+
+
+def begin():
+    """サンプリングに当たればトレースを開始する。finish に渡すトークンを返す"""
+    if SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE:
+        return None
+    return _trace.set(Trace())
+
+
+def finish(token, session_id, message_type, elapsed):
+    trace = None
+    if token is not None:
+        trace = _trace.get()
+        _trace.reset(token)
+    if elapsed < SLOW_MESSAGE_THRESHOLD:
+        return
+    record = {
+        'at': timezone.now().isoformat(),
+        'session': str(session_id),
+        'type': message_type,
+        'ms': round(elapsed * 1000, 3),
+        'traced': trace is not None,
+    }
+    if trace is not None:
+        record['queries'] = sum(trace.queries.values())
+        record['breakdown'] = trace.breakdown()
+    slow_logger.warning('%s', json.dumps(record, ensure_ascii=False))
+
+
+@contextmanager
+def span(name):
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    token = _span.set(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+        _span.reset(token)
+
+
+def traced(func):
+    """非同期メソッドをスパンとして記録する"""
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _trace.get() is None:
+            return await func(*args, **kwargs)
+        with span(name):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def count_query():
+    """DjangoのDB接続を通らないクエリ（async_dbの非同期プール）を数える"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.count_query(_span.get())
+
+
+def _count_query(execute, sql, params, many, context):
+    count_query()
+    return execute(sql, params, many, context)
+
+
+def count_queries(func):
+    """同期関数の中で実行されたSQLを、トレース中であれば現在のスパンに数える"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _trace.get() is None:
+            return func(*args, **kwargs)
+        with connection.execute_wrapper(_count_query):
+            return func(*args, **kwargs)
+    return wrapper
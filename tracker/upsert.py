@@ -0,0 +1,100 @@
+# tracker/upsert.py
+"""位置の書き込みを1往復で行う（HTTP APIの位置更新）
+
+1つのSQL文で次をまとめて行う。
+
+- セッションが期限内かの確認（期限切れなら何も書き込まず0行を返す）
+- LocationDataのupsert（INSERT ... ON CONFLICT ... DO UPDATE ... RETURNING）
+- 初めての位置なら参加ログ（SessionLog）の追加
+- ルームの参加者一覧の読み出し
+
+データ変更を伴うCTEの結果は同じ文の他の部分からは見えないため、書き込んだ行はRETURNINGから、
+他の参加者の行はテーブルから読んでUNION ALLで1つの結果にする。
+
+WebSocketの位置更新は location_buffer で書き込みを遅らせ、フラッシュ時に全参加者分を
+1回のINSERT ... ON CONFLICTでまとめて書き込む（1件ごとのDBアクセスはない）。
+"""
+from django.db import connection
+from django.utils import timezone
+
+from .models import LocationSession, LocationData, SessionLog
+
+SESSION_TABLE = LocationSession._meta.db_table
+LOCATION_TABLE = LocationData._meta.db_table
+LOG_TABLE = SessionLog._meta.db_table
+
+# location_buffer のレコードと同じ項目
+RECORD_COLUMNS = (
+    'participant_id', 'participant_name', 'latitude', 'longitude', 'accuracy', 'last_updated',
+    'is_background', 'is_online', 'status', 'altitude', 'heading', 'speed',
+)
+_columns = ', '.join(RECORD_COLUMNS)
+
+UPSERT_SQL = f"""
+WITH live AS (
+    SELECT id FROM {SESSION_TABLE} WHERE id = %(session)s AND expires_at > %(now)s
+), fix AS (
+    INSERT INTO {LOCATION_TABLE} (
+        session_id, participant_id, participant_name, latitude, longitude, accuracy,
+        is_background, is_active, is_online, status, connection_count, timestamp, last_updated
+    )
+    SELECT id, %(participant_id)s, %(participant_name)s, %(latitude)s, %(longitude)s, %(accuracy)s,
+           %(is_background)s, TRUE, TRUE, 'waiting', 0, %(now)s, %(now)s
+    FROM live
+    ON CONFLICT (session_id, participant_id) DO UPDATE SET
+        participant_name = EXCLUDED.participant_name,
+        latitude = EXCLUDED.latitude,
+        longitude = EXCLUDED.longitude,
+        accuracy = EXCLUDED.accuracy,
+        is_background = EXCLUDED.is_background,
+        is_active = TRUE,
+        last_updated = EXCLUDED.last_updated
+    RETURNING {_columns}, (xmax = 0) AS created
+), joined AS (
+    INSERT INTO {LOG_TABLE} (
+        session_id, action, participant_id, ip_address, user_agent, timestamp, connection_id, error_message
+    )
+    SELECT %(session)s, 'joined', participant_id, %(ip_address)s, %(user_agent)s, %(now)s, '', ''
+    FROM fix WHERE created
+)
+SELECT {_columns}, created FROM fix
+UNION ALL
+SELECT {', '.join(f'l.{name}' for name in RECORD_COLUMNS)}, NULL
+FROM {LOCATION_TABLE} l JOIN live ON l.session_id = live.id
+WHERE l.is_active AND l.participant_id <> %(participant_id)s
+"""
+
+
+def upsert_fix(session_pk, participant_id, fields, ip_address=None, user_agent=''):
+    """位置を書き込み、(初めての位置か, ルームの参加者レコードの一覧) を返す
+
+    セッションが期限切れ（または削除済み）ならNoneを返す。レコードの形式は location_buffer と同じ。
+    """
+    params = {
+        'session': session_pk,
+        'participant_id': participant_id,
+        'participant_name': fields.get('participant_name', ''),
+        'latitude': fields['latitude'],
+        'longitude': fields['longitude'],
+        'accuracy': fields.get('accuracy'),
+        'is_background': bool(fields.get('is_background', False)),
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+        'now': timezone.now(),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_SQL, params)
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+    created = False
+    records = []
+    for row in rows:
+        record = dict(zip(RECORD_COLUMNS, row))
+        for name in ('latitude', 'longitude'):
+            if record[name] is not None:
+                record[name] = float(record[name])
+        if row[-1]:
+            created = True
+        records.append(record)
+    return created, records
@@ -17,4 +17,7 @@ urlpatterns = [
     path('api/session/<uuid:session_id>/update/', views.api_update_location, name='api_update_location'),
     path('api/session/<uuid:session_id>/locations/', views.api_get_locations, name='api_get_locations'),
     path('api/session/<uuid:session_id>/leave/', views.api_leave_session, name='api_leave_session'),
+    path('api/session/<uuid:session_id>/track/<str:participant_id>/', views.api_get_track, name='api_get_track'),
+    path('api/stats/', views.api_stats, name='api_stats'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
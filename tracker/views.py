@@ -1,20 +1,36 @@
 # tracker/views.py
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.shortcuts import render, redirect
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib import messages
-from django.core.mail import send_mail
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 import json
 import uuid
 import logging
-from .models import LocationSession, LocationData, SessionLog
+from .models import LocationSession, LocationData
+from .session_cache import get_session_meta_or_404
+from .location_buffer import location_buffer, encode_change
+from .broadcaster import is_shared
+from .upsert import upsert_fix
+from .session_events import session_events
+from .mail_queue import mail_queue
+from .history import choose_tier, iter_track, aiter_track, pending_after
+from .fix_filter import fix_filter, ACCEPT
+from .presence import presence
+from .connections import connection_registry
+from .protocol import message_stats
+from .admission import admission
+from . import async_db, metrics, protocol
+from .simplify import SIMPLIFIERS, douglas_peucker, visvalingam
 
 # ログ設定
 logger = logging.getLogger(__name__)
@@ -111,61 +127,40 @@ def contact(request):
             
             # HTMLメールテンプレート（管理者用）
             html_message = render_to_string('tracker/email/contact_notification.html', email_context)
-            plain_message = strip_tags(html_message)
+            admin_email = getattr(settings, 'CONTACT_EMAIL', settings.DEFAULT_FROM_EMAIL)
+            admin_mail = EmailMultiAlternatives(
+                subject=email_subject,
+                body=strip_tags(html_message),
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=[admin_email],
+            )
+            admin_mail.attach_alternative(html_message, 'text/html')
             
-            # 管理者へのメール送信
-            try:
-                admin_email = getattr(settings, 'CONTACT_EMAIL', settings.DEFAULT_FROM_EMAIL)
-                
-                # デバッグ用ログ出力
-                logger.info(f'Sending email to admin: {admin_email}')
-                logger.info(f'Email subject: {email_subject}')
-                logger.info(f'From email: {settings.DEFAULT_FROM_EMAIL}')
-                
-                send_mail(
-                    subject=email_subject,
-                    message=plain_message,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[admin_email],
-                    html_message=html_message,
-                    fail_silently=False,
-                )
-                
-                logger.info('Admin email sent successfully')
-                
-                # 送信者への自動返信メール
-                auto_reply_html = render_to_string('tracker/email/contact_auto_reply.html', auto_reply_context)
-                auto_reply_plain = strip_tags(auto_reply_html)
-                
-                logger.info(f'Sending auto-reply to: {email}')
-                
-                send_mail(
-                    subject='[チョイシェアMAP] お問い合わせを受け付けました',
-                    message=auto_reply_plain,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[email],
-                    html_message=auto_reply_html,
-                    fail_silently=True,  # 自動返信は失敗してもOK
-                )
-                
-                logger.info('Auto-reply email sent successfully')
-                logger.info(f'Contact form submitted: {name} <{email}> - {category_text}')
-                
-            except Exception as e:
-                logger.error(f'Failed to send contact email: {str(e)}')
-                # より詳細なエラー情報をログに出力
-                import traceback
-                logger.error(f'Email error traceback: {traceback.format_exc()}')
-                
+            # 送信者への自動返信メール
+            auto_reply_html = render_to_string('tracker/email/contact_auto_reply.html', auto_reply_context)
+            auto_reply = EmailMultiAlternatives(
+                subject='[チョイシェアMAP] お問い合わせを受け付けました',
+                body=strip_tags(auto_reply_html),
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=[email],
+            )
+            auto_reply.attach_alternative(auto_reply_html, 'text/html')
+            
+            # 送信はキューのスレッドで行う（SMTPの応答を待たずに返す）
+            if not mail_queue.enqueue([admin_mail, auto_reply], label=f'contact from <{email}>'):
+                logger.error('Mail queue is full, contact form rejected: %s <%s>', name, email)
+                error_message = '現在メールを送信できません。しばらくしてから再度お試しください。'
                 if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                     return JsonResponse({
                         'success': False,
-                        'message': f'メール送信でエラーが発生しました: {str(e)}'
+                        'message': error_message
                     })
                 else:
-                    messages.error(request, f'メール送信でエラーが発生しました: {str(e)}')
+                    messages.error(request, error_message)
                     return render(request, 'tracker/contact.html')
             
+            logger.info('Contact form queued: %s <%s> - %s (to %s)', name, email, category_text, admin_email)
+            
             # 成功時のレスポンス
             success_message = 'お問い合わせありがとうございます。メッセージを正常に送信いたしました。内容を確認次第、ご返信させていただきます。'
             
@@ -208,10 +203,9 @@ def create_session(request):
     
     session = LocationSession.objects.create(duration_minutes=duration)
     
-    # ログ記録
-    SessionLog.objects.create(
-        session=session,
-        action='created',
+    # ログ記録（書き込みはまとめて後から）
+    session_events.record(
+        session.pk, 'created',
         ip_address=get_client_ip(request),
         user_agent=request.META.get('HTTP_USER_AGENT', '')
     )
@@ -220,7 +214,7 @@ def create_session(request):
 
 def session_created(request, session_id):
     """セッション作成完了ページ"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     if session.is_expired():
         messages.error(request, 'このセッションは期限切れです。')
@@ -235,7 +229,7 @@ def session_created(request, session_id):
 
 def share_location(request, session_id):
     """位置情報共有ページ"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     if session.is_expired():
         return render(request, 'tracker/expired.html', {'session': session})
@@ -256,21 +250,56 @@ def share_location(request, session_id):
     return render(request, 'tracker/share.html', context)
 
 # WebSocket通知用のヘルパー関数
-def notify_location_update(session_id, locations_data):
-    """WebSocketで位置情報更新を全参加者に通知"""
+def publish_room_change(session, participant_id, fields, records=None):
+    """HTTP API経由の変更をWebSocketの全参加者に通知
+
+    複数ワーカー構成ではチャネルブローカーのルームへ送る（全ワーカーの接続に差分として届く）。
+    それ以外ではメモリ上のルームのスナップショットを送る。records（ルームの参加者レコード）を
+    渡すと、ルームが未ロードでもDBを読み直さない。
+    """
     channel_layer = get_channel_layer()
-    if channel_layer:
-        async_to_sync(channel_layer.group_send)(
-            f'location_{session_id}',
-            {
-                'type': 'location_broadcast',
-                'locations': locations_data
-            }
-        )
+    if channel_layer is None:
+        return
+    group_name = f'location_{session.session_id}'
+    if not is_shared(channel_layer):
+        broadcast_room_snapshot(channel_layer, group_name, session.pk, records)
+        return
+
+    async def publish():
+        if not channel_layer.has_room(group_name):
+            # ブローカーにルームがあれば無視される（接続中のクライアントがいなければ作られない）
+            snapshot = location_buffer.snapshot(session.pk)
+            if snapshot is None:
+                snapshot = await sync_to_async(location_buffer.load_room)(session.pk, records=records)
+            await channel_layer.room_seed(group_name, snapshot)
+        await channel_layer.room_delta(group_name, [[participant_id, encode_change(fields)]])
+
+    async_to_sync(publish)()
+
+def broadcast_room_snapshot(channel_layer, group_name, session_pk, records=None):
+    """ルームのスナップショット（エポック・バージョン付き）を全接続に送る
+
+    consumerの差分と同じ版番号なので、クライアントは以降の差分の欠落を検出して再同期できる。
+    """
+    if not location_buffer.has_room(session_pk):
+        location_buffer.load_room(session_pk, records=records)
+    frame = location_buffer.snapshot_frame(session_pk)
+    compact_frame = location_buffer.snapshot_frame(session_pk, compact=True)
+    if frame is None or compact_frame is None:
+        # 読み込んだ直後に追い出された場合（接続中のクライアントは参加時に読み込み直す）
+        return
+    async_to_sync(channel_layer.group_send)(group_name, {
+        'type': 'location_broadcast',
+        'snapshot': True,
+        'frame': frame,
+        'compact_frame': compact_frame,
+    })
 
 def get_all_locations_data(session):
     """セッション内の全位置情報を取得"""
-    locations = LocationData.objects.filter(session=session, is_active=True)
+    # WebSocket経由の書き込み待ちの位置を先に反映
+    location_buffer.flush(session.pk)
+    locations = LocationData.objects.filter(session_id=session.pk, is_active=True)
     return [
         {
             'participant_id': location.participant_id,
@@ -288,7 +317,7 @@ def get_all_locations_data(session):
 @require_http_methods(["POST"])
 def api_update_location(request, session_id):
     """位置情報更新API（HTTP互換性のために保持）"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     if session.is_expired():
         return JsonResponse({'error': 'セッションが期限切れです'}, status=400)
@@ -304,34 +333,60 @@ def api_update_location(request, session_id):
         
         if not all([participant_id, latitude, longitude]):
             return JsonResponse({'error': '必要なパラメータが不足しています'}, status=400)
+        # 値の範囲・型はWebSocketの位置更新と同じスキーマで検証する
+        try:
+            protocol.VALIDATORS['location_update'](data)
+        except protocol.MessageError as e:
+            return JsonResponse({'error': f'パラメータが正しくありません: {e}'}, status=400)
         
-        # 位置情報を更新または作成
-        location, created = LocationData.objects.update_or_create(
-            session=session,
-            participant_id=participant_id,
-            defaults={
-                'latitude': latitude,
-                'longitude': longitude,
-                'accuracy': accuracy,
-                'participant_name': participant_name,
-                'is_background': is_background,
-                'is_active': True,
-            }
+        # 動いていない・あり得ない位置は書き込みも通知もしない（生存確認のみ更新）
+        verdict = fix_filter.check(
+            session.pk, participant_id, latitude, longitude, accuracy,
+            state=(participant_name, bool(is_background))
         )
+        if verdict != ACCEPT:
+            location_buffer.touch(session.pk, participant_id)
+            return JsonResponse({'success': True, 'message': '位置情報を更新しました', 'suppressed': verdict})
         
-        # 初回参加のログ記録
-        if created:
-            SessionLog.objects.create(
-                session=session,
-                action='joined',
-                participant_id=participant_id,
-                ip_address=get_client_ip(request),
-                user_agent=request.META.get('HTTP_USER_AGENT', '')
-            )
+        # 期限の確認・位置のupsert・参加ログ・ルームの読み出しを1回のSQLで行う
+        location_buffer.discard(session.pk, participant_id)
+        result = upsert_fix(session.pk, participant_id, {
+            'participant_name': participant_name,
+            'latitude': latitude,
+            'longitude': longitude,
+            'accuracy': accuracy,
+            'is_background': is_background,
+        }, ip_address=get_client_ip(request), user_agent=request.META.get('HTTP_USER_AGENT', ''))
+        if result is None:
+            # キャッシュの期限より先に延長・削除された場合
+            return JsonResponse({'error': 'セッションが期限切れです'}, status=400)
+        created, records = result
+        session_events.record(session.pk, 'location_updated', participant_id, ip_address=get_client_ip(request))
+        location_buffer.apply(session.pk, participant_id, {
+            'participant_name': participant_name,
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'accuracy': accuracy,
+            'is_background': is_background,
+            'is_active': True,
+        })
+        location_buffer.record_history(session.pk, participant_id, {
+            'latitude': latitude,
+            'longitude': longitude,
+            'accuracy': accuracy,
+        })
         
-        # WebSocketで全参加者に通知
-        locations_data = get_all_locations_data(session)
-        notify_location_update(session_id, locations_data)
+        # WebSocketで全参加者に通知（WebSocket経由の書き込み待ちの位置はフラッシュせずに重ねる）
+        records = location_buffer.merge_pending(session.pk, {r['participant_id']: r for r in records})
+        publish_room_change(session, participant_id, {
+            'participant_name': participant_name,
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'accuracy': accuracy,
+            'is_background': is_background,
+            'is_active': True,
+            'last_updated': records[participant_id]['last_updated'],
+        }, records=records)
         
         return JsonResponse({'success': True, 'message': '位置情報を更新しました'})
         
@@ -343,7 +398,7 @@ def api_update_location(request, session_id):
 @require_http_methods(["GET"])
 def api_get_locations(request, session_id):
     """セッション内の全位置情報取得API（HTTP互換性のために保持）"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     if session.is_expired():
         return JsonResponse({'error': 'セッションが期限切れです'}, status=400)
@@ -356,11 +411,89 @@ def api_get_locations(request, session_id):
         'is_expired': session.is_expired(),
     })
 
+@require_http_methods(["GET"])
+def api_get_track(request, session_id, participant_id):
+    """参加者の軌跡取得API（時刻順にストリーミング）
+
+    ?since= にISO 8601形式の日時を渡すと、それより後の点だけを返す。
+    ?zoom= / ?max_points= に合わせて raw / 10s / 1m のいずれかの解像度を選ぶ。
+    ?simplify=dp|vw&tolerance=<メートル> を指定すると選んだ軌跡をさらに間引く（この場合はメモリ上で処理）。
+    どちらもmax_pointsを指定すると点数がそれ以下になるまで間引く。
+    points: [[ts(epoch ms), latitude, longitude, accuracy, speed, heading], ...]
+    """
+    session = get_session_meta_or_404(session_id)
+
+    since = None
+    if request.GET.get('since'):
+        since = parse_datetime(request.GET['since'])
+        if since is None:
+            return JsonResponse({'error': 'sinceの形式が正しくありません'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+    try:
+        zoom = int(request.GET['zoom']) if request.GET.get('zoom') else None
+        max_points = int(request.GET['max_points']) if request.GET.get('max_points') else None
+        tolerance = float(request.GET['tolerance']) if request.GET.get('tolerance') else None
+    except ValueError:
+        return JsonResponse({'error': 'パラメータの形式が正しくありません'}, status=400)
+    if (zoom is not None and zoom < 0) or (max_points is not None and max_points < 1):
+        return JsonResponse({'error': 'パラメータの形式が正しくありません'}, status=400)
+    simplifier = None
+    if request.GET.get('simplify'):
+        simplifier = SIMPLIFIERS.get(request.GET['simplify'])
+        if simplifier is None or (tolerance is None and max_points is None and simplifier is douglas_peucker):
+            return JsonResponse({'error': 'simplifyの指定が正しくありません'}, status=400)
+
+    tier = choose_tier(session.pk, participant_id, since, zoom, max_points)
+    # WebSocket経由の書き込み待ちの点はフラッシュせずにDBの軌跡の後に付け足す（GETでDBへ書き込まない）
+    pending = location_buffer.pending_track(session.pk, participant_id, since)
+    points = None
+    if simplifier is not None:
+        points = list(iter_track(session.pk, participant_id, since, tier))
+        points += pending_after(pending, points[-1][0] if points else None, tier)
+        if simplifier is douglas_peucker:
+            points = douglas_peucker(points, tolerance, max_points)
+        else:
+            points = visvalingam(points, tolerance, max_points)
+
+    def encode(ts, latitude, longitude, accuracy, speed, heading):
+        return json.dumps(
+            [int(ts.timestamp() * 1000), latitude, longitude, accuracy, speed, heading],
+            separators=(',', ':'),
+        )
+
+    async def stream():
+        # ASGIでは同期のイテレーターは全て読み込んでから送られるので、非同期で少しずつ読んで送る
+        yield '{"participant_id":%s,"tier":"%s","points":[' % (json.dumps(participant_id), tier)
+        chunk, separator = [], ''
+        if points is not None:
+            rows = points
+        else:
+            last_ts = None
+            async for point in aiter_track(session.pk, participant_id, since, tier):
+                last_ts = point[0]
+                chunk.append(encode(*point))
+                if len(chunk) >= 500:
+                    yield separator + ','.join(chunk)
+                    chunk, separator = [], ','
+            rows = pending_after(pending, last_ts, tier)
+        for point in rows:
+            chunk.append(encode(*point))
+            if len(chunk) >= 500:
+                yield separator + ','.join(chunk)
+                chunk, separator = [], ','
+        if chunk:
+            yield separator + ','.join(chunk)
+        yield ']}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def api_offline_status(request, session_id):
     """オフライン状態通知API（HTTP互換性のために保持）"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     if session.is_expired():
         return JsonResponse({'error': 'セッションが期限切れです'}, status=400)
@@ -375,13 +508,15 @@ def api_offline_status(request, session_id):
         
         # 既存の位置情報のis_backgroundフラグを更新
         LocationData.objects.filter(
-            session=session, 
+            session_id=session.pk, 
             participant_id=participant_id
         ).update(is_background=is_background, last_updated=timezone.now())
+        location_buffer.apply(session.pk, participant_id, {'is_background': is_background})
         
         # WebSocketで全参加者に通知
-        locations_data = get_all_locations_data(session)
-        notify_location_update(session_id, locations_data)
+        publish_room_change(session, participant_id, {
+            'is_background': is_background, 'last_updated': timezone.now()
+        })
         
         return JsonResponse({'success': True, 'message': 'オフライン状態を更新しました'})
         
@@ -394,7 +529,7 @@ def api_offline_status(request, session_id):
 @require_http_methods(["POST"])
 def api_session_ping(request, session_id):
     """セッション維持用pingAPI（HTTP互換性のために保持）"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     if session.is_expired():
         return JsonResponse({'error': 'セッションが期限切れです'}, status=400)
@@ -409,9 +544,10 @@ def api_session_ping(request, session_id):
         
         # 既存の位置情報のis_backgroundフラグとlast_updatedを更新
         LocationData.objects.filter(
-            session=session, 
+            session_id=session.pk, 
             participant_id=participant_id
         ).update(is_background=is_background, last_updated=timezone.now())
+        location_buffer.apply(session.pk, participant_id, {'is_background': is_background})
         
         return JsonResponse({'success': True, 'message': 'セッションを維持しました'})
         
@@ -424,7 +560,7 @@ def api_session_ping(request, session_id):
 @require_http_methods(["POST"])
 def api_leave_session(request, session_id):
     """セッションから退出API（HTTP互換性のために保持）"""
-    session = get_object_or_404(LocationSession, session_id=session_id)
+    session = get_session_meta_or_404(session_id)
     
     try:
         data = json.loads(request.body)
@@ -434,23 +570,23 @@ def api_leave_session(request, session_id):
             return JsonResponse({'error': 'participant_idが必要です'}, status=400)
         
         # 位置情報を非アクティブに設定
+        location_buffer.discard(session.pk, participant_id)
+        fix_filter.forget(session.pk, participant_id)
         LocationData.objects.filter(
-            session=session, 
+            session_id=session.pk, 
             participant_id=participant_id
         ).update(is_active=False)
+        location_buffer.apply(session.pk, participant_id, {'is_active': False})
         
-        # ログ記録
-        SessionLog.objects.create(
-            session=session,
-            action='left',
-            participant_id=participant_id,
+        # ログ記録（書き込みはまとめて後から）
+        session_events.record(
+            session.pk, 'left', participant_id,
             ip_address=get_client_ip(request),
             user_agent=request.META.get('HTTP_USER_AGENT', '')
         )
         
         # WebSocketで全参加者に通知
-        locations_data = get_all_locations_data(session)
-        notify_location_update(session_id, locations_data)
+        publish_room_change(session, participant_id, {'is_active': False})
         
         return JsonResponse({'success': True, 'message': 'セッションから退出しました'})
         
@@ -459,6 +595,43 @@ def api_leave_session(request, session_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def process_stats():
+    """このプロセスの内部カウンター（/api/stats/ と /metrics で共有）"""
+    return {
+        'fix_filter': fix_filter.stats(),
+        'presence': presence.stats(),
+        'connections': connection_registry.stats(),
+        'messages': message_stats.stats(),
+        'admission': admission.stats(),
+        'async_db_pool': async_db.pool.stats(),
+        'session_log': session_events.stats(),
+        'mail_queue': mail_queue.stats(),
+        'location_buffer': {
+            'flushed_rows': location_buffer.flushed_rows,
+            'dropped_rows': location_buffer.dropped_rows,
+            'coalesced_fixes': location_buffer.coalesced_fixes,
+            'history_rows': location_buffer.history_rows,
+            'history_dropped': location_buffer.history_dropped,
+        },
+    }
+
+@staff_member_required
+@require_http_methods(["GET"])
+def api_stats(request):
+    """このプロセスの内部カウンター（管理者のみ）"""
+    return JsonResponse(process_stats())
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """Prometheus形式のメトリクス（スタッフまたはMETRICS_ALLOWED_IPSから）"""
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponse(status=403)
+    stats = process_stats()
+    # メッセージ数は tracker_ws_messages_total として出力済み
+    stats.pop('messages')
+    return HttpResponse(metrics.render(stats), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def get_client_ip(request):
     """クライアントのIPアドレスを取得"""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')